@@ -3,30 +3,27 @@
 # import packages
 import datetime as dt
 import os
-import sqlite3
+import sys
 
 import matplotlib.pyplot as plt
-import pandas as pd
 import seaborn as sns
+from sqlalchemy import create_engine
+
+# the report queries are shared with the v2 report
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'v2_mysql', 'reports'))
+from report_data import ReportData
 
 sns.set_style('whitegrid')
 sns.despine()
 
-# read in data
-connection = sqlite3.connect("treasure.db")
-cursor = connection.cursor()
-cursor.execute("SELECT * FROM marketplace_sales;")
-marketplace_sales = cursor.fetchall()
-marketplace_sales = pd.DataFrame(marketplace_sales)
-marketplace_sales.columns = [description[0] for description in cursor.description]
-
-# column manipulations as necessary
-marketplace_sales['timestamp'] = pd.to_datetime(marketplace_sales['timestamp'])
-marketplace_sales['date'] = marketplace_sales['timestamp'].dt.date
+# connect to database, each chart below only reads the daily aggregates it needs
+engine = create_engine("sqlite:///treasure.db")
+connection = engine.connect()
+report_data = ReportData(connection, time_column='timestamp')
 
 ## build charts
 # total volume
-daily_sales = marketplace_sales.groupby(['date'], as_index=False).agg({'quantity':'sum', 'sale_amt_magic':'sum'})
+daily_sales = report_data.daily_sales()
 
 sns.barplot(daily_sales.date,daily_sales.quantity, color='blue')
 plt.title("# of Sales on Treasure Marketplace per Day")
@@ -45,7 +42,7 @@ g.set_yticklabels(ylabels)
 plt.show()
 
 # volume by collection
-daily_sales_by_collection = marketplace_sales.groupby(['date', 'nft_collection'], as_index=False).agg({'quantity':'sum', 'sale_amt_magic':'sum'})
+daily_sales_by_collection = report_data.daily_sales(['nft_collection'])
 
 ax = sns.histplot(
     daily_sales_by_collection,
@@ -80,8 +77,8 @@ g.set_yticklabels(ylabels)
 plt.show()
 
 # average sale price by collection
-marketplace_sales['sale_amt_magic_adj'] = marketplace_sales['sale_amt_magic'] / marketplace_sales['quantity'] # temporary 'fix'
-med_sales_by_collection = marketplace_sales.groupby(['date', 'nft_collection'], as_index=False).agg({'sale_amt_magic_adj':'median'})
+# sale_amt_magic_adj is sale_amt_magic / quantity, a temporary 'fix'
+med_sales_by_collection = report_data.daily_median_price(['nft_collection'])
 
 g = sns.lineplot(
     data=med_sales_by_collection.loc[med_sales_by_collection.nft_collection!='extra_life'],
@@ -98,7 +95,11 @@ ylabels = ['{:,.0f}'.format(y) + 'K' for y in g.get_yticks()/1000]
 plt.show()
 
 # average sale price by legion and treasures
-med_sales_by_nft_legions = marketplace_sales.loc[marketplace_sales['nft_collection']=='legions_genesis'].groupby(['date', 'nft_subcategory'], as_index=False).agg({'sale_amt_magic_adj':'median', 'sale_amt_magic':'sum', 'quantity':'sum'})
+med_sales_by_nft_legions = report_data.daily_median_price(['nft_subcategory'], collection='legions_genesis').merge(
+    report_data.daily_sales(['nft_subcategory'], collection='legions_genesis'),
+    how='outer',
+    on=['date', 'nft_subcategory']
+)
 
 g = sns.lineplot(
     data=med_sales_by_nft_legions,
@@ -156,10 +157,9 @@ plt.show()
 
 
 
-treasures_df = marketplace_sales.loc[marketplace_sales['nft_collection']=='treasures']
-treasures_first10 = treasures_df.loc[treasures_df.nft_name.isin(treasures_df.nft_name.unique()[40:51])]
+treasures_first10 = report_data.nft_names('treasures')[40:51]
 
-med_sales_by_nft_treasures = treasures_first10.groupby(['date', 'nft_subcategory'], as_index=False).agg({'sale_amt_magic':'median'})
+med_sales_by_nft_treasures = report_data.daily_median_price(['nft_subcategory'], collection='treasures', nft_names=treasures_first10, per_unit=False)
 
 g = sns.lineplot(
     data=med_sales_by_nft_treasures,
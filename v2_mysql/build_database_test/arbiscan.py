@@ -0,0 +1,99 @@
+# In this file we talk to the Arbiscan API. Requests share one token bucket so
+# that we can keep several of them in flight at once while still staying
+# under the API's calls-per-second limit. Calls, their latency and the time
+# spent waiting on the limiter are reported to instrumentation.py.
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import requests
+
+import instrumentation
+
+# point this at a local stand-in (arbiscan_standin.py) to run the pipeline offline
+ARBISCAN_API_URL = os.environ.get('ARBISCAN_API_URL', 'https://api.arbiscan.io/api')
+ARBISCAN_CALLS_PER_SECOND = 2
+ARBISCAN_MAX_WORKERS = 8
+REQUEST_TIMEOUT = 30
+MAX_RETRIES = 3
+
+class TokenBucket:
+    # capacity 1 spaces calls evenly, so no window of `period` ever sees
+    # more than `calls` requests
+    def __init__(self, calls, period, capacity=1):
+        self.rate = calls / period
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+            instrumentation.add('rate_limit_sleep_seconds', wait)
+
+def contract_transactions_url(arbiscan_api_key, contract_address, start_block=0, end_block=99999999, from_address=None, tx_type="txlist", sort="desc"):
+    request_url = ARBISCAN_API_URL
+    request_url = request_url + "?module=account"
+    request_url = request_url + "&action=" + tx_type
+    request_url = request_url + "&address=" + (contract_address if from_address is None else from_address)
+    if tx_type != "txlist":
+        request_url = request_url + "&contractaddress=" + contract_address
+    request_url = request_url + "&startblock=" + str(start_block)
+    request_url = request_url + "&endblock=" + str(end_block)
+    request_url = request_url + "&sort=" + sort
+    request_url = request_url + "&apikey=" + arbiscan_api_key
+    return request_url
+
+def get_json(request_url, rate_limiter, session=requests):
+    rate_limiter.acquire()
+    started_at = time.perf_counter()
+    response = session.get(request_url, timeout=REQUEST_TIMEOUT)
+    instrumentation.add('http_calls')
+    instrumentation.add('http_seconds', time.perf_counter() - started_at)
+    return response.json()
+
+def get_result(request_url, rate_limiter, session=requests, description='arbiscan request'):
+    # a query with nothing to return comes back as status 0 with an empty
+    # list, errors (e.g. rate limiting) as status 0 with a message string,
+    # those are retried with backoff
+    for attempt in range(MAX_RETRIES):
+        response = get_json(request_url, rate_limiter, session)
+        if isinstance(response.get("result"), list):
+            return response["result"]
+        instrumentation.add('http_retries')
+        time.sleep(2 ** attempt)
+    raise RuntimeError('{} failed: {}'.format(description, response.get("result")))
+
+def get_wallet_token_txs(arbiscan_api_key, token_address, wallets, start_block=0, latest_tx_hashes=[], max_workers=ARBISCAN_MAX_WORKERS, calls_per_second=ARBISCAN_CALLS_PER_SECOND):
+    rate_limiter = TokenBucket(calls_per_second, 1)
+    session = requests.Session()
+    session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=max_workers))
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=max_workers))
+    def get_wallet(wallet):
+        request_url = contract_transactions_url(arbiscan_api_key, token_address, start_block=start_block, from_address=wallet, tx_type="tokentx")
+        return get_result(request_url, rate_limiter, session, 'arbiscan tokentx for {}'.format(wallet))
+
+    # map keeps wallet order, so the result matches fetching them one by one
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(get_wallet, wallets))
+    session.close()
+
+    token_txs = [pd.DataFrame.from_dict(result) for result in results]
+    token_txs = [txs for txs in token_txs if not txs.empty]
+    if not token_txs:
+        return pd.DataFrame(columns=['hash', 'value'])
+    token_txs_df = pd.concat(token_txs)
+    token_txs_df = token_txs_df.loc[~token_txs_df['hash'].isin(latest_tx_hashes)]
+    return token_txs_df.drop_duplicates(["hash", "value"])
@@ -0,0 +1,156 @@
+# In this file we crawl Arbiscan by block range. A single txlist/tokentx query
+# returns at most 10,000 transactions, so asking for startblock..99999999 in
+# one go silently drops everything past that cap on a busy contract. Here we
+# split the block range instead, but only where it's needed: each missing
+# range is asked for whole, and when one comes back full the blocks before
+# its last one are kept and the rest is bisected and fetched again. Ranges
+# are fetched in parallel under the shared rate limit, and every completed
+# range is written to a checkpoint directory so a crashed backfill picks up
+# where it left off. Without a checkpoint directory or an end block (a
+# refresh), the first query is open ended, so a quiet stretch takes a single
+# call and the latest block is only looked up if that query comes back full.
+#
+# usage: python arbiscan_crawler.py <contract name> <start block> <end block> <checkpoint dir> <output csv>
+
+import json
+import os
+import sys
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import pandas as pd
+import requests
+
+from arbiscan import ARBISCAN_API_URL, ARBISCAN_CALLS_PER_SECOND, ARBISCAN_MAX_WORKERS, TokenBucket, contract_transactions_url, get_json, get_result
+
+ARBISCAN_MAX_RESULTS = 10000
+# the endblock Arbiscan takes for "up to the latest block"
+OPEN_END_BLOCK = 99999999
+
+def get_latest_block(arbiscan_api_key, rate_limiter):
+    request_url = ARBISCAN_API_URL + "?module=proxy&action=eth_blockNumber&apikey=" + arbiscan_api_key
+    return int(get_json(request_url, rate_limiter)["result"], 16)
+
+def get_block_range(arbiscan_api_key, contract_address, block_range, rate_limiter, session, from_address=None, tx_type="txlist"):
+    start_block, end_block = block_range
+    request_url = contract_transactions_url(arbiscan_api_key, contract_address, start_block=start_block, end_block=end_block, from_address=from_address, tx_type=tx_type, sort="asc")
+    return get_result(request_url, rate_limiter, session, 'arbiscan request for blocks {}-{}'.format(start_block, end_block))
+
+def checkpoint_prefix(contract_address, from_address=None, tx_type="txlist"):
+    # names say what was asked for, so a dir shared between contracts, wallets
+    # or actions never hands one query another's txs
+    return '{}_{}_{}_'.format(tx_type, contract_address.lower(), (from_address or 'all').lower())
+
+def checkpoint_filename(checkpoint_dir, prefix, block_range):
+    return os.path.join(checkpoint_dir, '{}{}_{}.json'.format(prefix, *block_range))
+
+def read_checkpoints(checkpoint_dir, prefix):
+    completed = {}
+    if checkpoint_dir is None or not os.path.isdir(checkpoint_dir):
+        return completed
+    for filename in os.listdir(checkpoint_dir):
+        if not filename.startswith(prefix) or not filename.endswith('.json'):
+            continue
+        start_block, end_block = filename[len(prefix):-5].split('_')
+        with open(os.path.join(checkpoint_dir, filename)) as f:
+            completed[(int(start_block), int(end_block))] = json.loads(f.read())
+    return completed
+
+def write_checkpoint(checkpoint_dir, prefix, block_range, txs):
+    # write then rename so a crash never leaves a half written range behind
+    filename = checkpoint_filename(checkpoint_dir, prefix, block_range)
+    with open(filename + '.tmp', 'w') as f:
+        f.write(json.dumps(txs))
+    os.replace(filename + '.tmp', filename)
+
+def missing_block_ranges(start_block, end_block, completed_ranges):
+    missing = []
+    next_block = start_block
+    for range_start, range_end in sorted(completed_ranges):
+        if range_end < next_block or range_start > end_block:
+            continue
+        if range_start > next_block:
+            missing.append((next_block, range_start - 1))
+        next_block = max(next_block, range_end + 1)
+    if next_block <= end_block:
+        missing.append((next_block, end_block))
+    return missing
+
+def split_block_range(block_range, n_parts):
+    start_block, end_block = block_range
+    step = max(1, -(-(end_block - start_block + 1) // n_parts))
+    return [(s, min(s + step - 1, end_block)) for s in range(start_block, end_block + 1, step)]
+
+def crawl_contract_transactions(arbiscan_api_key, contract_address, start_block=0, end_block=None, checkpoint_dir=None, from_address=None, tx_type="txlist", max_workers=ARBISCAN_MAX_WORKERS, calls_per_second=ARBISCAN_CALLS_PER_SECOND):
+    rate_limiter = TokenBucket(calls_per_second, 1)
+    session = requests.Session()
+    session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=max_workers))
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=max_workers))
+    # a checkpoint has to say which blocks it covers, so only an uncheckpointed crawl can leave the end open
+    open_ended = end_block is None and checkpoint_dir is None
+    if end_block is None:
+        end_block = OPEN_END_BLOCK if open_ended else get_latest_block(arbiscan_api_key, rate_limiter)
+    if checkpoint_dir is not None:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+    prefix = checkpoint_prefix(contract_address, from_address, tx_type)
+    completed = read_checkpoints(checkpoint_dir, prefix)
+    pending = missing_block_ranges(start_block, end_block, completed)
+
+    errors = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        running = {}
+        while (pending and not errors) or running:
+            while pending and not errors:
+                block_range = pending.pop()
+                running[executor.submit(get_block_range, arbiscan_api_key, contract_address, block_range, rate_limiter, session, from_address, tx_type)] = block_range
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                block_range = running.pop(future)
+                if future.exception() is not None:
+                    # stop handing out work but keep checkpointing what's in flight
+                    errors.append(future.exception())
+                    continue
+                txs = future.result()
+                last_block = int(txs[-1]['blockNumber']) if txs else None
+                if len(txs) >= ARBISCAN_MAX_RESULTS and block_range[0] < last_block:
+                    # page came back full: the blocks before its last one are
+                    # all there (txs are in block order), the rest is bisected
+                    covered = (block_range[0], last_block - 1)
+                    completed[covered] = [tx for tx in txs if int(tx['blockNumber']) < last_block]
+                    if checkpoint_dir is not None:
+                        write_checkpoint(checkpoint_dir, prefix, covered, completed[covered])
+                    range_end = block_range[1]
+                    if open_ended and range_end == OPEN_END_BLOCK:
+                        # bisecting up to 99999999 would mostly ask for blocks that don't exist yet
+                        range_end = max(get_latest_block(arbiscan_api_key, rate_limiter), last_block)
+                    pending.extend(split_block_range((last_block, range_end), 2))
+                    continue
+                if len(txs) >= ARBISCAN_MAX_RESULTS and block_range[0] < block_range[1]:
+                    # the first block alone fills the page, so bisect the range
+                    pending.extend(split_block_range(block_range, 2))
+                    continue
+                if len(txs) >= ARBISCAN_MAX_RESULTS:
+                    print('block {} has more than {} txs, some may be missing'.format(block_range[0], ARBISCAN_MAX_RESULTS))
+                completed[block_range] = txs
+                if checkpoint_dir is not None:
+                    write_checkpoint(checkpoint_dir, prefix, block_range, txs)
+    session.close()
+    if errors:
+        raise errors[0]
+
+    txs = [tx for block_range in sorted(completed) if block_range[1] >= start_block and block_range[0] <= end_block for tx in completed[block_range]]
+    txs_df = pd.DataFrame.from_dict(txs)
+    if txs_df.empty:
+        return txs_df
+    txs_df = txs_df.loc[txs_df['blockNumber'].astype('int64').between(start_block, end_block)]
+    return txs_df.drop_duplicates().reset_index(drop=True)
+
+if __name__ == '__main__':
+    contract_name, start_block, end_block, checkpoint_dir, output_path = sys.argv[1:6]
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "constants", "api_key.txt")) as key_file:
+        arbiscan_api_key = key_file.read()
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "constants", "contract_addresses.json")) as contract_address_file:
+        contract_addresses = json.loads(contract_address_file.read())
+    txs_df = crawl_contract_transactions(arbiscan_api_key, contract_addresses[contract_name], int(start_block), int(end_block), checkpoint_dir)
+    txs_df['contract'] = contract_addresses[contract_name]
+    txs_df.to_csv(output_path, index=False)
@@ -0,0 +1,145 @@
+# In this file we serve a local stand-in for the parts of the Arbiscan API the
+# refresh calls (txlist, tokentx, getLogs and eth_blockNumber), answered from
+# a raw archive (raw_archive.py) or any frames of marketplace and MAGIC txs,
+# so the pulls can be run and compared offline. It keeps the API's result
+# caps (10,000 txs per query, 1,000 logs per page, 10,000 logs per getLogs
+# query however it's paged) so the bisecting and paging code paths get
+# exercised too. MAGIC Transfer logs are made up from
+# the archived tokentx rows, with the log index counting up within each tx.
+#
+# usage: python arbiscan_standin.py <archive root> [port]
+# then run the refresh with ARBISCAN_API_URL=http://127.0.0.1:<port>/api
+
+import json
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+
+from arbiscan_crawler import ARBISCAN_MAX_RESULTS
+from magic_logs import LOGS_MAX_RESULTS, LOGS_PAGE_SIZE, TRANSFER_TOPIC
+from raw_archive import read_raw_txs
+
+STANDIN_HOST = '127.0.0.1'
+
+def to_hex(value):
+    return hex(int(value))
+
+def address_topic(address):
+    return '0x' + '0' * 24 + address[2:].lower()
+
+def in_block_range(txs, start_block, end_block):
+    block_numbers = txs['blockNumber'].astype('int64')
+    return txs.loc[(block_numbers >= int(start_block)) & (block_numbers <= int(end_block))]
+
+def sort_by_block(txs, sort):
+    return txs.sort_values('blockNumber', key=lambda x: x.astype('int64'), ascending=sort != 'desc', kind='mergesort')
+
+def as_records(txs):
+    # the API returns every field as a string
+    return txs.astype(object).where(pd.notnull(txs), '').astype(str).to_dict('records')
+
+def response(result):
+    if isinstance(result, list) and not result:
+        return {'status': '0', 'message': 'No records found', 'result': []}
+    return {'status': '1', 'message': 'OK', 'result': result}
+
+class ArbiscanStandIn:
+    def __init__(self, marketplace_txs, magic_txs):
+        self.marketplace_txs = marketplace_txs.reset_index(drop=True)
+        self.magic_txs = magic_txs.reset_index(drop=True)
+        self.calls = []
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_archive(cls, archive_root):
+        return cls(read_raw_txs(archive_root, 'marketplace'), read_raw_txs(archive_root, 'magic'))
+
+    def latest_block(self):
+        return max(int(self.marketplace_txs['blockNumber'].astype('int64').max()), int(self.magic_txs['blockNumber'].astype('int64').max()))
+
+    def answer(self, params):
+        with self.lock:
+            self.calls.append(params)
+        action = params.get('action')
+        if action == 'eth_blockNumber':
+            return {'jsonrpc': '2.0', 'id': 83, 'result': to_hex(self.latest_block())}
+        if action == 'txlist':
+            return response(self.txlist(params))
+        if action == 'tokentx':
+            return response(self.tokentx(params))
+        if action == 'getLogs':
+            if int(params.get('page', 1)) * int(params.get('offset', LOGS_PAGE_SIZE)) > LOGS_MAX_RESULTS:
+                return {'status': '0', 'message': 'NOTOK', 'result': 'Result window is too large, PageNo x Offset size must be less than or equal to {}'.format(LOGS_MAX_RESULTS)}
+            return response(self.get_logs(params))
+        return {'status': '0', 'message': 'NOTOK', 'result': 'Error! Unknown action'}
+
+    def txlist(self, params):
+        # txs sent to the contract, which is what the marketplace's txlist is
+        txs = self.marketplace_txs.loc[self.marketplace_txs['to'].str.lower() == params['address'].lower()]
+        txs = in_block_range(txs, params.get('startblock', 0), params.get('endblock', 99999999))
+        return as_records(sort_by_block(txs, params.get('sort')).drop(columns=['contract'], errors='ignore').head(ARBISCAN_MAX_RESULTS))
+
+    def tokentx(self, params):
+        wallet = params['address'].lower()
+        txs = self.magic_txs
+        if 'contractAddress' in txs.columns and 'contractaddress' in params:
+            txs = txs.loc[txs['contractAddress'].str.lower() == params['contractaddress'].lower()]
+        txs = txs.loc[(txs['from'].str.lower() == wallet) | (txs['to'].str.lower() == wallet)]
+        txs = in_block_range(txs, params.get('startblock', 0), params.get('endblock', 99999999))
+        return as_records(sort_by_block(txs, params.get('sort')).head(ARBISCAN_MAX_RESULTS))
+
+    def get_logs(self, params):
+        if params.get('topic0', TRANSFER_TOPIC).lower() != TRANSFER_TOPIC:
+            return []
+        txs = self.magic_txs
+        if 'contractAddress' in txs.columns:
+            txs = txs.loc[txs['contractAddress'].str.lower() == params['address'].lower()]
+        txs = sort_by_block(in_block_range(txs, params.get('fromBlock', 0), params.get('toBlock', 99999999)), 'asc')
+        offset = min(int(params.get('offset', LOGS_PAGE_SIZE)), LOGS_PAGE_SIZE)
+        page = int(params.get('page', 1))
+        log_index = txs.groupby('hash').cumcount()
+        txs = txs.assign(logIndex=log_index).iloc[(page - 1) * offset:page * offset]
+        return [{
+            'address': params['address'].lower(),
+            'topics': [TRANSFER_TOPIC, address_topic(tx['from']), address_topic(tx['to'])],
+            'data': '0x' + format(int(tx['value']), '064x'),
+            'blockNumber': to_hex(tx['blockNumber']),
+            'timeStamp': to_hex(tx['timeStamp']),
+            'gasPrice': '0x', 'gasUsed': '0x',
+            'logIndex': to_hex(tx['logIndex']),
+            'transactionHash': tx['hash'],
+            'transactionIndex': '0x',
+        } for tx in txs.to_dict('records')]
+
+def make_handler(standin):
+    class StandInHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            params = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+            body = json.dumps(standin.answer(params)).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+    return StandInHandler
+
+def serve(standin, port=0):
+    # serves from a background thread, returns the server and its API url
+    server = ThreadingHTTPServer((STANDIN_HOST, port), make_handler(standin))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://{}:{}/api'.format(STANDIN_HOST, server.server_port)
+
+if __name__ == '__main__':
+    standin = ArbiscanStandIn.from_archive(sys.argv[1])
+    server, url = serve(standin, int(sys.argv[2]) if len(sys.argv) > 2 else 0)
+    print('serving {} marketplace txs and {} magic txs at {}'.format(len(standin.marketplace_txs), len(standin.magic_txs), url))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,111 @@
+# In this file we compare building the sales and listings tables from string
+# frames against building them from compact_frames' integer-coded/categorical
+# frames (including the encode and decode), on the synthetic workload
+# (synthetic_workload.py) run through process_marketplace_txs. It reports the
+# in-memory size of the inputs, the time of each step (listing_keys is the
+# merge/groupby half of the listings build, listings the whole of it), the
+# peak memory traced while reading (and encoding) the inputs and the peak
+# while building the tables from them, and checks both ways give the same
+# tables. The read peak of the coded run still holds the string frame it
+# encodes; build_listings_table.py avoids most of that by coding each raw
+# object as it's read.
+#
+# usage: python benchmarks/bench_compact_frames.py [n events]
+
+import os
+import pickle
+import sys
+import time
+import tracemalloc
+
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from compact_frames import StringDictionary, decode_frame, encode_frame
+from listing_lifecycle import LISTING_TX_TYPES, prepare_listing_sales, sort_listing_events
+from refresh_pipeline import config
+from refresh_pipeline.transform import build_marketplace_listings_table, build_marketplace_sales_table, process_marketplace_txs
+from synthetic_workload import synthetic_workload
+
+def processed_workload(n_events, seed=0):
+    # the synthetic workload's successful txs through process_marketplace_txs,
+    # and the hash and wei value of its MAGIC transfers
+    marketplace_txs_raw, magic_txs = synthetic_workload(n_events, seed)
+    marketplace_txs = process_marketplace_txs(marketplace_txs_raw.loc[marketplace_txs_raw.txreceipt_status=='1'])
+    return marketplace_txs, magic_txs.loc[:, ['hash', 'value']]
+
+def frame_mb(*frames):
+    return sum(frame.memory_usage(deep=True).sum() for frame in frames) / 1e6
+
+def timed(timings, step, function, *args):
+    started_at = time.perf_counter()
+    result = function(*args)
+    timings[step] = time.perf_counter() - started_at
+    return result
+
+def listing_keys(marketplace_txs, sales):
+    # the merge and groupby half of the listings build, without the sweep
+    listing_sales = prepare_listing_sales(sales, marketplace_txs)
+    listings = marketplace_txs.loc[marketplace_txs['tx_type'].isin(LISTING_TX_TYPES)].reset_index(drop=True)
+    updates = marketplace_txs.loc[marketplace_txs['tx_type']=='updateListing'].reset_index(drop=True)
+    cancellations = marketplace_txs.loc[marketplace_txs['tx_type']=='cancelListing'].reset_index(drop=True)
+    return sort_listing_events(listings, updates, cancellations, listing_sales.reset_index(drop=True))
+
+def build(inputs, contract_addresses, timings, coded):
+    # inputs are unpickled here so the traced peak includes holding them,
+    # like a rebuild that has just read its txs
+    marketplace_txs, magic_txs = pickle.loads(inputs)
+    if coded:
+        dictionary = StringDictionary()
+        marketplace_txs = timed(timings, 'encode', encode_frame, marketplace_txs, dictionary)
+        magic_txs = encode_frame(magic_txs, dictionary)
+    timings['input_mb'] = frame_mb(marketplace_txs, magic_txs)
+    if tracemalloc.is_tracing():
+        timings['peak_read_mb'] = tracemalloc.get_traced_memory()[1] / 1e6
+        tracemalloc.reset_peak()
+    sales = timed(timings, 'sales', build_marketplace_sales_table, marketplace_txs, magic_txs, contract_addresses)
+    timed(timings, 'listing_keys', listing_keys, marketplace_txs, sales)
+    listings = timed(timings, 'listings', build_marketplace_listings_table, marketplace_txs, sales)
+    if coded:
+        started_at = time.perf_counter()
+        sales, listings = decode_frame(sales, dictionary), decode_frame(listings, dictionary)
+        timings['decode'] = time.perf_counter() - started_at
+    return sales, listings
+
+def run(inputs, coded):
+    # timed untraced, tracemalloc slows every allocation down; then built a
+    # second time under tracemalloc for the peak
+    contract_addresses = config.contract_addresses()
+    timings = {}
+    started_at = time.perf_counter()
+    sales, listings = build(inputs, contract_addresses, timings, coded)
+    timings['total'] = time.perf_counter() - started_at
+    tracemalloc.start()
+    traced = {}
+    build(inputs, contract_addresses, traced, coded)
+    timings['peak_read_mb'] = traced['peak_read_mb']
+    timings['peak_build_mb'] = tracemalloc.get_traced_memory()[1] / 1e6
+    tracemalloc.stop()
+    return sales, listings, timings
+
+def main(n_events):
+    marketplace_txs, magic_txs = processed_workload(n_events)
+    print('{} marketplace txs, {} magic txs'.format(len(marketplace_txs), len(magic_txs)))
+    inputs = pickle.dumps((marketplace_txs, magic_txs))
+    del marketplace_txs, magic_txs
+    string_sales, string_listings, string_metrics = run(inputs, coded=False)
+    coded_sales, coded_listings, coded_metrics = run(inputs, coded=True)
+    pd.testing.assert_frame_equal(string_sales.reset_index(drop=True), coded_sales.reset_index(drop=True), check_dtype=False)
+    pd.testing.assert_frame_equal(string_listings.reset_index(drop=True), coded_listings.reset_index(drop=True), check_dtype=False)
+
+    # times in seconds, sizes in MB
+    print('{:<14}{:>12}{:>12}{:>10}'.format('', 'strings', 'coded', 'ratio'))
+    for metric in ['input_mb', 'peak_read_mb', 'peak_build_mb', 'encode', 'sales', 'listing_keys', 'listings', 'decode', 'total']:
+        string_value, coded_value = string_metrics.get(metric, 0.0), coded_metrics.get(metric, 0.0)
+        ratio = '{:.1f}x'.format(string_value / coded_value) if string_value and coded_value else ''
+        print('{:<14}{:>12.3f}{:>12.3f}{:>10}'.format(metric, string_value, coded_value, ratio))
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 300000)
@@ -0,0 +1,171 @@
+# In this file we time and memory-profile each stage of the refresh on the
+# synthetic workload (synthetic_workload.py) at one or more scales:
+# process_marketplace_txs, build_marketplace_sales_table,
+# build_marketplace_listings_table and the SQL load of the sales (upsert) and
+# listings (bulk load). The load goes to a throwaway SQLite database unless
+# --db points at another one, where it writes bench_ tables and drops them
+# again. Every stage is timed untraced and then run a second time under
+# tracemalloc for its peak (--no-memory skips that). The results are written
+# as JSON with the commit and environment they were measured on, and
+# --baseline compares them against an earlier results file.
+#
+# usage: python benchmarks/bench_pipeline.py [n events ...] [--output results.json] [--baseline results.json] [--db url] [--no-memory] [--seed N]
+
+import datetime as dt
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from bulk_load import bulk_load, upsert
+from refresh_pipeline.transform import build_marketplace_listings_table, build_marketplace_sales_table, process_marketplace_txs
+from synthetic_workload import synthetic_workload
+
+DEFAULT_SCALES = [10000, 100000, 1000000]
+# a stage this much slower than in the baseline is flagged
+REGRESSION_RATIO = 1.2
+BENCH_TABLE_PREFIX = 'bench_'
+
+stages = ['process_marketplace_txs', 'build_marketplace_sales_table', 'build_marketplace_listings_table', 'sql_load']
+
+def run_stage(function, args, trace_memory):
+    started_at = time.perf_counter()
+    result = function(*args)
+    metrics = {'seconds': round(time.perf_counter() - started_at, 4)}
+    if trace_memory:
+        # the result is dropped first so the traced run doesn't share it
+        del result
+        tracemalloc.start()
+        result = function(*args)
+        metrics['peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 1e6, 1)
+        tracemalloc.stop()
+    return result, metrics
+
+def drop_bench_tables(connection):
+    for table in ['marketplace_sales', 'marketplace_listings']:
+        connection.exec_driver_sql('DROP TABLE IF EXISTS {}{}'.format(BENCH_TABLE_PREFIX, table))
+
+def load_tables(engine, sales, listings):
+    # the writes the refresh makes, into empty bench_ tables
+    with engine.connect() as connection:
+        drop_bench_tables(connection)
+        upsert(sales, BENCH_TABLE_PREFIX + 'marketplace_sales', connection, key='tx_hash')
+        bulk_load(listings, BENCH_TABLE_PREFIX + 'marketplace_listings', connection)
+        drop_bench_tables(connection)
+
+def bench_scale(n_events, engine, seed, trace_memory):
+    started_at = time.perf_counter()
+    marketplace_txs_raw, magic_txs = synthetic_workload(n_events, seed)
+    generate_seconds = round(time.perf_counter() - started_at, 4)
+    # only successful txs reach process_marketplace_txs, as in the refresh
+    marketplace_txs_raw = marketplace_txs_raw.loc[marketplace_txs_raw.txreceipt_status=='1']
+
+    results = {}
+    marketplace_txs, results['process_marketplace_txs'] = run_stage(process_marketplace_txs, (marketplace_txs_raw,), trace_memory)
+    sales, results['build_marketplace_sales_table'] = run_stage(build_marketplace_sales_table, (marketplace_txs, magic_txs), trace_memory)
+    listings, results['build_marketplace_listings_table'] = run_stage(build_marketplace_listings_table, (marketplace_txs, sales), trace_memory)
+    _, results['sql_load'] = run_stage(load_tables, (engine, sales, listings), trace_memory)
+    results['process_marketplace_txs']['rows'] = len(marketplace_txs)
+    results['build_marketplace_sales_table']['rows'] = len(sales)
+    results['build_marketplace_listings_table']['rows'] = len(listings)
+    results['sql_load']['rows'] = len(sales) + len(listings)
+    for metrics in results.values():
+        metrics['rows_per_second'] = round(metrics['rows'] / metrics['seconds'], 1) if metrics['seconds'] > 0 else None
+
+    return {
+        'events': n_events,
+        'marketplace_txs': len(marketplace_txs_raw),
+        'magic_txs': len(magic_txs),
+        'generate_seconds': generate_seconds,
+        'stages': results,
+    }
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def environment(engine):
+    return {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'database': engine.dialect.name,
+    }
+
+def compare(results, baseline):
+    # stage timings of the scales both runs have, as new / baseline
+    baseline_scales = {scale['events']: scale for scale in baseline['scales']}
+    print('{:<10}{:<36}{:>12}{:>12}{:>10}'.format('events', 'stage', 'baseline', 'now', 'ratio'))
+    for scale in results['scales']:
+        if scale['events'] not in baseline_scales:
+            continue
+        for stage in stages:
+            before = baseline_scales[scale['events']]['stages'].get(stage, {}).get('seconds')
+            now = scale['stages'][stage]['seconds']
+            if not before:
+                continue
+            ratio = now / before
+            flag = '  slower' if ratio > REGRESSION_RATIO else ''
+            print('{:<10}{:<36}{:>12.3f}{:>12.3f}{:>9.2f}x{}'.format(scale['events'], stage, before, now, ratio, flag))
+
+def print_results(results):
+    # times in seconds, peaks in MB
+    print('{:<10}{:<36}{:>10}{:>12}{:>10}{:>14}'.format('events', 'stage', 'rows', 'seconds', 'peak_mb', 'rows/s'))
+    for scale in results['scales']:
+        for stage in stages:
+            metrics = scale['stages'][stage]
+            print('{:<10}{:<36}{:>10}{:>12.3f}{:>10}{:>14}'.format(
+                scale['events'], stage, metrics['rows'], metrics['seconds'], metrics.get('peak_mb', ''), metrics['rows_per_second'] or ''
+            ))
+
+def main(argv):
+    options = {}
+    for name in ['--output', '--baseline', '--db', '--seed']:
+        if name in argv:
+            position = argv.index(name)
+            options[name] = argv[position + 1]
+            argv = argv[:position] + argv[position + 2:]
+    trace_memory = '--no-memory' not in argv
+    scales = [int(x) for x in argv if x != '--no-memory'] or DEFAULT_SCALES
+    seed = int(options.get('--seed', 0))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        engine = create_engine(options.get('--db') or 'sqlite:///{}'.format(os.path.join(tmp_dir, 'bench.db')))
+        results = {
+            'benchmark': 'pipeline',
+            'started_at': dt.datetime.now(dt.timezone.utc).isoformat(timespec='seconds'),
+            'seed': seed,
+            'environment': environment(engine),
+            'scales': [],
+        }
+        for n_events in scales:
+            results['scales'].append(bench_scale(n_events, engine, seed, trace_memory))
+        engine.dispose()
+
+    print_results(results)
+    if '--baseline' in options:
+        with open(options['--baseline']) as f:
+            compare(results, json.load(f))
+    if '--output' in options:
+        with open(options['--output'], 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,315 @@
+# In this file we generate a synthetic marketplace workload shaped like what
+# the refresh pulls from Arbiscan, so every stage can be run and measured
+# without Arbiscan, S3 or MySQL. Each listing key (seller, collection, token)
+# gets a createListing, maybe some updateListings, and then a cancelListing,
+# one or more buyItems or nothing (it stays open). The txs are raw txlist rows
+# with their calldata ABI-encoded the way the marketplace contracts take it,
+# for the collections in contract_addresses.json, and every buy comes with
+# the buyer's two MAGIC tokentx transfers: 95% to the seller and 5% to the
+# DAO. Everything is built column-wise with numpy, a chunk at a time, so 10M
+# events take minutes rather than hours.
+#
+# usage: python benchmarks/synthetic_workload.py <n events> <archive root> [--seed N]
+# writes the workload as a raw archive (raw_archive.py) for rebuild_db.py
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from raw_archive import write_raw_txs
+from refresh_pipeline import config
+
+CHUNK_SIZE = 1000000
+START_BLOCK = 3000000
+START_TIMESTAMP = 1638316800
+BLOCKS_PER_SECOND = 4
+# average gap between two events of the whole marketplace, in blocks
+BLOCKS_PER_EVENT = 3
+# gap between two events of the same listing, in blocks
+MAX_LIFECYCLE_GAP = 20000
+
+FAILED_TX_SHARE = 0.01
+NEVER_EXPIRES_SHARE = 0.02
+MAGIC_DECIMALS = 18
+# prices are drawn in hundredths of a MAGIC
+PRICE_DECIMALS = 2
+
+# listings per key end in a cancellation, one or more sales, or stay open
+ENDINGS = ['cancelListing', 'buyItem', None]
+ENDING_PROBABILITIES = [0.2, 0.5, 0.3]
+UPDATE_PROBABILITIES = [0.6, 0.3, 0.1]
+
+# relative activity of each collection, anything not listed gets 1
+collection_weights = {
+    'treasures': 8,
+    'legions': 6,
+    'consumables': 4,
+    'smol_brains': 3,
+    'legacy_legions': 2,
+    'legacy_legions_genesis': 2,
+}
+# ERC1155 collections, listed and bought in quantities above one
+multi_quantity_collections = ['treasures', 'consumables', 'extra_life', 'quest_keys', 'smol_brains_land']
+# median listing price in MAGIC, anything not listed gets 50
+median_prices = {
+    'treasures': 20,
+    'consumables': 5,
+    'legions': 150,
+    'legacy_legions_genesis': 600,
+    'smol_brains': 300,
+}
+COLLECTION_SUPPLY = 10000
+
+# the raw columns the refresh reads, in txlist/tokentx order
+marketplace_columns = ['blockNumber', 'timeStamp', 'hash', 'from', 'to', 'value', 'gas', 'gasPrice', 'isError', 'txreceipt_status', 'input', 'gasUsed', 'contract']
+magic_columns = ['blockNumber', 'timeStamp', 'hash', 'from', 'contractAddress', 'to', 'value', 'tokenName', 'tokenSymbol', 'tokenDecimal']
+
+HEX_DIGITS = np.frombuffer(b'0123456789abcdef', dtype=np.uint8)
+WORD_DIGITS = 64
+
+def hex_matrix_to_strings(matrix, prefix='0x'):
+    # (rows x chars) ascii matrix -> one Python string per row
+    matrix = np.ascontiguousarray(matrix, dtype=np.uint8)
+    strings = matrix.view('S{}'.format(matrix.shape[1])).ravel().astype(str).astype(object)
+    return prefix + strings if prefix else strings
+
+def random_hex_matrix(rng, n_rows, n_digits):
+    return HEX_DIGITS[rng.integers(0, 16, size=(n_rows, n_digits))]
+
+def int_words(values):
+    # uint64 values as 64-digit zero-padded hex words
+    values = np.asarray(values, dtype=np.uint64)
+    shifts = np.arange(60, -1, -4, dtype=np.uint64)
+    words = np.full((len(values), WORD_DIGITS), ord('0'), dtype=np.uint8)
+    words[:, -16:] = HEX_DIGITS[((values[:, None] >> shifts) & np.uint64(0xf)).astype(np.int64)]
+    return words
+
+def big_int_words(values, scale):
+    # values * scale, which can overflow 64 bits (wei amounts), as words.
+    # There are few distinct values, so each is formatted once in Python
+    uniques, inverse = np.unique(values, return_inverse=True)
+    words = ''.join(format(int(x) * scale, '064x') for x in uniques).encode()
+    return np.frombuffer(words, dtype=np.uint8).reshape(len(uniques), WORD_DIGITS)[inverse]
+
+def address_words(addresses):
+    # '0x' + 40 digit addresses, left padded to words
+    addresses = np.asarray([x[2:].lower() for x in addresses], dtype='S40')
+    words = np.full((len(addresses), WORD_DIGITS), ord('0'), dtype=np.uint8)
+    words[:, -40:] = addresses.view(np.uint8).reshape(len(addresses), 40)
+    return words
+
+def calldata(method_id, *words):
+    method_id = np.frombuffer(method_id[2:].encode(), dtype=np.uint8)
+    n_rows = len(words[0])
+    return hex_matrix_to_strings(np.hstack([np.broadcast_to(method_id, (n_rows, len(method_id)))] + list(words)))
+
+def int_strings(values):
+    return np.asarray(values).astype(str).astype(object)
+
+def calldata_collections():
+    # contract_addresses.json keys collections by the 41 characters the
+    # decoder slices out of the calldata (one padding zero + the address),
+    # everything else there has a plain 0x address
+    return {name: '0x' + address[1:].lower() for name, address in config.contract_addresses().items() if not address.startswith('0x')}
+
+def collection_token_ids():
+    token_ids = {
+        'treasures': sorted(config.treasure_ids_numeric()),
+        'legacy_legions': sorted(config.treasure_ids_numeric()),
+        'legacy_legions_genesis': sorted(config.treasure_ids_numeric()),
+        'consumables': sorted(config.consumable_ids_numeric()),
+    }
+    return {name: np.asarray(ids, dtype=np.int64) for name, ids in token_ids.items()}
+
+def selectors():
+    # method name -> selector, the two buyItem selectors are the old and the
+    # new marketplace's
+    method_ids = config.method_ids()
+    by_name = {name: [method_id for method_id, method in method_ids.items() if method == name] for name in set(method_ids.values())}
+    return {
+        'createListing': by_name['createListing'][0],
+        'updateListing': by_name['updateListing'][0],
+        'cancelListing': by_name['cancelListing'][0],
+        'buyItem': {'treasure_marketplace': '0xde250604', 'treasure_marketplace_2': '0x7d1a6533'},
+    }
+
+def wallet_pool(n_events, seed):
+    rng = np.random.default_rng([seed, 0])
+    return hex_matrix_to_strings(random_hex_matrix(rng, max(n_events // 50, 100), 40))
+
+def skewed_choice(rng, n_values, size):
+    # low indices are picked far more often, like a few wallets doing most trades
+    return (n_values * rng.random(size) ** 3).astype(np.int64)
+
+def group_positions(counts):
+    # 0, 1, .. within each run of np.repeat(np.arange(len(counts)), counts)
+    offsets = np.repeat(np.cumsum(counts) - counts, counts)
+    return np.arange(counts.sum()) - offsets
+
+def draw_listings(rng, n_listings, wallets, collections, token_ids):
+    names = list(collections)
+    weights = np.array([collection_weights.get(name, 1) for name in names], dtype='float64')
+    collection = rng.choice(len(names), size=n_listings, p=weights / weights.sum())
+    nft_id = rng.integers(0, COLLECTION_SUPPLY, size=n_listings)
+    for i, name in enumerate(names):
+        if name in token_ids:
+            is_collection = collection == i
+            nft_id[is_collection] = rng.choice(token_ids[name], size=is_collection.sum())
+    is_multi = np.isin(np.array(names, dtype=object)[collection], multi_quantity_collections)
+    quantity = np.where(is_multi, rng.geometric(0.3, size=n_listings), 1)
+    ending = rng.choice(len(ENDINGS), size=n_listings, p=ENDING_PROBABILITIES)
+    n_buys = np.where(ending == ENDINGS.index('buyItem'), rng.integers(1, np.minimum(quantity, 3) + 1), 0)
+    return pd.DataFrame({
+        'seller': skewed_choice(rng, len(wallets), n_listings),
+        'collection': collection,
+        'nft_id': nft_id,
+        'quantity': quantity,
+        'n_updates': rng.choice(len(UPDATE_PROBABILITIES), size=n_listings, p=UPDATE_PROBABILITIES),
+        'ending': ending,
+        'n_buys': n_buys,
+    })
+
+def mean_listing_events():
+    mean_buys = ENDING_PROBABILITIES[ENDINGS.index('buyItem')] * 1.5
+    return 1 + np.dot(np.arange(len(UPDATE_PROBABILITIES)), UPDATE_PROBABILITIES) + ENDING_PROBABILITIES[ENDINGS.index('cancelListing')] + mean_buys
+
+def generate_chunk(n_events, chunk_index, seed, wallets, first_block, switch_block):
+    rng = np.random.default_rng([seed, chunk_index + 1])
+    collections = calldata_collections()
+    collection_names = np.array(list(collections), dtype=object)
+    collection_addresses = np.array(list(collections.values()), dtype=object)
+    methods = selectors()
+    contracts = config.contract_addresses()
+
+    # a few more listings than needed, the events past n_events are cut off
+    n_listings = int(n_events / mean_listing_events() * 1.1) + 10
+    listings = draw_listings(rng, n_listings, wallets, collections, collection_token_ids())
+    listings['first_block'] = first_block + rng.integers(0, n_events * BLOCKS_PER_EVENT, size=n_listings)
+    listings['contract'] = np.where(listings['first_block'] < switch_block, 'treasure_marketplace', 'treasure_marketplace_2')
+
+    # one row per event of every listing: the create, its updates, then the
+    # cancellation or buys
+    n_endings = np.where(listings['ending'] == ENDINGS.index('cancelListing'), 1, listings['n_buys'])
+    counts = (1 + listings['n_updates'] + n_endings).values
+    listing = np.repeat(np.arange(n_listings), counts)
+    position = group_positions(counts)
+    events = listings.iloc[listing].reset_index(drop=True)
+    tx_type = np.where(position == 0, 'createListing', 'updateListing').astype(object)
+    is_ending = position > events['n_updates'].values
+    tx_type[is_ending] = np.where(events['ending'].values[is_ending] == ENDINGS.index('cancelListing'), 'cancelListing', 'buyItem')
+    gaps = np.cumsum(np.where(position == 0, 0, rng.integers(1, MAX_LIFECYCLE_GAP, size=len(events))))
+    events['blockNumber'] = events['first_block'].values + gaps - np.repeat(gaps[np.cumsum(counts) - counts], counts)
+    events['tx_type'] = tx_type
+
+    # creates and updates set the price, buys pay the last one set
+    median = np.array([median_prices.get(name, 50) for name in collection_names])[events['collection'].values]
+    price = np.maximum(np.round(median * rng.lognormal(0, 0.5, size=len(events)) * 10 ** PRICE_DECIMALS), 1).astype(np.int64)
+    is_listing = np.isin(tx_type, ['createListing', 'updateListing'])
+    price = pd.Series(np.where(is_listing, price, np.nan)).groupby(listing).ffill().values.astype(np.int64)
+
+    # buys split the listed quantity, the last one takes what's left
+    buy_number = position - events['n_updates'].values - 1
+    n_buys = events['n_buys'].values
+    quantity = events['quantity'].values
+    bought = np.where(buy_number == n_buys - 1, quantity - (quantity // np.maximum(n_buys, 1)) * (n_buys - 1), quantity // np.maximum(n_buys, 1))
+    events['event_quantity'] = np.where(tx_type == 'buyItem', bought, quantity)
+    events['price'] = price
+
+    events = events.sort_values('blockNumber', kind='mergesort').iloc[:n_events].reset_index(drop=True)
+    n_rows = len(events)
+    tx_type = events['tx_type'].values
+    buyer = skewed_choice(rng, len(wallets), n_rows)
+    seller = events['seller'].values
+    collection_words = address_words(collection_addresses[events['collection'].values])
+    nft_id_words = int_words(events['nft_id'].values)
+    quantity_words = int_words(events['event_quantity'].values)
+    datetime_ms = (START_TIMESTAMP + (events['blockNumber'].values - START_BLOCK) // BLOCKS_PER_SECOND) * 1000
+    expiration_ms = datetime_ms + rng.integers(1, 31, size=n_rows) * 86400000
+    expiration_ms = np.where(rng.random(n_rows) < NEVER_EXPIRES_SHARE, np.iinfo(np.uint64).max, expiration_ms.astype(np.uint64))
+
+    inputs = np.empty(n_rows, dtype=object)
+    for name in ['createListing', 'updateListing']:
+        rows = tx_type == name
+        # (nftAddress, tokenId, quantity, pricePerItem, expirationTime)
+        inputs[rows] = calldata(
+            methods[name], collection_words[rows], nft_id_words[rows], quantity_words[rows],
+            big_int_words(events['price'].values[rows], 10 ** (MAGIC_DECIMALS - PRICE_DECIMALS)), int_words(expiration_ms[rows])
+        )
+    rows = tx_type == 'cancelListing'
+    # (nftAddress, tokenId)
+    inputs[rows] = calldata(methods['cancelListing'], collection_words[rows], nft_id_words[rows])
+    for contract, method_id in methods['buyItem'].items():
+        rows = (tx_type == 'buyItem') & (events['contract'].values == contract)
+        # (nftAddress, tokenId, owner, quantity)
+        inputs[rows] = calldata(method_id, collection_words[rows], nft_id_words[rows], address_words(wallets[seller[rows]]), quantity_words[rows])
+
+    is_buy = tx_type == 'buyItem'
+    hashes = hex_matrix_to_strings(random_hex_matrix(rng, n_rows, 64))
+    failed = rng.random(n_rows) < FAILED_TX_SHARE
+    marketplace_addresses = np.array([contracts['treasure_marketplace'], contracts['treasure_marketplace_2']], dtype=object)
+    contract = np.where(events['contract'].values == 'treasure_marketplace', marketplace_addresses[0], marketplace_addresses[1])
+    marketplace_txs_raw = pd.DataFrame({
+        'blockNumber': int_strings(events['blockNumber'].values),
+        'timeStamp': int_strings(datetime_ms // 1000),
+        'hash': hashes,
+        'from': np.where(is_buy, wallets[buyer], wallets[seller]),
+        'to': pd.Series(contract).str.lower().values,
+        'value': '0',
+        'gas': '1500000',
+        'gasPrice': int_strings(rng.integers(100000000, 2000000000, size=n_rows)),
+        'isError': np.where(failed, '1', '0').astype(object),
+        'txreceipt_status': np.where(failed, '0', '1').astype(object),
+        'input': inputs,
+        'gasUsed': int_strings(rng.integers(150000, 900000, size=n_rows)),
+        'contract': contract,
+    }, columns=marketplace_columns)
+
+    # the buyer's transfers for each successful buy, amounts in wei as text
+    paid = is_buy & ~failed
+    sale_centi_magic = events['price'].values[paid] * events['event_quantity'].values[paid]
+    wei_zeros = '0' * (MAGIC_DECIMALS - PRICE_DECIMALS - 2)
+    n_sales = paid.sum()
+    magic_txs = pd.DataFrame({
+        'blockNumber': np.tile(marketplace_txs_raw['blockNumber'].values[paid], 2),
+        'timeStamp': np.tile(marketplace_txs_raw['timeStamp'].values[paid], 2),
+        'hash': np.tile(hashes[paid], 2),
+        'from': np.tile(wallets[buyer[paid]], 2),
+        'contractAddress': contracts['magic'].lower(),
+        'to': np.concatenate([wallets[seller[paid]], np.full(n_sales, config.DAO_WALLET, dtype=object)]),
+        'value': np.concatenate([int_strings(sale_centi_magic * 95) + wei_zeros, int_strings(sale_centi_magic * 5) + wei_zeros]),
+        'tokenName': 'MAGIC',
+        'tokenSymbol': 'MAGIC',
+        'tokenDecimal': str(MAGIC_DECIMALS),
+    }, columns=magic_columns)
+    return marketplace_txs_raw, magic_txs
+
+def generate_workload(n_events, seed=0, chunk_size=CHUNK_SIZE):
+    # yields (marketplace txs, magic txs) a chunk of events at a time, each
+    # chunk a later stretch of blocks. The same seed and chunk size give the
+    # same workload
+    wallets = wallet_pool(n_events, seed)
+    switch_block = START_BLOCK + n_events * BLOCKS_PER_EVENT // 2
+    for chunk_index, chunk_start in enumerate(range(0, n_events, chunk_size)):
+        n_chunk_events = min(chunk_size, n_events - chunk_start)
+        first_block = START_BLOCK + chunk_start * BLOCKS_PER_EVENT
+        yield generate_chunk(n_chunk_events, chunk_index, seed, wallets, first_block, switch_block)
+
+def synthetic_workload(n_events, seed=0, chunk_size=CHUNK_SIZE):
+    chunks = list(generate_workload(n_events, seed, chunk_size))
+    marketplace_txs_raw = pd.concat([marketplace for marketplace, _ in chunks], ignore_index=True)
+    magic_txs = pd.concat([magic for _, magic in chunks], ignore_index=True)
+    return marketplace_txs_raw, magic_txs
+
+def write_workload_archive(n_events, archive_root, seed=0, chunk_size=CHUNK_SIZE):
+    for marketplace_txs_raw, magic_txs in generate_workload(n_events, seed, chunk_size):
+        write_raw_txs(marketplace_txs_raw, archive_root, 'marketplace')
+        write_raw_txs(magic_txs, archive_root, 'magic')
+        print('archived {} marketplace txs and {} magic txs'.format(len(marketplace_txs_raw), len(magic_txs)))
+
+if __name__ == '__main__':
+    seed = int(sys.argv[sys.argv.index('--seed') + 1]) if '--seed' in sys.argv else 0
+    write_workload_archive(int(sys.argv[1]), sys.argv[2], seed)
@@ -0,0 +1,367 @@
+# In this file we store marketplace_sales and marketplace_listings with
+# compact keys. Wallets (42 char hex) and tx hashes (66 char hex) are held as
+# VARCHAR(255) text, so every row, index entry and join key on them is several
+# times the size it needs to be. The keyed tables hold hashes as BINARY(32)
+# and wallets as INT UNSIGNED ids into the wallets dimension (address
+# BINARY(20), unique). A listing can have several rows (one per cancellation
+# and sale that could have ended it), so the keyed listings table has a
+# listing_id surrogate key and a plain index on tx_hash. Once a table is
+# swapped, its old name is a view over the keyed table that presents the
+# hashes and wallets as lower case 0x hex again, so the reports, views and
+# reads that only filter or aggregate keep working unchanged; the writers go
+# through load_table/upsert_table/to_stored_frame below, which work the same
+# on a table that hasn't been migrated yet.
+#
+# The migration copies a table into its keyed twin in tx_hash order, a chunk
+# per transaction, while the original stays the live table. Lower case hex
+# sorts like the bytes it encodes, so each source chunk covers exactly the
+# keyed rows between its first and last tx_hash (it always takes every row of
+# its last tx_hash, so none are skipped at the boundary): a chunk is compared
+# with them and only rewritten if they differ, so a rerun resumes where the
+# last one stopped and picks up rows that changed since (closed listings,
+# sales that got their USD/ETH amounts). swap does one more such pass and then
+# moves the original to <table>_hex and puts the view in its place; run it
+# between refreshes so nothing is written after the last pass.
+#
+# usage: python binary_keys.py [migrate|verify|swap] [table ...]
+
+import json
+import os
+import sys
+
+import pandas as pd
+from sqlalchemy import create_engine, inspect, text
+
+from bulk_load import bulk_load, upsert
+
+KEY_CHUNKSIZE = 500
+MIGRATION_CHUNKSIZE = 20000
+WALLETS_TABLE = 'wallets'
+# LOAD DATA goes through a CSV, which has no way to carry the binary columns
+KEYED_LOAD_METHOD = 'multirow'
+HASH_BYTES = 32
+ADDRESS_BYTES = 20
+
+hash_columns = ['tx_hash', 'update_tx_hash', 'cancellation_tx_hash', 'final_sale_tx_hash']
+wallet_columns = ['wallet_buyer', 'wallet_seller']
+
+# the logical columns of each table in order, wallets are stored as <col>_id
+keyed_tables = {
+    'marketplace_sales': {
+        'keyed_table': 'marketplace_sales_keyed',
+        'row_id': None,
+        'columns': [
+            ('tx_hash', 'BINARY(32) NOT NULL'),
+            ('datetime', 'DATETIME NOT NULL'),
+            ('wallet_buyer', 'INT UNSIGNED NOT NULL'),
+            ('wallet_seller', 'INT UNSIGNED NOT NULL'),
+            ('sale_amt_magic', 'FLOAT NOT NULL'),
+            ('seller_amt_received_magic', 'FLOAT NOT NULL'),
+            ('dao_amt_received_magic', 'FLOAT NOT NULL'),
+            ('gas_fee_eth', 'DOUBLE NOT NULL'),
+            ('nft_collection', 'VARCHAR(255)'),
+            ('nft_id', 'INT'),
+            ('nft_name', 'VARCHAR(255)'),
+            ('nft_subcategory', 'VARCHAR(255)'),
+            ('quantity', 'INT NOT NULL'),
+            ('sale_amt_usd', 'DOUBLE'),
+            ('sale_amt_eth', 'DOUBLE'),
+        ],
+        'indexes': {
+            'datetime': ['datetime'],
+            'listing_key': ['wallet_seller_id', 'nft_collection', 'nft_id'],
+        },
+    },
+    'marketplace_listings': {
+        'keyed_table': 'marketplace_listings_keyed',
+        'row_id': 'listing_id',
+        'columns': [
+            ('tx_hash', 'BINARY(32) NOT NULL'),
+            ('listed_at', 'DATETIME'),
+            ('wallet_seller', 'INT UNSIGNED'),
+            ('listing_price_magic', 'DOUBLE'),
+            ('gas_fee_eth', 'DOUBLE'),
+            ('nft_collection', 'VARCHAR(255)'),
+            ('nft_id', 'BIGINT'),
+            ('nft_name', 'VARCHAR(255)'),
+            ('nft_subcategory', 'VARCHAR(255)'),
+            ('quantity', 'BIGINT'),
+            ('update_tx_hash', 'BINARY(32)'),
+            ('cancellation_tx_hash', 'BINARY(32)'),
+            ('final_sale_tx_hash', 'BINARY(32)'),
+            ('updated_at', 'DATETIME'),
+            ('cancelled_at', 'DATETIME'),
+            ('sold_at', 'DATETIME'),
+            ('expires_at', 'DATETIME'),
+        ],
+        'indexes': {
+            'tx_hash': ['tx_hash'],
+            'listing_key': ['wallet_seller_id', 'nft_collection', 'nft_id'],
+            'final_sale_tx_hash': ['final_sale_tx_hash'],
+        },
+        # rows of one listing differ only in how it ended
+        'row_order': ['update_tx_hash', 'cancellation_tx_hash', 'final_sale_tx_hash'],
+    },
+}
+
+def stored_column(col):
+    return '{}_id'.format(col) if col in wallet_columns else col
+
+def hex_table_name(table):
+    return '{}_hex'.format(table)
+
+def hex_to_binary(values, n_bytes=HASH_BYTES):
+    # a value of another length would be truncated or padded by the BINARY(n)
+    # column (or rejected in strict mode), so it's refused here instead
+    binary = [bytes.fromhex(x[2:]) if isinstance(x, str) else None for x in values]
+    wrong_length = [x for x, b in zip(values, binary) if b is not None and len(b) != n_bytes]
+    if wrong_length:
+        raise ValueError('{} values are not {} bytes of hex, e.g. {}'.format(len(wrong_length), n_bytes, wrong_length[0]))
+    return binary
+
+def key_bound(value):
+    # a tx_hash range bound, '0x' (before every hash) is the empty string
+    return bytes.fromhex(value[2:]) if isinstance(value, str) else None
+
+def binary_to_hex(values):
+    return ['0x' + bytes(x).hex() if isinstance(x, (bytes, bytearray, memoryview)) else None for x in values]
+
+def is_swapped(connection, table):
+    inspector = inspect(connection)
+    return table in inspector.get_view_names() and inspector.has_table(keyed_tables[table]['keyed_table'])
+
+def physical_table(connection, table):
+    # where the rows of marketplace_sales/marketplace_listings are written to
+    return keyed_tables[table]['keyed_table'] if is_swapped(connection, table) else table
+
+def source_table(connection, table):
+    # the hex table the migration reads from
+    return hex_table_name(table) if is_swapped(connection, table) else table
+
+def create_keyed_tables(connection, tables):
+    transaction = connection.begin() if not connection.in_transaction() else None
+    try:
+        if not inspect(connection).has_table(WALLETS_TABLE):
+            wallet_id = 'INTEGER PRIMARY KEY' if connection.dialect.name == 'sqlite' else 'INT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY'
+            connection.execute(text('CREATE TABLE {} (wallet_id {}, address BINARY(20) NOT NULL)'.format(WALLETS_TABLE, wallet_id)))
+            connection.execute(text('CREATE UNIQUE INDEX {0}_address ON {0} (address)'.format(WALLETS_TABLE)))
+        for table in tables:
+            keyed = keyed_tables[table]
+            if inspect(connection).has_table(keyed['keyed_table']):
+                continue
+            columns = ['{} {}'.format(stored_column(col), col_type) for col, col_type in keyed['columns']]
+            if keyed['row_id']:
+                row_id = 'INTEGER PRIMARY KEY' if connection.dialect.name == 'sqlite' else 'BIGINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY'
+                columns.insert(0, '{} {}'.format(keyed['row_id'], row_id))
+            else:
+                columns.append('PRIMARY KEY (tx_hash)')
+            connection.execute(text('CREATE TABLE {} ({})'.format(keyed['keyed_table'], ', '.join(columns))))
+            for name, index_columns in keyed['indexes'].items():
+                connection.execute(text('CREATE INDEX {0}_{1} ON {0} ({2})'.format(keyed['keyed_table'], name, ', '.join(index_columns))))
+    except Exception:
+        if transaction is not None:
+            transaction.rollback()
+        raise
+    if transaction is not None:
+        transaction.commit()
+
+def read_wallet_ids(connection, addresses):
+    wallet_ids = {}
+    for chunk_start in range(0, len(addresses), KEY_CHUNKSIZE):
+        chunk = addresses[chunk_start:chunk_start + KEY_CHUNKSIZE]
+        placeholders = ', '.join(':a{}'.format(i) for i in range(len(chunk)))
+        result = connection.execute(
+            text('SELECT address, wallet_id FROM {} WHERE address IN ({})'.format(WALLETS_TABLE, placeholders)),
+            {'a{}'.format(i): address for i, address in enumerate(chunk)}
+        )
+        wallet_ids.update((bytes(address), wallet_id) for address, wallet_id in result)
+    return wallet_ids
+
+def wallet_ids(connection, addresses):
+    # ids for hex addresses, adding the ones the dimension doesn't have yet.
+    # Addresses are stored as bytes so the case they came in doesn't matter,
+    # they come back lower case like arbiscan returns them
+    addresses = hex_to_binary(addresses, ADDRESS_BYTES)
+    unique_addresses = list({address for address in addresses if address is not None})
+    ids = read_wallet_ids(connection, unique_addresses)
+    missing = [address for address in unique_addresses if address not in ids]
+    if missing:
+        # the ignore keeps two writers adding the same wallet from failing
+        insert = 'INSERT OR IGNORE' if connection.dialect.name == 'sqlite' else 'INSERT IGNORE'
+        transaction = connection.begin() if not connection.in_transaction() else None
+        connection.execute(text('{} INTO {} (address) VALUES (:address)'.format(insert, WALLETS_TABLE)), [{'address': address} for address in missing])
+        if transaction is not None:
+            transaction.commit()
+        ids.update(read_wallet_ids(connection, missing))
+    return pd.array([ids.get(address) for address in addresses], dtype='Int64')
+
+def wallet_addresses(connection, ids):
+    ids = [int(x) for x in pd.unique(pd.Series(ids).dropna())]
+    addresses = {}
+    for chunk_start in range(0, len(ids), KEY_CHUNKSIZE):
+        chunk = ids[chunk_start:chunk_start + KEY_CHUNKSIZE]
+        placeholders = ', '.join(':i{}'.format(i) for i in range(len(chunk)))
+        result = connection.execute(
+            text('SELECT wallet_id, address FROM {} WHERE wallet_id IN ({})'.format(WALLETS_TABLE, placeholders)),
+            {'i{}'.format(i): wallet_id for i, wallet_id in enumerate(chunk)}
+        )
+        addresses.update((wallet_id, bytes(address)) for wallet_id, address in result)
+    return addresses
+
+def to_keyed_frame(connection, df):
+    df = df.copy()
+    for col in df.columns:
+        if col in hash_columns:
+            df[col] = hex_to_binary(df[col])
+        elif col in wallet_columns:
+            df[col] = wallet_ids(connection, df[col])
+    return df.rename(columns={col: stored_column(col) for col in wallet_columns})
+
+def from_keyed_frame(connection, df):
+    df = df.copy()
+    for col in df.columns:
+        if col in hash_columns:
+            df[col] = binary_to_hex(df[col])
+    for col in wallet_columns:
+        if stored_column(col) in df.columns:
+            addresses = wallet_addresses(connection, df[stored_column(col)])
+            df[stored_column(col)] = binary_to_hex([addresses.get(x) if pd.notnull(x) else None for x in df[stored_column(col)]])
+    return df.rename(columns={stored_column(col): col for col in wallet_columns})
+
+def to_stored_frame(connection, table, df):
+    # a frame with hex hashes and wallets as the rows physical_table() takes
+    return to_keyed_frame(connection, df) if is_swapped(connection, table) else df
+
+def load_table(df, table, connection):
+    # keyed sales have tx_hash as primary key, so appends are upserts there;
+    # keyed listings can repeat a tx_hash and are appended like the hex table
+    if is_swapped(connection, table):
+        if keyed_tables[table]['row_id']:
+            return bulk_load(to_keyed_frame(connection, df), keyed_tables[table]['keyed_table'], connection, method=KEYED_LOAD_METHOD)
+        return upsert(to_keyed_frame(connection, df), keyed_tables[table]['keyed_table'], connection, key='tx_hash', method=KEYED_LOAD_METHOD)
+    return bulk_load(df, table, connection)
+
+def upsert_table(df, table, connection, key='tx_hash', update=True):
+    if is_swapped(connection, table):
+        return upsert(to_keyed_frame(connection, df), keyed_tables[table]['keyed_table'], connection, key=key, update=update, method=KEYED_LOAD_METHOD)
+    return upsert(df, table, connection, key=key, update=update)
+
+def hex_expression(connection, column):
+    if connection.dialect.name == 'sqlite':
+        # sqlite's HEX(NULL) is '' rather than NULL
+        return "CASE WHEN {0} IS NOT NULL THEN '0x' || LOWER(HEX({0})) END".format(column)
+    return "CONCAT('0x', LOWER(HEX({})))".format(column)
+
+def hex_select(connection, table):
+    # the keyed table with its hashes and wallets as hex, what the view shows
+    keyed = keyed_tables[table]
+    select = []
+    joins = []
+    for col, _ in keyed['columns']:
+        if col in hash_columns:
+            select.append('{} AS {}'.format(hex_expression(connection, 'k.{}'.format(col)), col))
+        elif col in wallet_columns:
+            select.append('{} AS {}'.format(hex_expression(connection, 'w_{}.address'.format(col)), col))
+            joins.append('LEFT JOIN {0} w_{1} ON w_{1}.wallet_id = k.{2}'.format(WALLETS_TABLE, col, stored_column(col)))
+        else:
+            select.append('k.{}'.format(col))
+    return 'SELECT {} FROM {} k {}'.format(', '.join(select), keyed['keyed_table'], ' '.join(joins))
+
+def order_by(table, prefix=''):
+    return ', '.join(prefix + col for col in ['tx_hash'] + keyed_tables[table].get('row_order', []))
+
+def read_source_chunk(connection, table, after, chunksize):
+    # about chunksize rows with tx_hash > after, ending on a whole tx_hash
+    columns = ', '.join(col for col, _ in keyed_tables[table]['columns'])
+    query = text('SELECT {} FROM {} WHERE tx_hash > :after ORDER BY {} LIMIT :chunksize'.format(columns, source_table(connection, table), order_by(table)))
+    chunk = pd.read_sql(query, connection, params={'after': after, 'chunksize': chunksize})
+    if len(chunk) < chunksize or not keyed_tables[table]['row_id']:
+        return chunk
+    # the LIMIT may have cut the last tx_hash's rows short, take all of them
+    last = chunk['tx_hash'].iloc[-1]
+    query = text('SELECT {} FROM {} WHERE tx_hash = :last ORDER BY {}'.format(columns, source_table(connection, table), order_by(table)))
+    last_rows = pd.read_sql(query, connection, params={'last': last})
+    return pd.concat([chunk.loc[chunk['tx_hash'] != last], last_rows], ignore_index=True)
+
+def read_keyed_range(connection, table, after, last=None):
+    # keyed rows with after < tx_hash <= last, as hex
+    condition = 'k.tx_hash > :after' + (' AND k.tx_hash <= :last' if last is not None else '')
+    params = {'after': key_bound(after) or b'', 'last': key_bound(last)}
+    query = text('{} WHERE {} ORDER BY {}'.format(hex_select(connection, table), condition, order_by(table, 'k.')))
+    return pd.read_sql(query, connection, params=params)
+
+def same_rows(a, b):
+    def rows(df):
+        df = df.reset_index(drop=True)
+        return list(df.astype(object).where(pd.notnull(df), None).itertuples(index=False, name=None))
+    return list(a.columns) == list(b.columns) and rows(a) == rows(b)
+
+def sync_table(connection, table, chunksize=MIGRATION_CHUNKSIZE, write=True):
+    # bring the keyed table in line with the hex one a chunk at a time, only
+    # the chunks that differ are rewritten (and none if not write)
+    after = '0x'
+    n_rows = 0
+    n_rewritten = 0
+    while True:
+        chunk = read_source_chunk(connection, table, after, chunksize)
+        if chunk.empty:
+            break
+        last = chunk['tx_hash'].iloc[-1]
+        if not same_rows(chunk, read_keyed_range(connection, table, after, last)):
+            n_rewritten += len(chunk)
+            if write:
+                with connection.begin():
+                    connection.execute(
+                        text('DELETE FROM {} WHERE tx_hash > :after AND tx_hash <= :last'.format(keyed_tables[table]['keyed_table'])),
+                        {'after': key_bound(after), 'last': key_bound(last)}
+                    )
+                    bulk_load(to_keyed_frame(connection, chunk), keyed_tables[table]['keyed_table'], connection, method=KEYED_LOAD_METHOD)
+        n_rows += len(chunk)
+        after = last
+    # rows past the last hex tx_hash only exist on the keyed side
+    n_extra = len(read_keyed_range(connection, table, after))
+    print('{}: {} of {} rows {} ({} keyed rows past the end)'.format(
+        table, n_rewritten, n_rows, 'copied' if write else 'differ', n_extra
+    ))
+    return {'rows': n_rows, 'rewritten': n_rewritten, 'extra': n_extra}
+
+def swap_table(connection, table, chunksize=MIGRATION_CHUNKSIZE):
+    if is_swapped(connection, table):
+        print('{}: already swapped'.format(table))
+        return
+    sync_table(connection, table, chunksize)
+    view_query = hex_select(connection, table)
+    if connection.dialect.name == 'mysql':
+        # RENAME TABLE moves both at once, readers never see the name missing
+        staged_view = '{}_view'.format(table)
+        connection.execute(text('CREATE OR REPLACE VIEW {} AS {}'.format(staged_view, view_query)))
+        connection.execute(text('RENAME TABLE {0} TO {1}, {2} TO {0}'.format(table, hex_table_name(table), staged_view)))
+    else:
+        with connection.begin():
+            connection.execute(text('ALTER TABLE {} RENAME TO {}'.format(table, hex_table_name(table))))
+            connection.execute(text('CREATE VIEW {} AS {}'.format(table, view_query)))
+    print('{}: now a view over {}, the hex table is kept as {}'.format(table, keyed_tables[table]['keyed_table'], hex_table_name(table)))
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'migrate'
+    tables = sys.argv[2:] or list(keyed_tables)
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "constants", "mysql_credential.json")) as f:
+        mysql_credentials = json.loads(f.read())
+    engine = create_engine(
+        "mysql+pymysql://{user}:{pw}@{host}/{db}".format(
+        user=mysql_credentials['username'],
+        pw=mysql_credentials['pw'],
+        host=mysql_credentials['host'],
+        db="treasure"
+        )
+    )
+    with engine.connect() as connection:
+        create_keyed_tables(connection, tables)
+        for table in tables:
+            if command == 'migrate':
+                sync_table(connection, table)
+            elif command == 'verify':
+                sync_table(connection, table, write=False)
+            elif command == 'swap':
+                swap_table(connection, table)
+    engine.dispose()
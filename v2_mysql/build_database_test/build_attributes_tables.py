@@ -8,6 +8,8 @@ import pandas as pd
 import os
 from sqlalchemy import create_engine
 
+from bulk_load import bulk_load
+
 os.chdir('v2_mysql/build_database_test')
 
 # read in attributes
@@ -39,27 +41,9 @@ engine = create_engine(
 )
 connection = engine.connect()
 
-smol_brains_attributes.to_sql(
-    'attributes_smol_brains', 
-    con = connection, 
-    if_exists = 'append', 
-    chunksize = 1000,
-    index=False
-)
-smol_bodies_attributes.to_sql(
-    'attributes_smol_bodies', 
-    con = connection, 
-    if_exists = 'append', 
-    chunksize = 1000,
-    index=False
-)
-smol_cars_attributes.to_sql(
-    'attributes_smol_cars', 
-    con = connection, 
-    if_exists = 'append', 
-    chunksize = 1000,
-    index=False
-)
+bulk_load(smol_brains_attributes, 'attributes_smol_brains', connection)
+bulk_load(smol_bodies_attributes, 'attributes_smol_bodies', connection)
+bulk_load(smol_cars_attributes, 'attributes_smol_cars', connection)
 
 connection.close()
 engine.dispose()
\ No newline at end of file
@@ -1,22 +1,43 @@
 # This script wrangles our already existing ArbiScan data into
 # a listings table. We can use this table to track floor prices.
 
-import datetime as dt
-import io
 import json
 import pytz
 import re
 import os
 
 import boto3
-import numpy as np
 import pandas as pd
 from sqlalchemy import create_engine
 
+from binary_keys import load_table
+from compact_frames import StringDictionary, decode_frame, encode_frame
+from listing_lifecycle import sales_table_merge_keys, sweep_listing_lifecycles
+from marketplace_decoder import decode_marketplace_calldata, timestamps_to_datetimes
+from raw_archive import read_raw_txs
+from s3_cache import read_cached_csvs
+
 os.chdir('v2_mysql/build_database_test')
 
 tz = pytz.timezone('UTC')
 
+# set to e.g. s3://treasure-marketplace-db/archive to read the parquet archive instead of the raw CSVs
+RAW_TXS_ARCHIVE = os.environ.get('RAW_TXS_ARCHIVE')
+
+raw_marketplace_columns = [
+    'hash',
+    'blockNumber',
+    'timeStamp',
+    'from',
+    'to',
+    'from_wallet',
+    'to_wallet',
+    'input',
+    'gasPrice',
+    'gasUsed',
+    'txreceipt_status'
+]
+
 # define functions
 def get_contract_addresses():
     contract_address = os.path.join("constants", "contract_addresses.json")
@@ -41,18 +62,40 @@ def get_contract_addresses():
 
     return contract_addresses_reverse_lower, method_ids, treasure_ids_numeric
 
-def read_raw_marketplace_txs():
+def read_raw_marketplace_txs(archive_root=None):
+    if archive_root is not None:
+        # only read the columns the listings build uses out of the parquet archive
+        marketplace_txs_raw = read_raw_txs(archive_root, 'marketplace', columns=raw_marketplace_columns)
+        return marketplace_txs_raw.loc[marketplace_txs_raw.txreceipt_status==1].copy() # only keep successful txs
+
     s3_resource = boto3.resource('s3')
     bucket = s3_resource.Bucket("treasure-marketplace-db")
-    mkt_objs = [obj for obj in bucket.objects.all() if (obj.key[:16]=='marketplace-txs/') & (obj.key[-4:]=='.csv')]
-    mkt_objs_lst = []
-    for obj in mkt_objs:
-        mkt_objs_lst.append(pd.read_csv(io.BytesIO(obj.get()["Body"].read())))
+    # archived objects never change, so only new ones are downloaded
+    mkt_objs_lst = read_cached_csvs(bucket, 'marketplace-txs/')
 
     marketplace_txs_raw = pd.concat(mkt_objs_lst)
     marketplace_txs_raw = marketplace_txs_raw.loc[marketplace_txs_raw.txreceipt_status==1].copy() # only keep successful txs
     return marketplace_txs_raw
 
+def read_marketplace_txs(dictionary, archive_root=None):
+    # parsed and integer-coded marketplace txs. The raw CSVs are parsed and
+    # coded one object at a time and dropped as we go, rather than
+    # concatenating the whole history as strings first
+    if archive_root is not None:
+        return encode_frame(process_raw_marketplace_txs(read_raw_marketplace_txs(archive_root)), dictionary)
+
+    s3_resource = boto3.resource('s3')
+    bucket = s3_resource.Bucket("treasure-marketplace-db")
+    mkt_objs_lst = read_cached_csvs(bucket, 'marketplace-txs/')
+    mkt_objs_lst.reverse()
+    marketplace_txs = []
+    while mkt_objs_lst:
+        marketplace_txs_raw = mkt_objs_lst.pop()
+        marketplace_txs_raw = marketplace_txs_raw.loc[marketplace_txs_raw.txreceipt_status==1].copy() # only keep successful txs
+        marketplace_txs.append(encode_frame(process_raw_marketplace_txs(marketplace_txs_raw), dictionary))
+    # categories differ between objects, so concat gives back objects to re-categorize
+    return encode_frame(pd.concat(marketplace_txs), dictionary)
+
 def read_marketplace_sales():
     sql_credential = os.path.join("constants", "mysql_credential.json")
     with open(sql_credential) as f:
@@ -78,27 +121,19 @@ def read_marketplace_sales():
     return marketplace_sales
 
 def process_raw_marketplace_txs(marketplace_txs_raw):
-    marketplace_txs_raw["tx_type"] = [x[:10] for x in marketplace_txs_raw["input"]]
-    marketplace_txs_raw["tx_type"] = marketplace_txs_raw["tx_type"].map(method_ids)
-    marketplace_txs_raw = marketplace_txs_raw.loc[~pd.isnull(marketplace_txs_raw["tx_type"])] # null transactions are all whitelisting of certain accounts before marketplace launch
-    marketplace_txs_raw['timestamp'] = [dt.datetime.fromtimestamp(int(x), tz) for x in marketplace_txs_raw['timeStamp']]
+    decoded = decode_marketplace_calldata(marketplace_txs_raw['input'], method_ids, contract_addresses_reverse_lower)
+    is_marketplace_tx = ~pd.isnull(decoded['tx_type']) # null transactions are all whitelisting of certain accounts before marketplace launch
+    marketplace_txs_raw = marketplace_txs_raw.loc[is_marketplace_tx].copy()
+    for col in ['tx_type', 'nft_collection', 'nft_id', 'quantity', 'listing_price_magic']:
+        marketplace_txs_raw[col] = decoded[col][is_marketplace_tx]
+    marketplace_txs_raw['timestamp'] = timestamps_to_datetimes(marketplace_txs_raw['timeStamp'])
+    marketplace_txs_raw['expiration_datetime'] = timestamps_to_datetimes(decoded['expiration_ms'][is_marketplace_tx], unit='ms')
     marketplace_txs_raw['gas_fee_eth'] = (marketplace_txs_raw['gasPrice'].astype('int64') * 1e-9 * marketplace_txs_raw['gasUsed'].astype(int) * 1e-9) / 2
-    marketplace_txs_raw['nft_collection'] = [contract_addresses_reverse_lower[x[33:74]] for x in marketplace_txs_raw['input']] # works for both types of txs
-    marketplace_txs_raw['nft_id'] = [int(x[133:138], 16) for x in marketplace_txs_raw['input']] # also works for all types of txs
 
     marketplace_txs_raw.loc[marketplace_txs_raw['nft_collection'].isin(['treasures', 'legions', 'legions_genesis']), 'nft_name'] = \
         marketplace_txs_raw.loc[marketplace_txs_raw['nft_collection'].isin(['treasures', 'legions', 'legions_genesis']), 'nft_id'].map(treasure_ids_numeric)
     marketplace_txs_raw.loc[~pd.isnull(marketplace_txs_raw['nft_name']),'nft_subcategory'] = \
         [re.sub(r'[0-9]+', '', x).rstrip() for x in marketplace_txs_raw.loc[~pd.isnull(marketplace_txs_raw['nft_name']),'nft_name']]
-    marketplace_txs_raw['quantity'] = np.nan
-    marketplace_txs_raw['listing_price_magic'] = np.nan
-    marketplace_txs_raw['expiration_datetime'] = np.nan
-    marketplace_txs_raw.loc[marketplace_txs_raw['tx_type'].isin(['createListing','updateListing']), 'quantity'] = [int(x[198:202], 16) for x in marketplace_txs_raw.loc[marketplace_txs_raw['tx_type'].isin(['createListing','updateListing']), 'input']]
-    marketplace_txs_raw.loc[marketplace_txs_raw['tx_type']=='buyItem', 'quantity'] = [int(x[262:266], 16) for x in marketplace_txs_raw.loc[marketplace_txs_raw['tx_type']=='buyItem', 'input']]
-    marketplace_txs_raw.loc[marketplace_txs_raw['tx_type'].isin(['createListing','updateListing']), 'listing_price_magic'] = [int(x[240:266], 16) for x in marketplace_txs_raw.loc[marketplace_txs_raw['tx_type'].isin(['createListing','updateListing']), 'input']]
-    marketplace_txs_raw.loc[marketplace_txs_raw['tx_type'].isin(['createListing','updateListing']), 'expiration_datetime'] = [int(x[310:330], 16) for x in marketplace_txs_raw.loc[marketplace_txs_raw['tx_type'].isin(['createListing','updateListing']), 'input']]
-    marketplace_txs_raw.loc[marketplace_txs_raw['tx_type'].isin(['createListing','updateListing']), 'listing_price_magic'] = marketplace_txs_raw.loc[marketplace_txs_raw['tx_type'].isin(['createListing','updateListing']), 'listing_price_magic'].astype("float64") * 1e-18
-    marketplace_txs_raw.loc[marketplace_txs_raw['tx_type'].isin(['createListing','updateListing']), 'expiration_datetime'] = [dt.datetime.fromtimestamp(int(x)/1000, tz) for x in marketplace_txs_raw.loc[marketplace_txs_raw['tx_type'].isin(['createListing','updateListing']), 'expiration_datetime']]
 
     # correct data error: coalesce from + from_wallet, to + to_wallet
     marketplace_txs_raw.loc[pd.isnull(marketplace_txs_raw['from_wallet']), 'from_wallet'] = marketplace_txs_raw.loc[pd.isnull(marketplace_txs_raw['from_wallet']), 'from']
@@ -130,63 +165,16 @@ def process_raw_marketplace_txs(marketplace_txs_raw):
 ## Gather required data
 # read in important contract addresses
 contract_addresses_reverse_lower, method_ids, treasure_ids_numeric = get_contract_addresses()
-# read in raw marketplace txs from s3 for listings and cancellations
-marketplace_txs_raw = read_raw_marketplace_txs()
+# hashes and wallets are integer-coded from here on, one dictionary for both
+# frames so they merge on the codes, and decoded again for writing
+dictionary = StringDictionary()
+# read in raw marketplace txs from s3 for listings and cancellations, and parse them
+marketplace_txs_raw = read_marketplace_txs(dictionary, RAW_TXS_ARCHIVE)
 # read in existing marketplace_sales table for sales
-sales = read_marketplace_sales()
-sales = sales.merge(marketplace_txs_raw.loc[:,['hash','blockNumber']], left_on='tx_hash',right_on='hash')
-# parse data
-marketplace_txs_raw = process_raw_marketplace_txs(marketplace_txs_raw)
+sales = encode_frame(read_marketplace_sales(), dictionary)
+sales = sales.merge(marketplace_txs_raw.loc[:,['tx_hash','blockNumber']], on='tx_hash')
 
 ## Create listings table
-listings_og = marketplace_txs_raw.loc[marketplace_txs_raw['tx_type'].isin(['createListing','updateListing'])].copy()
-listings=listings_og.copy()
-
-# Join updates
-listings_merge_keys = [
-    'from_wallet',
-    'nft_collection',
-    'nft_id'
-]
-updates = listings.loc[listings['tx_type']=='updateListing',['tx_hash','datetime','blockNumber'] + listings_merge_keys].copy()
-updates.rename(columns={
-    'tx_hash':'update_tx_hash',
-    'datetime':'updated_at',
-    'blockNumber':'update_blockNumber'
-}, inplace=True)
-listings_updates = listings.merge(updates, how='left', on=listings_merge_keys)
-listings_updates = listings_updates.loc[listings_updates['blockNumber']<listings_updates['update_blockNumber']]
-most_recent_updates = listings_updates.groupby('tx_hash',as_index=False).agg({'update_blockNumber':'min'})
-listings_updates = listings_updates.merge(most_recent_updates, how='inner',on=['tx_hash','update_blockNumber']) 
-dupe_cols_to_drop = list(listings_updates.columns)
-dupe_cols_to_drop.remove('update_tx_hash')
-listings_updates.drop_duplicates(dupe_cols_to_drop,inplace=True)
-listings = listings.merge(listings_updates, how='left', on=list(listings_og.columns))
-
-# Cancellations
-cancellations = marketplace_txs_raw.loc[marketplace_txs_raw['tx_type'].isin(['cancelListing'])].copy()
-cancellations = cancellations.loc[:,['tx_hash','datetime','blockNumber'] + listings_merge_keys].copy()
-cancellations.rename(columns={
-    'tx_hash':'cancellation_tx_hash',
-    'datetime':'cancelled_at',
-    'blockNumber':'cancellation_blockNumber'
-}, inplace=True)
-listings_cancellations = listings_og.merge(cancellations, how='left', on=listings_merge_keys)
-listings_cancellations = listings_cancellations.loc[listings_cancellations['blockNumber']<=listings_cancellations['cancellation_blockNumber']] # less than or equal to to account for times when the tx is updated then immediately cancelled
-most_recent_cancellation = listings_cancellations.groupby('tx_hash',as_index=False).agg({'cancellation_blockNumber':'min'})
-listings_cancellations = listings_cancellations.merge(most_recent_cancellation, how='inner',on=['tx_hash','cancellation_blockNumber']) 
-cancellation_merge_cols = list(listings.columns)
-listings = listings.merge(listings_cancellations, how='left', on=list(listings_og.columns))
-# handle cases where there is both an update and a cancellation
-listings.loc[listings.cancellation_blockNumber >= listings.update_blockNumber, ['cancellation_tx_hash', 'cancelled_at']] = np.nan
-listings.loc[listings.cancellation_blockNumber < listings.update_blockNumber, ['update_tx_hash', 'updated_at']] = np.nan
-
-# Sales
-sales_table_merge_keys = [
-    'wallet_seller',
-    'nft_collection',
-    'nft_id'
-]
 sales = sales.loc[:,['tx_hash','datetime','blockNumber','quantity'] + sales_table_merge_keys].copy()
 sales.rename(columns={
     'tx_hash':'final_sale_tx_hash',
@@ -194,48 +182,8 @@ sales.rename(columns={
     'blockNumber':'sale_blockNumber',
     'quantity':'quantity_sold'
 }, inplace=True)
-listings_sales = listings_og.merge(sales, how='left', left_on=listings_merge_keys, right_on=sales_table_merge_keys)
-listings_sales['sold_at'] = listings_sales['sold_at'].apply(lambda x: x.tz_localize(tz))
-listings_sales = listings_sales.loc[listings_sales['blockNumber']<=listings_sales['sale_blockNumber']]
-listings_sales.sort_values(['tx_hash','sold_at'],inplace=True)
-listings_sales['cum_quantity_sold'] = listings_sales.groupby('tx_hash').quantity_sold.cumsum()
-listings_sales = listings_sales.loc[listings_sales['quantity']==listings_sales['cum_quantity_sold']]
-listings = listings.merge(listings_sales, how='left', on=list(listings_og.columns))
-# handle cases where there is any two of an update, a cancellation, or a listing
-listings.loc[listings.cancellation_blockNumber > listings.sale_blockNumber, ['cancellation_tx_hash', 'cancelled_at']] = np.nan
-listings.loc[listings.cancellation_blockNumber < listings.sale_blockNumber, ['final_sale_tx_hash','sold_at','quantity_sold']] = np.nan
-listings.loc[listings.update_blockNumber > listings.sale_blockNumber, ['update_tx_hash', 'updated_at']] = np.nan
-listings.loc[listings.update_blockNumber <= listings.sale_blockNumber, ['final_sale_tx_hash','sold_at','quantity_sold']] = np.nan
-
-listings.drop('wallet_seller',axis=1,inplace=True)
-listings.rename(columns={
-    'datetime':'listed_at',
-    'expiration_datetime':'expires_at',
-    'from_wallet':'wallet_seller'
-}, inplace=True)
-listings['listing_price_magic'] = listings['listing_price_magic'].apply(lambda x: round(x,2))
-
-cols_to_load = [
-    'tx_hash',
-    'listed_at',
-    'wallet_seller',
-    'listing_price_magic',
-    'gas_fee_eth',
-    'nft_collection',
-    'nft_id',
-    'nft_name',
-    'nft_subcategory',
-    'quantity',
-    'update_tx_hash',
-    'cancellation_tx_hash',
-    'final_sale_tx_hash',
-    'updated_at',
-    'cancelled_at',
-    'sold_at',
-    'expires_at'
-]
-
-listings = listings.loc[:,cols_to_load]
+sales['sold_at'] = sales['sold_at'].dt.tz_localize(tz)
+listings = sweep_listing_lifecycles(marketplace_txs_raw.rename(columns={'tx_hash':'hash', 'from_wallet':'from'}), sales)
 
 # write to sql
 sql_credential = os.path.join("constants", "mysql_credential.json")
@@ -251,13 +199,7 @@ engine = create_engine(
 )
 connection = engine.connect()
 
-listings.to_sql(
-    'marketplace_listings', 
-    con = connection, 
-    if_exists = 'append', 
-    chunksize = 1000,
-    index=False
-)
+load_table(decode_frame(listings, dictionary), 'marketplace_listings', connection)
 
 connection.close()
 engine.dispose()
@@ -0,0 +1,193 @@
+# In this file we load DataFrames into MySQL in bulk. DataFrame.to_sql with
+# chunksize=1000 goes through SQLAlchemy's row-wise parameter handling, which
+# is slow for full history loads. Here each batch is either sent as one large
+# multi-row INSERT (pymysql's executemany rewrites the statement) or streamed
+# through LOAD DATA LOCAL INFILE, inside one transaction per batch. Anything
+# that isn't MySQL (e.g. a SQLite test database) falls back to to_sql.
+#
+# upsert() is the idempotent variant: each batch goes into a temporary staging
+# table first and is then merged into the target keyed on tx_hash, so a
+# re-run or a retried batch never duplicates rows and dedup uses the primary
+# key index rather than pulling every existing hash into Python.
+
+import csv
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import inspect
+from sqlalchemy.engine import Engine
+
+BULK_LOAD_METHOD = os.environ.get('BULK_LOAD_METHOD', 'multirow') # multirow, load_data or to_sql
+BULK_LOAD_BATCH_SIZE = int(os.environ.get('BULK_LOAD_BATCH_SIZE', 50000))
+
+def to_naive_utc(df):
+    # MySQL DATETIME has no timezone, everything we store is UTC
+    df = df.copy()
+    for col in df.columns:
+        if pd.api.types.is_datetime64tz_dtype(df[col]):
+            df[col] = df[col].dt.tz_convert('UTC').dt.tz_localize(None)
+    return df
+
+def to_records(df):
+    df = df.astype(object).where(pd.notnull(df), None)
+    records = []
+    for row in df.itertuples(index=False, name=None):
+        records.append(tuple(x.to_pydatetime() if isinstance(x, pd.Timestamp) else x.item() if isinstance(x, np.generic) else x for x in row))
+    return records
+
+def quote_columns(columns):
+    return ', '.join('`{}`'.format(col) for col in columns)
+
+def insert_multirow(connection, table, batch):
+    statement = 'INSERT INTO `{}` ({}) VALUES ({})'.format(table, quote_columns(batch.columns), ', '.join(['%s'] * len(batch.columns)))
+    connection.exec_driver_sql(statement, to_records(batch))
+
+def insert_load_data(connection, table, batch):
+    # needs local_infile enabled on both the server and the client connection
+    batch = batch.copy()
+    for col in batch.columns:
+        if batch[col].dtype == object:
+            # backslash is the escape character, NULLs are written as \N
+            batch[col] = batch[col].map(lambda x: x.replace('\\', '\\\\') if isinstance(x, str) else x)
+    with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False, newline='') as f:
+        batch.to_csv(f, index=False, header=False, na_rep='\\N', date_format='%Y-%m-%d %H:%M:%S.%f', quoting=csv.QUOTE_MINIMAL)
+        path = f.name
+    try:
+        statement = """
+            LOAD DATA LOCAL INFILE '{}' INTO TABLE `{}`
+            FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '"' ESCAPED BY '\\\\'
+            LINES TERMINATED BY '\\n'
+            ({})
+        """.format(path.replace('\\', '/'), table, quote_columns(batch.columns))
+        connection.exec_driver_sql(statement)
+    finally:
+        os.remove(path)
+
+def bulk_load(df, table, connection, batch_size=BULK_LOAD_BATCH_SIZE, method=BULK_LOAD_METHOD):
+    if isinstance(connection, Engine):
+        with connection.connect() as engine_connection:
+            return bulk_load(df, table, engine_connection, batch_size, method)
+
+    started_at = time.perf_counter()
+    if connection.dialect.name != 'mysql':
+        method = 'to_sql'
+
+    n_batches = 0
+    if method == 'to_sql' or not inspect(connection).has_table(table):
+        # to_sql also creates the table the first time round
+        df.to_sql(
+            table,
+            con = connection,
+            if_exists = 'append',
+            chunksize = 1000,
+            index=False
+        )
+        n_batches = -(-len(df) // 1000)
+        method = 'to_sql'
+    else:
+        insert_batch = insert_load_data if method == 'load_data' else insert_multirow
+        df = to_naive_utc(df)
+        for batch_start in range(0, len(df), batch_size):
+            batch = df.iloc[batch_start:batch_start + batch_size]
+            if connection.in_transaction():
+                insert_batch(connection, table, batch)
+            else:
+                with connection.begin():
+                    insert_batch(connection, table, batch)
+            n_batches += 1
+
+    seconds = time.perf_counter() - started_at
+    metrics = {
+        'table': table,
+        'method': method,
+        'rows': len(df),
+        'batches': n_batches,
+        'seconds': round(seconds, 3),
+        'rows_per_second': round(len(df) / seconds, 1) if seconds > 0 else None
+    }
+    print('loaded {rows} rows into {table} via {method} in {seconds}s ({rows_per_second} rows/s)'.format(**metrics))
+    return metrics
+
+def stage_table_name(table):
+    return '{}_staging'.format(table)
+
+def merge_staged_mysql(connection, table, staging_table, columns, key, update=True):
+    # with update=False existing rows are left alone (the no-op assignment
+    # keeps the statement valid without INSERT IGNORE swallowing other errors)
+    updates = ', '.join('`{0}` = VALUES(`{0}`)'.format(col) for col in columns if col not in key) if update else ''
+    statement = 'INSERT INTO `{}` ({}) SELECT {} FROM `{}` ON DUPLICATE KEY UPDATE {}'.format(
+        table, quote_columns(columns), quote_columns(columns), staging_table, updates or '`{0}` = `{0}`'.format(key[0])
+    )
+    return connection.exec_driver_sql(statement).rowcount
+
+def merge_staged_anti_join(connection, table, staging_table, columns, key):
+    # without a key index to lean on (e.g. SQLite tables made by to_sql) we
+    # only insert rows whose key isn't there yet
+    key_match = ' AND '.join('t.`{0}` = s.`{0}`'.format(col) for col in key)
+    statement = 'INSERT INTO `{}` ({}) SELECT {} FROM `{}` s WHERE NOT EXISTS (SELECT 1 FROM `{}` t WHERE {})'.format(
+        table, quote_columns(columns), ', '.join('s.`{}`'.format(col) for col in columns), staging_table, table, key_match
+    )
+    return connection.exec_driver_sql(statement).rowcount
+
+def upsert(df, table, connection, key=('tx_hash',), update=True, batch_size=BULK_LOAD_BATCH_SIZE, method=BULK_LOAD_METHOD):
+    if isinstance(connection, Engine):
+        with connection.connect() as engine_connection:
+            return upsert(df, table, engine_connection, key, update, batch_size, method)
+
+    key = [key] if isinstance(key, str) else list(key)
+    # a key given twice keeps its last row, as the merge would leave it
+    n_rows = len(df)
+    df = df.drop_duplicates(key, keep='last')
+    n_duplicates = n_rows - len(df)
+    if n_duplicates:
+        print('dropped {} rows with a duplicate {} before merging into {}'.format(n_duplicates, ', '.join(key), table))
+    if not inspect(connection).has_table(table):
+        return dict(bulk_load(df, table, connection, batch_size, method), duplicate_rows=n_duplicates)
+
+    started_at = time.perf_counter()
+    is_mysql = connection.dialect.name == 'mysql'
+    staging_table = stage_table_name(table)
+    columns = list(df.columns)
+    n_batches = 0
+    n_affected = 0
+    df = to_naive_utc(df)
+    for batch_start in range(0, len(df), batch_size):
+        batch = df.iloc[batch_start:batch_start + batch_size]
+        transaction = connection.begin() if not connection.in_transaction() else None
+        try:
+            if is_mysql:
+                connection.exec_driver_sql('CREATE TEMPORARY TABLE IF NOT EXISTS `{}` LIKE `{}`'.format(staging_table, table))
+                # not TRUNCATE, which commits implicitly and would end the caller's transaction
+                connection.exec_driver_sql('DELETE FROM `{}`'.format(staging_table))
+                insert_batch = insert_load_data if method == 'load_data' else insert_multirow
+                insert_batch(connection, staging_table, batch)
+                n_affected += merge_staged_mysql(connection, table, staging_table, columns, key, update)
+            else:
+                batch.to_sql(staging_table, con=connection, if_exists='replace', chunksize=1000, index=False)
+                # note this path never updates rows that are already there
+                n_affected += merge_staged_anti_join(connection, table, staging_table, columns, key)
+            connection.exec_driver_sql('DROP {}TABLE `{}`'.format('TEMPORARY ' if is_mysql else '', staging_table))
+        except Exception:
+            if transaction is not None:
+                transaction.rollback()
+            raise
+        if transaction is not None:
+            transaction.commit()
+        n_batches += 1
+
+    seconds = time.perf_counter() - started_at
+    metrics = {
+        'table': table,
+        'method': 'upsert ({})'.format(method if is_mysql else 'anti-join'),
+        'rows': len(df),
+        'affected_rows': n_affected,
+        'duplicate_rows': n_duplicates,
+        'batches': n_batches,
+        'seconds': round(seconds, 3),
+        'rows_per_second': round(len(df) / seconds, 1) if seconds > 0 else None
+    }
+    print('merged {rows} rows into {table} via {method} in {seconds}s ({rows_per_second} rows/s, {affected_rows} rows affected)'.format(**metrics))
+    return metrics
@@ -0,0 +1,192 @@
+# In this file we check that sweep_listing_lifecycles ends every listing the
+# same way as the merge cascade it replaced (merge_listing_lifecycles), via
+# check_listing_lifecycles. It runs on small hand-written histories with
+# known endings and on random batches. The hand-written ones cover relists,
+# a cancellation, update or sale in the same block as the listing, and
+# listings filled by several partial buys. It also refreshes a SQLite
+# marketplace_listings batch by batch with refresh_marketplace_listings, and
+# checks that running a batch again (as after a crash before the watermark
+# write) leaves the same table as running each batch once.
+#
+# usage: python checks/check_listing_lifecycles.py [n random batches]
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from binary_keys import upsert_table
+from incremental_listings import refresh_marketplace_listings
+from listing_lifecycle import check_listing_lifecycles, prepare_listing_sales, sweep_listing_lifecycles
+
+START_TIMESTAMP = 1640000000
+
+# (hash, tx_type, block, from, to, nft_id, quantity), the seller of a buy is its `to`
+fixtures = {
+    'relist after a cancellation, then sold': ([
+        ('l1', 'createListing', 10, 'alice', None, 1, 1),
+        ('c1', 'cancelListing', 20, 'alice', None, 1, None),
+        ('l2', 'createListing', 30, 'alice', None, 1, 1),
+        ('b1', 'buyItem', 40, 'bob', 'alice', 1, 1),
+    ], {'l1': (None, 'c1', None), 'l2': (None, None, 'b1')}),
+    'relist of a sold token': ([
+        ('l1', 'createListing', 10, 'alice', None, 2, 1),
+        ('b1', 'buyItem', 15, 'bob', 'alice', 2, 1),
+        ('l2', 'createListing', 25, 'alice', None, 2, 1),
+    ], {'l1': (None, None, 'b1'), 'l2': (None, None, None)}),
+    'cancelled in the listing block': ([
+        ('l1', 'createListing', 50, 'carol', None, 3, 1),
+        ('c1', 'cancelListing', 50, 'carol', None, 3, None),
+    ], {'l1': (None, 'c1', None)}),
+    'sold in the listing block': ([
+        ('l1', 'createListing', 60, 'carol', None, 4, 1),
+        ('b1', 'buyItem', 60, 'dave', 'carol', 4, 1),
+    ], {'l1': (None, None, 'b1')}),
+    'updated in the listing block, then updated again': ([
+        ('l1', 'createListing', 70, 'carol', None, 5, 1),
+        ('u1', 'updateListing', 70, 'carol', None, 5, 1),
+        ('u2', 'updateListing', 75, 'carol', None, 5, 1),
+    ], {'l1': ('u2', None, None), 'u1': ('u2', None, None), 'u2': (None, None, None)}),
+    'updated and cancelled in one block': ([
+        ('l1', 'createListing', 80, 'erin', None, 6, 1),
+        ('u1', 'updateListing', 90, 'erin', None, 6, 1),
+        ('c1', 'cancelListing', 90, 'erin', None, 6, None),
+    ], {'l1': ('u1', None, None), 'u1': (None, 'c1', None)}),
+    'updated and sold in one block': ([
+        ('l1', 'createListing', 100, 'erin', None, 7, 1),
+        ('u1', 'updateListing', 110, 'erin', None, 7, 1),
+        ('b1', 'buyItem', 110, 'frank', 'erin', 7, 1),
+    ], {'l1': ('u1', None, None), 'u1': (None, None, 'b1')}),
+    'filled by two partial buys': ([
+        ('l1', 'createListing', 120, 'gina', None, 8, 3),
+        ('b1', 'buyItem', 130, 'hank', 'gina', 8, 1),
+        ('b2', 'buyItem', 140, 'ivan', 'gina', 8, 2),
+    ], {'l1': (None, None, 'b2')}),
+    'partly filled, then cancelled': ([
+        ('l1', 'createListing', 150, 'gina', None, 9, 3),
+        ('b1', 'buyItem', 160, 'hank', 'gina', 9, 1),
+        ('c1', 'cancelListing', 170, 'gina', None, 9, None),
+    ], {'l1': (None, 'c1', None)}),
+    'partial buys in the listing block and the next': ([
+        ('l1', 'createListing', 180, 'gina', None, 10, 2),
+        ('b1', 'buyItem', 180, 'hank', 'gina', 10, 1),
+        ('b2', 'buyItem', 181, 'ivan', 'gina', 10, 1),
+    ], {'l1': (None, None, 'b2')}),
+}
+
+def marketplace_frame(rows, collection='treasures'):
+    # processed marketplace txs like process_marketplace_txs returns
+    txs = pd.DataFrame(rows, columns=['hash', 'tx_type', 'blockNumber', 'from', 'to', 'nft_id', 'quantity'])
+    txs['datetime'] = pd.to_datetime(START_TIMESTAMP + txs['blockNumber'] * 2, unit='s', utc=True)
+    txs['listing_price_magic'] = np.where(txs['tx_type'].isin(['createListing', 'updateListing']), 10.0, np.nan)
+    txs['expiration_datetime'] = txs['datetime'] + pd.Timedelta(days=30)
+    txs['gas_fee_eth'] = 0.0001
+    txs['nft_collection'] = collection
+    txs['nft_name'] = None
+    txs['nft_subcategory'] = None
+    txs['quantity'] = txs['quantity'].astype(float)
+    return txs
+
+def sales_frame(txs):
+    buys = txs.loc[txs['tx_type'] == 'buyItem']
+    return pd.DataFrame({
+        'tx_hash': buys['hash'],
+        'datetime': buys['datetime'],
+        'wallet_buyer': buys['from'],
+        'wallet_seller': buys['to'],
+        'nft_collection': buys['nft_collection'],
+        'nft_id': buys['nft_id'],
+        'quantity': buys['quantity'],
+    })
+
+def endings(listings):
+    def value(x):
+        return None if pd.isnull(x) else x
+    return {
+        row.tx_hash: (value(row.update_tx_hash), value(row.cancellation_tx_hash), value(row.final_sale_tx_hash))
+        for row in listings.itertuples()
+    }
+
+def random_batch(rng, n_txs, n_wallets=4, n_tokens=3):
+    # a few wallets and tokens over few blocks, so keys relist and blocks hold several events
+    blocks = np.sort(rng.integers(0, max(n_txs // 3, 1), n_txs))
+    wallets = np.array(['w{}'.format(i) for i in range(n_wallets)])
+    tx_types = rng.choice(['createListing', 'updateListing', 'cancelListing', 'buyItem'], n_txs, p=[.35, .25, .15, .25])
+    rows = list(zip(
+        ['h{}'.format(i) for i in range(n_txs)],
+        tx_types,
+        blocks,
+        wallets[rng.integers(0, n_wallets, n_txs)],
+        wallets[rng.integers(0, n_wallets, n_txs)],
+        rng.integers(0, n_tokens, n_txs),
+        np.where(tx_types == 'cancelListing', np.nan, rng.integers(1, 4, n_txs)),
+    ))
+    txs = marketplace_frame(rows)
+    # same-second sales, and txs not in block order, like a concatenated pull
+    txs['datetime'] = pd.to_datetime(START_TIMESTAMP + txs['blockNumber'] * 2 // 3, unit='s', utc=True)
+    return txs.sample(frac=1, random_state=int(rng.integers(1e9))).reset_index(drop=True)
+
+def refreshed_listings(batches, sales):
+    # marketplace_listings after refreshing an empty database with each batch in turn
+    connection = create_engine('sqlite://').connect()
+    listings = sweep_listing_lifecycles(batches[0], prepare_listing_sales(sales, batches[0]))
+    listings.head(0).to_sql('marketplace_listings', connection, index=False)
+    sales.head(0).to_sql('marketplace_sales', connection, index=False)
+    for txs in batches:
+        batch_sales = sales.loc[sales['tx_hash'].isin(txs['hash'])]
+        upsert_table(batch_sales, 'marketplace_sales', connection, key='tx_hash')
+        refresh_marketplace_listings(connection, txs, batch_sales)
+    listings = pd.read_sql('SELECT * FROM marketplace_listings', connection)
+    connection.close()
+    return listings.sort_values(list(listings.columns)).reset_index(drop=True)
+
+def check_refresh_rerun(txs):
+    sales = sales_frame(txs)
+    # split on a block, a refresh never ends inside one
+    cut = txs['blockNumber'].median()
+    first = txs.loc[txs['blockNumber'] <= cut]
+    second = txs.loc[txs['blockNumber'] > cut]
+    expected = refreshed_listings([first, second], sales)
+    assert expected['tx_hash'].nunique() == txs['tx_type'].isin(['createListing', 'updateListing']).sum()
+    for name, batches in [
+        ('first batch run twice', [first, first, second]),
+        ('first batch rerun with the second', [first, pd.concat([first, second])]),
+        ('both batches run twice', [first, second, pd.concat([first, second])]),
+    ]:
+        got = refreshed_listings(batches, sales)
+        pd.testing.assert_frame_equal(got, expected, obj=name)
+    return expected
+
+def main(n_batches):
+    for name, (rows, expected) in fixtures.items():
+        txs = marketplace_frame(rows)
+        listings = check_listing_lifecycles(txs, prepare_listing_sales(sales_frame(txs), txs))
+        assert endings(listings) == expected, '{}: {} != {}'.format(name, endings(listings), expected)
+        print('{}: ok'.format(name))
+
+    # all of them in one batch, as one refresh would see them
+    txs = pd.concat([
+        marketplace_frame(rows, collection='fixture_{}'.format(i)).assign(hash=lambda x, i=i: x['hash'] + '_{}'.format(i))
+        for i, (rows, _) in enumerate(fixtures.values())
+    ], ignore_index=True)
+    check_listing_lifecycles(txs, prepare_listing_sales(sales_frame(txs), txs))
+
+    rng = np.random.default_rng(0)
+    n_filled = 0
+    for _ in range(n_batches):
+        txs = random_batch(rng, int(rng.integers(20, 600)))
+        listings = check_listing_lifecycles(txs, prepare_listing_sales(sales_frame(txs), txs))
+        n_filled += listings['final_sale_tx_hash'].notna().sum()
+    print('{} random batches: ok ({} listings filled)'.format(n_batches, n_filled))
+
+    n_listings = 0
+    for _ in range(max(n_batches // 5, 1)):
+        n_listings += len(check_refresh_rerun(random_batch(rng, int(rng.integers(20, 300)))))
+    print('{} refresh reruns: ok ({} listing rows)'.format(max(n_batches // 5, 1), n_listings))
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50)
@@ -0,0 +1,63 @@
+# In this file we check that the partitioned rebuild (refresh_pipeline/
+# rebuild.py) gives the same marketplace_sales and marketplace_listings as
+# building everything in one go, on the synthetic workload. The archive also
+# gets some txs twice, and some buys made to share a hash with a buy of
+# another seller's listing, as if one tx had filled several listings: their
+# sale amounts come from all of the hash's buys and magic txs, so these only
+# come out right if all of them end up in the same partition.
+#
+# usage: python checks/check_rebuild_partitions.py [n events]
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from refresh_pipeline import rebuild
+from synthetic_workload import synthetic_workload
+
+N_DUPLICATED_TXS = 30
+N_SHARED_HASHES = 40
+
+def share_buy_hashes(marketplace_txs_raw, lookups, n_hashes, rng):
+    # gives pairs of buys of different sellers one hash, the second buy's own
+    # magic txs no longer match any buy and are dropped like any other
+    txs = rebuild.process_chunk(marketplace_txs_raw, lookups)
+    buys = txs.loc[txs['tx_type'] == 'buyItem']
+    pairs = rng.choice(len(buys), size=(n_hashes, 2), replace=False)
+    pairs = pairs[buys['to'].values[pairs[:, 0]] != buys['to'].values[pairs[:, 1]]]
+    marketplace_txs_raw = marketplace_txs_raw.copy()
+    marketplace_txs_raw.loc[buys.index[pairs[:, 1]], 'hash'] = buys['hash'].values[pairs[:, 0]]
+    return marketplace_txs_raw, buys['hash'].values[pairs[:, 0]]
+
+def main(n_events):
+    marketplace_txs_raw, magic_txs = synthetic_workload(n_events)
+    marketplace_txs_raw = marketplace_txs_raw.loc[marketplace_txs_raw['txreceipt_status'] == '1']
+    marketplace_txs_raw = pd.concat([marketplace_txs_raw, marketplace_txs_raw.iloc[100:100 + N_DUPLICATED_TXS]], ignore_index=True)
+    lookups = rebuild.transform_lookups()
+    marketplace_txs_raw, shared_hashes = share_buy_hashes(marketplace_txs_raw, lookups, N_SHARED_HASHES, np.random.default_rng(0))
+
+    expected_sales, expected_listings = rebuild.rebuild_serial(marketplace_txs_raw, magic_txs, lookups)
+    assert expected_sales['tx_hash'].isin(shared_hashes).sum() >= 2 * len(shared_hashes)
+
+    txs = rebuild.process_chunk(marketplace_txs_raw, lookups)
+    for n_partitions in [1, 3, 7, 16]:
+        partitions = rebuild.listing_partitions(txs, n_partitions)
+        magic_partition = rebuild.magic_partitions(magic_txs, txs, partitions)
+        results = [
+            rebuild.build_partition(txs.loc[partitions == partition], magic_txs.loc[magic_partition == partition], lookups)
+            for partition in range(n_partitions)
+        ]
+        pd.testing.assert_frame_equal(rebuild.in_serial_order([sales for sales, _ in results]), expected_sales)
+        pd.testing.assert_frame_equal(rebuild.in_serial_order([listings for _, listings in results]), expected_listings)
+        print('{} partitions: ok'.format(n_partitions))
+    print('{} sales ({} sharing a hash with another buy), {} listings'.format(
+        len(expected_sales), expected_sales['tx_hash'].isin(shared_hashes).sum(), len(expected_listings)
+    ))
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
@@ -0,0 +1,86 @@
+# In this file we check get_wallet_token_txs against the Arbiscan stand-in
+# (arbiscan_standin.py) on the synthetic workload. Some of the stand-in's
+# tokentx answers are rate limit errors the first time a wallet is asked for.
+# The parallel pull has to retry those and return the same txs as asking a
+# well-behaved stand-in for each wallet one by one. A wallet that keeps
+# failing has to raise rather than come back as an empty or broken frame.
+#
+# usage: python checks/check_wallet_token_txs.py [n events]
+
+import os
+import sys
+
+import pandas as pd
+import requests
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+import arbiscan
+from arbiscan_standin import ArbiscanStandIn, serve
+from refresh_pipeline import config
+from synthetic_workload import synthetic_workload
+
+RATE_LIMIT_ERROR = {'status': '0', 'message': 'NOTOK', 'result': 'Max rate limit reached'}
+# every this many wallets fails its first request
+FLAKY_EVERY = 4
+
+class FlakyStandIn(ArbiscanStandIn):
+    def __init__(self, marketplace_txs, magic_txs, always_failing=()):
+        super().__init__(marketplace_txs, magic_txs)
+        self.always_failing = set(always_failing)
+        self.failed = set()
+        self.errors = 0
+
+    def answer(self, params):
+        if params.get('action') == 'tokentx':
+            wallet = params['address']
+            with self.lock:
+                fail = wallet in self.always_failing or (int(wallet[-1], 16) % FLAKY_EVERY == 0 and wallet not in self.failed)
+                if fail:
+                    self.failed.add(wallet)
+                    self.errors += 1
+            if fail:
+                return RATE_LIMIT_ERROR
+        return super().answer(params)
+
+def serial_wallet_token_txs(url, token_address, wallets):
+    # one wallet at a time, the way the refresh pulled them before they went parallel
+    token_txs = []
+    for wallet in wallets:
+        response = requests.get(url + '?module=account&action=tokentx&address={}&contractaddress={}&startblock=0&endblock=99999999&sort=desc&apikey=k'.format(wallet, token_address)).json()
+        token_txs.append(pd.DataFrame.from_dict(response['result']))
+    token_txs_df = pd.concat([txs for txs in token_txs if not txs.empty])
+    return token_txs_df.drop_duplicates(['hash', 'value'])
+
+def main(n_events):
+    marketplace_txs, magic_txs = synthetic_workload(n_events)
+    token_address = config.contract_addresses()['magic']
+    buyers = magic_txs['from'].unique()
+
+    server, url = serve(ArbiscanStandIn(marketplace_txs, magic_txs))
+    expected = serial_wallet_token_txs(url, token_address, buyers)
+    server.shutdown()
+
+    flaky = FlakyStandIn(marketplace_txs, magic_txs)
+    server, arbiscan.ARBISCAN_API_URL = serve(flaky)
+    actual = arbiscan.get_wallet_token_txs('k', token_address, buyers, calls_per_second=1000)
+    server.shutdown()
+    assert flaky.errors > 0
+    pd.testing.assert_frame_equal(expected.reset_index(drop=True), actual.reset_index(drop=True))
+    print('{} wallets, {} token txs, {} rate limited requests retried'.format(len(buyers), len(actual), flaky.errors))
+
+    failing = FlakyStandIn(marketplace_txs, magic_txs, always_failing=buyers[:1])
+    server, arbiscan.ARBISCAN_API_URL = serve(failing)
+    try:
+        arbiscan.get_wallet_token_txs('k', token_address, buyers[:3], calls_per_second=1000)
+    except RuntimeError as error:
+        print('a wallet that keeps failing raises: {}'.format(error))
+    else:
+        raise AssertionError('a wallet that keeps failing was not reported')
+    finally:
+        server.shutdown()
+    print('ok')
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 3000)
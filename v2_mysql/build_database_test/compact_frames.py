@@ -0,0 +1,84 @@
+# In this file we shrink the frames the pipeline works on. Tx hashes (66
+# chars) and wallet addresses (42 chars) are held as Python strings, so every
+# merge and groupby on them hashes and compares strings, and each one costs
+# ~100 bytes. Here they're swapped for int32 codes from a StringDictionary that
+# all the frames of a run share (so a hash in the marketplace txs gets the same
+# code as in the magic txs and merges line up), and the few-valued label
+# columns become categoricals. The sales and listings builders work the same
+# on either form; decode_frame turns the codes back into strings right before
+# a frame is written.
+
+import numpy as np
+import pandas as pd
+
+NULL_CODE = -1
+CODE_DTYPE = np.int32
+
+# columns holding hashes or wallets, under every name they go by
+coded_columns = [
+    'hash',
+    'tx_hash',
+    'from',
+    'to',
+    'from_wallet',
+    'to_wallet',
+    'wallet_buyer',
+    'wallet_seller',
+    'update_tx_hash',
+    'cancellation_tx_hash',
+    'final_sale_tx_hash',
+]
+
+category_columns = [
+    'tx_type',
+    'nft_collection',
+    'nft_name',
+    'nft_subcategory',
+    'contract',
+]
+
+class StringDictionary:
+    # append-only string <-> code mapping, codes are positions in self.values
+    def __init__(self):
+        self.values = pd.Index([], dtype=object)
+
+    def __len__(self):
+        return len(self.values)
+
+    def encode(self, strings):
+        strings = pd.Series(strings, copy=False)
+        is_null = strings.isnull().values
+        codes = self.values.get_indexer(strings)
+        new_values = pd.unique(strings[(codes == NULL_CODE) & ~is_null])
+        if len(new_values):
+            self.values = self.values.append(pd.Index(new_values, dtype=object))
+            codes = self.values.get_indexer(strings)
+        codes[is_null] = NULL_CODE
+        return codes.astype(CODE_DTYPE)
+
+    def decode(self, codes):
+        # takes codes that went through a reindex too, i.e. floats with NaN
+        codes = pd.Series(codes, copy=False)
+        codes = codes.fillna(NULL_CODE).values.astype(np.int64)
+        strings = self.values.values.take(np.where(codes == NULL_CODE, 0, codes)) if len(self.values) else np.full(len(codes), None, dtype=object)
+        strings = np.asarray(strings, dtype=object).copy()
+        strings[codes == NULL_CODE] = None
+        return strings
+
+def encode_frame(df, dictionary):
+    df = df.copy()
+    for col in df.columns:
+        if col in coded_columns and not pd.api.types.is_numeric_dtype(df[col]):
+            df[col] = dictionary.encode(df[col])
+        elif col in category_columns and not pd.api.types.is_categorical_dtype(df[col]):
+            df[col] = df[col].astype('category')
+    return df
+
+def decode_frame(df, dictionary):
+    df = df.copy()
+    for col in df.columns:
+        if col in coded_columns and pd.api.types.is_numeric_dtype(df[col]):
+            df[col] = dictionary.decode(df[col])
+        elif pd.api.types.is_categorical_dtype(df[col]):
+            df[col] = df[col].astype(object)
+    return df
@@ -0,0 +1,38 @@
+CREATE TABLE IF NOT EXISTS agg_daily_volume_mat (
+    date DATE NOT NULL,
+    volume_magic DOUBLE,
+    n_sales BIGINT,
+    avg_sale_amt_magic DOUBLE,
+    volume_usd DOUBLE,
+    volume_eth DOUBLE,
+    avg_sale_amt_usd DOUBLE,
+    avg_sale_amt_eth DOUBLE,
+    PRIMARY KEY (date)
+);
+
+CREATE TABLE IF NOT EXISTS agg_daily_vol_by_collection_mat (
+    date DATE NOT NULL,
+    nft_collection VARCHAR(255),
+    volume_magic DOUBLE,
+    n_sales BIGINT,
+    avg_sale_amt_magic DOUBLE,
+    volume_usd DOUBLE,
+    volume_eth DOUBLE,
+    avg_sale_amt_usd DOUBLE,
+    avg_sale_amt_eth DOUBLE,
+    KEY (date)
+);
+
+CREATE TABLE IF NOT EXISTS agg_daily_vol_by_nft_mat (
+    date DATE NOT NULL,
+    nft_collection VARCHAR(255),
+    nft VARCHAR(255),
+    volume_magic DOUBLE,
+    n_sales BIGINT,
+    avg_sale_amt_magic DOUBLE,
+    volume_usd DOUBLE,
+    volume_eth DOUBLE,
+    avg_sale_amt_usd DOUBLE,
+    avg_sale_amt_eth DOUBLE,
+    KEY (date)
+);
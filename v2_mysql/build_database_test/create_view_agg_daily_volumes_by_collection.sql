@@ -10,28 +10,24 @@ CREATE OR REPLACE VIEW agg_daily_vol_by_collection (
     avg_sale_amt_eth
 )
 AS
-WITH avg_daily_prices AS (
-SELECT 
-	DATE(datetime) AS date, 
-    AVG(price_magic_usd) AS price_magic_usd, 
-    AVG(price_eth_usd) AS price_eth_usd
-FROM token_prices
-GROUP BY 1),
-daily_magic_volume AS (
+WITH daily_volume AS (
 SELECT 
 	DATE(a.datetime) AS date, 
     nft_collection,
     ROUND(SUM(sale_amt_magic), 2) AS volume_magic, 
 	SUM(quantity) AS n_sales,
-    ROUND(SUM(sale_amt_magic) / SUM(quantity), 2) AS avg_sale_amt_magic
+    ROUND(SUM(sale_amt_magic) / SUM(quantity), 2) AS avg_sale_amt_magic,
+    CASE WHEN COUNT(sale_amt_usd) = COUNT(1) THEN SUM(sale_amt_usd) END AS volume_usd,
+    CASE WHEN COUNT(sale_amt_eth) = COUNT(1) THEN SUM(sale_amt_eth) END AS volume_eth
 FROM marketplace_sales a 
 GROUP BY 1, 2
 )
+-- sale_amt_usd/sale_amt_eth are converted per sale at ingest, from the 5 minute
+-- token_prices bucket at or before the sale (token_price_index.py). A group
+-- with a sale that isn't converted yet has NULL USD/ETH values rather than a
+-- partial sum, until the price refresh backfills it
 SELECT 
 	a.*,
-	volume_magic * price_magic_usd AS volume_usd,
-    (volume_magic * price_magic_usd) / price_eth_usd AS volume_eth,
-	(volume_magic * price_magic_usd) / n_sales AS avg_sale_amt_usd,
-    ((volume_magic * price_magic_usd) / price_eth_usd) / n_sales AS avg_sale_amt_eth
-FROM daily_magic_volume a
-INNER JOIN avg_daily_prices b ON a.date = b.date;
\ No newline at end of file
+	volume_usd / n_sales AS avg_sale_amt_usd,
+    volume_eth / n_sales AS avg_sale_amt_eth
+FROM daily_volume a;
\ No newline at end of file
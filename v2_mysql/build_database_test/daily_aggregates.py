@@ -0,0 +1,158 @@
+# In this file we keep materialized copies of the agg_daily_volume* views
+# (tables from create_agg_daily_volume_tables.sql). The views re-aggregate all
+# of marketplace_sales on every query. The tables are only recomputed for the
+# dates a refresh actually touched (new sales, or sales whose USD/ETH amounts
+# were backfilled): the rows for those dates are deleted and re-inserted from the same query the views use,
+# restricted to that date range so it reads just those days of sales.
+#
+# usage: python daily_aggregates.py <rebuild|verify> [start date] [end date]
+
+import datetime as dt
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine, text
+
+# materialized table: (view it mirrors, group by columns as in the view)
+aggregate_tables = {
+    'agg_daily_volume_mat': ('agg_daily_volume', []),
+    'agg_daily_vol_by_collection_mat': ('agg_daily_vol_by_collection', [('nft_collection', 'nft_collection')]),
+    'agg_daily_vol_by_nft_mat': ('agg_daily_vol_by_nft', [('nft_collection', 'nft_collection'), ('nft_subcategory', 'nft')]),
+}
+value_columns = ['volume_magic', 'n_sales', 'avg_sale_amt_magic', 'volume_usd', 'volume_eth', 'avg_sale_amt_usd', 'avg_sale_amt_eth']
+
+def aggregate_query(group_columns):
+    # the view definition with a date range pushed in
+    group_select = ''.join('{} AS {}, '.format(col, alias) for col, alias in group_columns)
+    group_by = ', '.join(['DATE(a.datetime)'] + [col for col, _ in group_columns])
+    group_output = ''.join('a.{}, '.format(alias) for _, alias in group_columns)
+    return """
+        SELECT
+            a.date,
+            {group_output}
+            a.volume_magic,
+            a.n_sales,
+            a.avg_sale_amt_magic,
+            a.volume_usd,
+            a.volume_eth,
+            a.volume_usd / a.n_sales AS avg_sale_amt_usd,
+            a.volume_eth / a.n_sales AS avg_sale_amt_eth
+        FROM (
+            SELECT
+                DATE(a.datetime) AS date,
+                {group_select}
+                ROUND(SUM(sale_amt_magic), 2) AS volume_magic,
+                SUM(quantity) AS n_sales,
+                ROUND(SUM(sale_amt_magic) / SUM(quantity), 2) AS avg_sale_amt_magic,
+                CASE WHEN COUNT(sale_amt_usd) = COUNT(1) THEN SUM(sale_amt_usd) END AS volume_usd,
+                CASE WHEN COUNT(sale_amt_eth) = COUNT(1) THEN SUM(sale_amt_eth) END AS volume_eth
+            FROM marketplace_sales a
+            WHERE a.datetime >= :start_date AND a.datetime < :end_date
+            GROUP BY {group_by}
+        ) a
+    """.format(group_output=group_output, group_select=group_select, group_by=group_by)
+
+def touched_dates(datetimes):
+    datetimes = pd.to_datetime(pd.Series(datetimes))
+    if datetimes.dt.tz is not None:
+        datetimes = datetimes.dt.tz_convert('UTC').dt.tz_localize(None)
+    return sorted(set(datetimes.dt.date.dropna()))
+
+def date_ranges(dates):
+    # contiguous runs of days, so a refresh spanning midnight is one range
+    ranges = []
+    for date in sorted(dates):
+        if ranges and date == ranges[-1][1] + dt.timedelta(days=1):
+            ranges[-1][1] = date
+        else:
+            ranges.append([date, date])
+    return [(start, end) for start, end in ranges]
+
+def refresh_date_range(connection, start_date, end_date):
+    params = {'start_date': str(start_date), 'end_date': str(end_date + dt.timedelta(days=1))}
+    for table, (_, group_columns) in aggregate_tables.items():
+        columns = ['date'] + [alias for _, alias in group_columns] + value_columns
+        connection.execute(text('DELETE FROM {} WHERE date >= :start_date AND date < :end_date'.format(table)), params)
+        connection.execute(text('INSERT INTO {} ({}) {}'.format(table, ', '.join(columns), aggregate_query(group_columns))), params)
+
+def refresh_daily_aggregates(connection, dates):
+    dates = list(dates)
+    if not dates:
+        return
+    transaction = connection.begin() if not connection.in_transaction() else None
+    try:
+        for start_date, end_date in date_ranges(dates):
+            refresh_date_range(connection, start_date, end_date)
+    except Exception:
+        if transaction is not None:
+            transaction.rollback()
+        raise
+    if transaction is not None:
+        transaction.commit()
+    print('refreshed daily aggregates for {} day(s) from {} to {}'.format(len(dates), min(dates), max(dates)))
+
+def rebuild_daily_aggregates(connection, start_date=None, end_date=None):
+    # every day with a sale, e.g. to fill the tables for the first time
+    bounds = connection.execute(text('SELECT MIN(datetime), MAX(datetime) FROM marketplace_sales')).fetchone()
+    if bounds[0] is None:
+        return
+    start_date = start_date or pd.to_datetime(bounds[0]).date()
+    end_date = end_date or pd.to_datetime(bounds[1]).date()
+    refresh_daily_aggregates(connection, pd.date_range(start_date, end_date).date)
+
+def verify_daily_aggregates(connection, start_date=None, end_date=None, rtol=1e-6):
+    # compare each table with what its view returns right now
+    conditions = []
+    params = {}
+    if start_date is not None:
+        conditions.append('date >= :start_date')
+        params['start_date'] = str(start_date)
+    if end_date is not None:
+        conditions.append('date <= :end_date')
+        params['end_date'] = str(end_date)
+    where = 'WHERE ' + ' AND '.join(conditions) if conditions else ''
+
+    all_match = True
+    for table, (view, group_columns) in aggregate_tables.items():
+        keys = ['date'] + [alias for _, alias in group_columns]
+        expected = pd.read_sql(text('SELECT * FROM {} {}'.format(view, where)), connection, params=params)
+        actual = pd.read_sql(text('SELECT {} FROM {} {}'.format(', '.join(keys + value_columns), table, where)), connection, params=params)
+        for df in (expected, actual):
+            df['date'] = pd.to_datetime(df['date']).dt.date
+            df[keys[1:]] = df[keys[1:]].astype(object).where(df[keys[1:]].notnull(), '')
+        merged = expected.merge(actual, how='outer', on=keys, suffixes=('_view', '_table'), indicator=True)
+        missing = merged['_merge'] != 'both'
+        differs = np.zeros(len(merged), dtype=bool)
+        for col in value_columns:
+            view_values = merged[col + '_view'].astype(float).values
+            table_values = merged[col + '_table'].astype(float).values
+            differs |= ~np.isclose(view_values, table_values, rtol=rtol, equal_nan=True)
+        n_bad = int((missing | differs).sum())
+        all_match &= n_bad == 0
+        print('{}: {} ({} rows in {}, {} in table, {} mismatched)'.format(table, 'OK' if n_bad == 0 else 'MISMATCH', len(expected), view, len(actual), n_bad))
+    return all_match
+
+if __name__ == '__main__':
+    command = sys.argv[1]
+    start_date = dt.date.fromisoformat(sys.argv[2]) if len(sys.argv) > 2 else None
+    end_date = dt.date.fromisoformat(sys.argv[3]) if len(sys.argv) > 3 else None
+
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "constants", "mysql_credential.json")) as f:
+        mysql_credentials = json.loads(f.read())
+    engine = create_engine(
+        "mysql+pymysql://{user}:{pw}@{host}/{db}".format(
+        user=mysql_credentials['username'],
+        pw=mysql_credentials['pw'],
+        host=mysql_credentials['host'],
+        db="treasure"
+        )
+    )
+    with engine.connect() as connection:
+        if command == 'rebuild':
+            rebuild_daily_aggregates(connection, start_date, end_date)
+        elif not verify_daily_aggregates(connection, start_date, end_date):
+            sys.exit(1)
+    engine.dispose()
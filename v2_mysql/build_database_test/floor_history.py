@@ -0,0 +1,192 @@
+# In this file we build floor_price_history, the floor price of every
+# (nft_collection, nft_subcategory) at each 5 minute bucket back to launch.
+# Running the floor_prices view at every point in time isn't feasible, so we
+# sweep the listing lifecycle instead: every row of marketplace_listings is
+# active from listed_at until the first of updated_at, cancelled_at, sold_at
+# and expires_at. Start and end events are sorted by time and replayed into a
+# min-heap per subcategory (ended listings are dropped lazily when they reach
+# the top). The floor at the close of a bucket is only stored when it differs
+# from the last stored value, so the table is a compact step series: the
+# floor at any bucket is the latest row at or before it.
+#
+# The incremental mode carries on from the last computed bucket, seeding the
+# heaps with the listings still active at that point.
+#
+# usage: python floor_history.py [update|rebuild]
+
+import heapq
+import json
+import os
+import sys
+
+import pandas as pd
+from sqlalchemy import create_engine, inspect, text
+
+from bulk_load import bulk_load
+
+BUCKET = pd.Timedelta(minutes=5)
+HISTORY_TABLE = 'floor_price_history'
+PROGRESS_TABLE = 'floor_price_history_progress'
+
+group_cols = ['nft_collection', 'nft_subcategory']
+end_cols = ['updated_at', 'cancelled_at', 'sold_at', 'expires_at']
+history_cols = ['bucket', 'nft_collection', 'nft_subcategory', 'floor_price']
+
+def floor_bucket(times):
+    return pd.to_datetime(times).dt.floor(BUCKET) if isinstance(times, pd.Series) else pd.Timestamp(times).floor(BUCKET)
+
+def listing_intervals(listings):
+    intervals = listings.loc[:,['tx_hash'] + group_cols + ['listing_price_magic']].copy()
+    intervals['nft_subcategory'] = intervals['nft_subcategory'].astype(object).where(intervals['nft_subcategory'].notnull(), None)
+    intervals['start'] = pd.to_datetime(listings['listed_at'])
+    intervals['end'] = pd.concat([pd.to_datetime(listings[col]) for col in end_cols], axis=1).min(axis=1)
+    return intervals
+
+def latest_event_time(listings):
+    times = pd.concat([pd.to_datetime(listings[col]) for col in ['listed_at', 'updated_at', 'cancelled_at', 'sold_at']])
+    return times.max()
+
+def sweep_floor_history(listings, start, until, last_floors=None):
+    # floors for the buckets in [start, until), rows only where the floor
+    # changed from last_floors (the last stored floor per group)
+    last_floors = dict(last_floors or {})
+    intervals = listing_intervals(listings)
+    intervals = intervals.loc[(intervals['start'] < until) & ~(intervals['end'] < start)]
+    # anything listed before start is carried in as if listed at start
+    intervals['start'] = intervals['start'].where(intervals['start'] >= start, start)
+
+    starts = intervals.loc[:,group_cols + ['tx_hash', 'listing_price_magic']].assign(time=intervals['start'], is_end=False)
+    ends = intervals.loc[intervals['end'] < until, group_cols + ['tx_hash', 'listing_price_magic']].assign(time=intervals['end'], is_end=True)
+    events = pd.concat([starts, ends], ignore_index=True)
+    events['bucket'] = floor_bucket(events['time'])
+    events = events.sort_values(['time', 'is_end'], kind='mergesort')
+
+    rows = []
+    for (nft_collection, nft_subcategory), group_events in events.groupby(group_cols, sort=False, dropna=False):
+        nft_subcategory = None if pd.isnull(nft_subcategory) else nft_subcategory
+        key = (nft_collection, nft_subcategory)
+        heap = []
+        ended = set()
+        last_floor = last_floors.get(key)
+
+        def close(bucket):
+            nonlocal last_floor
+            while heap and heap[0][1] in ended:
+                heapq.heappop(heap)
+            floor_price = heap[0][0] if heap else None
+            if floor_price != last_floor:
+                rows.append((bucket, nft_collection, nft_subcategory, floor_price))
+                last_floor = floor_price
+
+        buckets = group_events['bucket'].values
+        tx_hashes = group_events['tx_hash'].values
+        prices = group_events['listing_price_magic'].values
+        is_end = group_events['is_end'].values
+        for i in range(len(group_events)):
+            if i > 0 and buckets[i] != buckets[i - 1]:
+                close(pd.Timestamp(buckets[i - 1]))
+            if is_end[i]:
+                ended.add(tx_hashes[i])
+            else:
+                heapq.heappush(heap, (float(prices[i]), tx_hashes[i]))
+        if len(group_events):
+            close(pd.Timestamp(buckets[-1]))
+
+    history = pd.DataFrame(rows, columns=history_cols)
+    return history.sort_values(['bucket'] + group_cols, kind='mergesort', na_position='first').reset_index(drop=True)
+
+def floor_at(history, time):
+    # the floor per group at a point in time, from the compact series
+    history = history.loc[history['bucket'] <= floor_bucket(time)]
+    return history.sort_values('bucket', kind='mergesort').groupby(group_cols, dropna=False).tail(1).reset_index(drop=True)
+
+def read_listings(connection, active_since=None):
+    # every listing, or just the ones still active at or after active_since
+    params = {}
+    where = ''
+    if active_since is not None:
+        where = 'WHERE ' + ' AND '.join('({0} IS NULL OR {0} >= :since)'.format(col) for col in end_cols)
+        params['since'] = str(active_since)
+    query = text("""
+        SELECT tx_hash, nft_collection, nft_subcategory, listing_price_magic, listed_at, {}
+        FROM marketplace_listings
+        {}
+    """.format(', '.join(end_cols), where))
+    return pd.read_sql(query, connection, params=params)
+
+def read_progress(connection):
+    if not inspect(connection).has_table(PROGRESS_TABLE):
+        return None
+    computed_until = connection.execute(text('SELECT MAX(computed_until) FROM {}'.format(PROGRESS_TABLE))).scalar()
+    return pd.Timestamp(computed_until) if computed_until is not None else None
+
+def read_last_floors(connection):
+    query = text("""
+        SELECT nft_collection, nft_subcategory, floor_price
+        FROM (
+            SELECT h.*, ROW_NUMBER() OVER (PARTITION BY nft_collection, nft_subcategory ORDER BY bucket DESC) AS rn
+            FROM {} h
+        ) latest
+        WHERE rn = 1
+    """.format(HISTORY_TABLE))
+    last_floors = pd.read_sql(query, connection)
+    return {
+        (row.nft_collection, None if pd.isnull(row.nft_subcategory) else row.nft_subcategory): None if pd.isnull(row.floor_price) else row.floor_price
+        for row in last_floors.itertuples(index=False)
+    }
+
+def create_history_tables(connection):
+    connection.execute(text("""
+        CREATE TABLE IF NOT EXISTS {} (
+            bucket DATETIME NOT NULL,
+            nft_collection VARCHAR(255),
+            nft_subcategory VARCHAR(255),
+            floor_price DOUBLE
+        )
+    """.format(HISTORY_TABLE)))
+    connection.execute(text('CREATE TABLE IF NOT EXISTS {} (computed_until DATETIME NOT NULL)'.format(PROGRESS_TABLE)))
+
+def update_floor_price_history(connection, rebuild=False, until=None):
+    with connection.begin():
+        create_history_tables(connection)
+        computed_until = None if rebuild else read_progress(connection)
+        if computed_until is None:
+            listings = read_listings(connection)
+            last_floors = {}
+            connection.execute(text('DELETE FROM {}'.format(HISTORY_TABLE)))
+        else:
+            listings = read_listings(connection, computed_until)
+            last_floors = read_last_floors(connection)
+        if listings.empty:
+            return pd.DataFrame(columns=history_cols)
+
+        start = computed_until if computed_until is not None else floor_bucket(pd.to_datetime(listings['listed_at']).min())
+        # only buckets that are over and fully ingested, later events may still
+        # land in the bucket the newest tx is in
+        until = until if until is not None else floor_bucket(latest_event_time(listings))
+        if until <= start:
+            return pd.DataFrame(columns=history_cols)
+
+        history = sweep_floor_history(listings, start, until, last_floors)
+        if not history.empty:
+            bulk_load(history, HISTORY_TABLE, connection)
+        connection.execute(text('DELETE FROM {}'.format(PROGRESS_TABLE)))
+        connection.execute(text('INSERT INTO {} (computed_until) VALUES (:computed_until)'.format(PROGRESS_TABLE)), {'computed_until': until.to_pydatetime()})
+    print('floor price history: {} new rows for {} to {}'.format(len(history), start, until))
+    return history
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'update'
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "constants", "mysql_credential.json")) as f:
+        mysql_credentials = json.loads(f.read())
+    engine = create_engine(
+        "mysql+pymysql://{user}:{pw}@{host}/{db}".format(
+        user=mysql_credentials['username'],
+        pw=mysql_credentials['pw'],
+        host=mysql_credentials['host'],
+        db="treasure"
+        )
+    )
+    with engine.connect() as connection:
+        update_floor_price_history(connection, rebuild=command == 'rebuild')
+    engine.dispose()
@@ -0,0 +1,189 @@
+# In this file we keep marketplace_listings up to date one refresh at a time.
+# Appending the listings built from the latest batch misses every listing
+# created in an earlier run whose update, cancellation or sale only shows up
+# now. Instead of rebuilding the whole table we load just the still-open
+# listings for the (wallet, collection, nft id) keys touched by the batch,
+# run them through the lifecycle sweep ahead of the new events, then UPDATE
+# the ones that closed and INSERT the new ones. A batch that is run again
+# (the watermark is only moved after this write) finds its listings already
+# in the table: they are swept from their own events like the first time,
+# closed with the UPDATE if they ended since, and not inserted again.
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+
+from binary_keys import binary_to_hex, is_swapped, load_table, physical_table, to_stored_frame
+from listing_lifecycle import LISTING_TX_TYPES, cols_to_load, prepare_listing_sales, sweep_listing_lifecycles
+
+KEY_CHUNKSIZE = 500
+
+listings_key_cols = [
+    'wallet_seller',
+    'nft_collection',
+    'nft_id'
+]
+
+termination_cols = [
+    'update_tx_hash',
+    'cancellation_tx_hash',
+    'final_sale_tx_hash',
+    'updated_at',
+    'cancelled_at',
+    'sold_at'
+]
+
+# every event in the batch comes after every listing already in the table
+CARRIED_OVER_BLOCK = -1
+
+def touched_listing_keys(marketplace_txs, marketplace_sales):
+    keys = pd.concat([
+        marketplace_txs.loc[:,['from','nft_collection','nft_id']].rename(columns={'from':'wallet_seller'}),
+        marketplace_sales.loc[:,listings_key_cols]
+    ])
+    return keys.drop_duplicates().reset_index(drop=True)
+
+def read_rows_for_keys(connection, query, keys, params={}):
+    frames = []
+    for chunk_start in range(0, len(keys), KEY_CHUNKSIZE):
+        chunk = keys.iloc[chunk_start:chunk_start + KEY_CHUNKSIZE]
+        key_params = dict(params)
+        placeholders = []
+        for i, (wallet, collection, nft_id) in enumerate(chunk.itertuples(index=False)):
+            placeholders.append('(:w{0}, :c{0}, :i{0})'.format(i))
+            key_params.update({'w{}'.format(i): wallet, 'c{}'.format(i): collection, 'i{}'.format(i): int(nft_id)})
+        result = connection.execute(text(query.format(keys=', '.join(placeholders))), key_params)
+        frames.append(pd.DataFrame(result.fetchall(), columns=list(result.keys())))
+    if not frames:
+        return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True)
+
+def read_open_listings(connection, keys):
+    query = """
+        SELECT * FROM marketplace_listings
+        WHERE update_tx_hash IS NULL
+        AND cancellation_tx_hash IS NULL
+        AND final_sale_tx_hash IS NULL
+        AND (wallet_seller, nft_collection, nft_id) IN ({keys})
+    """
+    return read_rows_for_keys(connection, query, keys)
+
+def read_listed_hashes(connection, hashes):
+    # the ones among hashes that marketplace_listings already has a row for
+    table = 'marketplace_listings'
+    stored = to_stored_frame(connection, table, pd.DataFrame({'tx_hash': list(hashes)}))['tx_hash'].tolist()
+    listed = set()
+    for chunk_start in range(0, len(stored), KEY_CHUNKSIZE):
+        chunk = stored[chunk_start:chunk_start + KEY_CHUNKSIZE]
+        placeholders = ', '.join(':h{}'.format(i) for i in range(len(chunk)))
+        result = connection.execute(
+            text('SELECT DISTINCT tx_hash FROM {} WHERE tx_hash IN ({})'.format(physical_table(connection, table), placeholders)),
+            {'h{}'.format(i): tx_hash for i, tx_hash in enumerate(chunk)}
+        )
+        listed.update(row[0] for row in result)
+    if is_swapped(connection, table):
+        return set(binary_to_hex(listed))
+    return listed
+
+def read_prior_sales(connection, keys, since):
+    query = """
+        SELECT tx_hash, datetime, wallet_seller, nft_collection, nft_id, quantity
+        FROM marketplace_sales
+        WHERE datetime >= :since
+        AND (wallet_seller, nft_collection, nft_id) IN ({keys})
+    """
+    return read_rows_for_keys(connection, query, keys, {'since': since})
+
+def quantity_sold_before(open_listings, prior_sales):
+    # partial fills from earlier runs still count towards closing a listing
+    if prior_sales.empty:
+        return pd.Series(0.0, index=open_listings.index)
+    fills = open_listings.loc[:,['tx_hash','listed_at'] + listings_key_cols].merge(
+        prior_sales.rename(columns={'tx_hash':'sale_tx_hash'}), how='inner', on=listings_key_cols)
+    fills = fills.loc[fills['datetime']>=fills['listed_at']]
+    fills = fills.groupby('tx_hash').quantity.sum()
+    return open_listings['tx_hash'].map(fills).fillna(0.0)
+
+def carry_over_listings(open_listings):
+    listings = open_listings.rename(columns={
+        'tx_hash':'hash',
+        'listed_at':'datetime',
+        'expires_at':'expiration_datetime',
+        'wallet_seller':'from'
+    })
+    for col in ['datetime', 'expiration_datetime']:
+        listings[col] = pd.to_datetime(listings[col]).dt.tz_localize('UTC')
+    listings['blockNumber'] = CARRIED_OVER_BLOCK
+    listings['tx_type'] = 'createListing'
+    return listings.drop(columns=termination_cols)
+
+def apply_listing_events(open_listings, prior_sales, marketplace_txs, marketplace_sales, listed_hashes=()):
+    # listed_hashes: listings of this batch already in the table from an earlier run
+    carried_over = carry_over_listings(open_listings)
+    carried_over['quantity_sold_before'] = quantity_sold_before(open_listings, prior_sales).values
+    events = pd.concat([carried_over, marketplace_txs], ignore_index=True)
+    listings = sweep_listing_lifecycles(events, prepare_listing_sales(marketplace_sales, marketplace_txs))
+
+    is_carried_over = listings['tx_hash'].isin(carried_over['hash'])
+    is_listed = listings['tx_hash'].isin(listed_hashes)
+    is_terminated = listings.loc[:,termination_cols[:3]].notna().any(axis=1)
+    closed_listings = listings.loc[(is_carried_over | is_listed) & is_terminated]
+    closed_listings = closed_listings.drop_duplicates('tx_hash')
+    new_listings = listings.loc[~is_carried_over & ~is_listed]
+    return closed_listings, new_listings
+
+def to_sql_value(value):
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, pd.Timestamp):
+        return value.tz_convert(None).to_pydatetime() if value.tzinfo else value.to_pydatetime()
+    if value is None or (isinstance(value, float) and np.isnan(value)) or value is pd.NaT:
+        return None
+    return value
+
+def write_listing_changes(connection, closed_listings, new_listings):
+    # by now marketplace_listings may be the view over the keyed table
+    update_query = text("""
+        UPDATE {}
+        SET update_tx_hash = :update_tx_hash,
+            cancellation_tx_hash = :cancellation_tx_hash,
+            final_sale_tx_hash = :final_sale_tx_hash,
+            updated_at = :updated_at,
+            cancelled_at = :cancelled_at,
+            sold_at = :sold_at
+        WHERE tx_hash = :tx_hash
+        AND update_tx_hash IS NULL
+        AND cancellation_tx_hash IS NULL
+        AND final_sale_tx_hash IS NULL
+    """.format(physical_table(connection, 'marketplace_listings')))
+    updates = [
+        {col: to_sql_value(value) for col, value in row.items()}
+        for row in to_stored_frame(connection, 'marketplace_listings', closed_listings.loc[:,['tx_hash'] + termination_cols]).to_dict('records')
+    ]
+
+    with connection.begin():
+        if updates:
+            connection.execute(update_query, updates)
+        load_table(new_listings.loc[:,cols_to_load], 'marketplace_listings', connection)
+    return len(updates), len(new_listings)
+
+def refresh_marketplace_listings(connection, marketplace_txs, marketplace_sales):
+    keys = touched_listing_keys(marketplace_txs, marketplace_sales)
+    listed_hashes = read_listed_hashes(connection, marketplace_txs.loc[marketplace_txs['tx_type'].isin(LISTING_TX_TYPES), 'hash'])
+    open_listings = read_open_listings(connection, keys)
+    if not open_listings.empty:
+        # listings this batch creates are swept from their own events, not carried over
+        open_listings = open_listings.loc[~open_listings['tx_hash'].isin(marketplace_txs['hash'])].copy()
+    if open_listings.empty:
+        open_listings = pd.DataFrame(columns=cols_to_load)
+        prior_sales = pd.DataFrame()
+    else:
+        open_listings['listed_at'] = pd.to_datetime(open_listings['listed_at'])
+        prior_sales = read_prior_sales(connection, keys, open_listings['listed_at'].min().to_pydatetime())
+        if not prior_sales.empty:
+            prior_sales['datetime'] = pd.to_datetime(prior_sales['datetime'])
+            # sales from this batch may already be loaded, they are applied as new events
+            prior_sales = prior_sales.loc[~prior_sales['tx_hash'].isin(marketplace_sales['tx_hash'])]
+
+    closed_listings, new_listings = apply_listing_events(open_listings, prior_sales, marketplace_txs, marketplace_sales, listed_hashes)
+    return write_listing_changes(connection, closed_listings, new_listings)
@@ -0,0 +1,151 @@
+# In this file we measure where a refresh spends its time. Each step of
+# refresh_database runs inside stage(), which records its wall time, the rows
+# it took and gave, the peak RSS of the process so far, and how many HTTP
+# calls were made during it, how long they took and how long the rate
+# limiter slept (the Arbiscan helpers report those through add()). Records
+# are written as they finish, as JSON lines, or as a Prometheus textfile for
+# node_exporter's textfile collector when the path ends in .prom.
+#
+# It's off unless a path is given (REFRESH_METRICS_PATH or configure()), and
+# off, stage() and add() return straight away.
+
+import contextlib
+import datetime as dt
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+
+try:
+    import resource
+except ImportError: # not on Windows
+    resource = None
+
+METRICS_PATH = os.environ.get('REFRESH_METRICS_PATH')
+PROMETHEUS_SUFFIX = '.prom'
+PROMETHEUS_PREFIX = 'treasure_refresh'
+
+# counters the stages report the change in
+counter_names = [
+    'http_calls',
+    'http_seconds',
+    'http_retries',
+    'rate_limit_sleep_seconds',
+]
+
+# record field -> (prometheus metric, help), summed over stages of the same name
+prometheus_metrics = {
+    'seconds': ('stage_seconds', 'Wall time of the stage.'),
+    'rows_in': ('stage_rows_in', 'Rows the stage was given.'),
+    'rows_out': ('stage_rows_out', 'Rows the stage returned or wrote.'),
+    'http_calls': ('stage_http_calls', 'HTTP calls made during the stage.'),
+    'http_seconds': ('stage_http_seconds', 'Time spent waiting on HTTP calls during the stage, summed over threads.'),
+    'http_retries': ('stage_http_retries', 'HTTP calls retried during the stage.'),
+    'rate_limit_sleep_seconds': ('stage_rate_limit_sleep_seconds', 'Time the rate limiter slept during the stage, summed over threads.'),
+    'peak_rss_bytes': ('stage_peak_rss_bytes', 'Peak RSS of the process at the end of the stage.'),
+    'failed': ('stage_failed', 'Times the stage raised.'),
+}
+
+def peak_rss_bytes():
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+class Metrics:
+    def __init__(self, path=None):
+        self.path = path
+        self.run_id = uuid.uuid4().hex
+        self.lock = threading.Lock()
+        self.counters = dict.fromkeys(counter_names, 0)
+        self.records = []
+
+    def add(self, name, value=1):
+        if self.path is None:
+            return
+        with self.lock:
+            self.counters[name] += value
+
+    @contextlib.contextmanager
+    def stage(self, name, rows_in=None):
+        # yields the record, the caller sets rows_out (or anything else) on it
+        if self.path is None:
+            yield {}
+            return
+        record = {'stage': name, 'rows_in': rows_in, 'rows_out': None}
+        with self.lock:
+            counters_before = dict(self.counters)
+        started_at = time.perf_counter()
+        failed = False
+        try:
+            yield record
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            record['seconds'] = round(time.perf_counter() - started_at, 4)
+            with self.lock:
+                for counter in counter_names:
+                    record[counter] = round(self.counters[counter] - counters_before[counter], 4)
+            record['peak_rss_bytes'] = peak_rss_bytes()
+            record['failed'] = failed
+            self.write(record)
+
+    def write(self, record):
+        record = dict(record, run_id=self.run_id, finished_at=dt.datetime.utcnow().isoformat())
+        with self.lock:
+            self.records.append(record)
+            if self.path.endswith(PROMETHEUS_SUFFIX):
+                write_textfile(self.path, prometheus_text(self.records))
+            else:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+
+def prometheus_text(records):
+    # a stage that ran more than once (e.g. a retried load) is summed, peak
+    # RSS is the highest seen
+    totals = {}
+    for record in records:
+        stage_totals = totals.setdefault(record['stage'], {})
+        for field in prometheus_metrics:
+            if record.get(field) is None:
+                continue
+            if field == 'peak_rss_bytes':
+                stage_totals[field] = max(stage_totals.get(field, 0), record[field])
+            else:
+                stage_totals[field] = stage_totals.get(field, 0) + record[field]
+
+    lines = []
+    for field, (metric, help_text) in prometheus_metrics.items():
+        lines.append('# HELP {}_{} {}'.format(PROMETHEUS_PREFIX, metric, help_text))
+        lines.append('# TYPE {}_{} gauge'.format(PROMETHEUS_PREFIX, metric))
+        for stage_name, stage_totals in totals.items():
+            if field in stage_totals:
+                lines.append('{}_{}{{stage="{}"}} {}'.format(PROMETHEUS_PREFIX, metric, stage_name, stage_totals[field]))
+    lines.append('# HELP {}_last_stage_timestamp_seconds When the last stage finished.'.format(PROMETHEUS_PREFIX))
+    lines.append('# TYPE {}_last_stage_timestamp_seconds gauge'.format(PROMETHEUS_PREFIX))
+    lines.append('{}_last_stage_timestamp_seconds {}'.format(PROMETHEUS_PREFIX, round(time.time(), 3)))
+    return '\n'.join(lines) + '\n'
+
+def write_textfile(path, body):
+    # the collector may read at any moment, so never leave a half written file
+    with open(path + '.tmp', 'w') as f:
+        f.write(body)
+    os.replace(path + '.tmp', path)
+
+current = Metrics(METRICS_PATH)
+
+def configure(path):
+    # start a new run writing to path, None switches it off
+    global current
+    current = Metrics(path)
+    return current
+
+def stage(name, rows_in=None):
+    return current.stage(name, rows_in)
+
+def add(name, value=1):
+    current.add(name, value)
@@ -0,0 +1,302 @@
+# In this file we work out how every marketplace listing ended: updated,
+# cancelled or sold. The original approach self-merged listings against every
+# other event for the same (wallet, collection, nft id), which blows up for
+# wallets that relist the same token over and over. Instead we sort all the
+# events once and walk each key's history backwards in a single pass,
+# keeping track of the next update, cancellation and sales seen so far.
+
+import numpy as np
+import pandas as pd
+
+LISTING_TX_TYPES = ['createListing', 'updateListing']
+
+listings_merge_keys = [
+    'from',
+    'nft_collection',
+    'nft_id'
+]
+
+sales_table_merge_keys = [
+    'wallet_seller',
+    'nft_collection',
+    'nft_id'
+]
+
+cols_to_load = [
+    'tx_hash',
+    'listed_at',
+    'wallet_seller',
+    'listing_price_magic',
+    'gas_fee_eth',
+    'nft_collection',
+    'nft_id',
+    'nft_name',
+    'nft_subcategory',
+    'quantity',
+    'update_tx_hash',
+    'cancellation_tx_hash',
+    'final_sale_tx_hash',
+    'updated_at',
+    'cancelled_at',
+    'sold_at',
+    'expires_at'
+]
+
+# event kinds, in the order they are handled within a single block
+CANCELLED, SOLD, LISTED, UPDATED = 0, 1, 2, 3
+
+def prepare_listing_sales(marketplace_sales, marketplace_txs):
+    sales = marketplace_sales.merge(marketplace_txs.loc[:,['hash','blockNumber']], how='inner', left_on='tx_hash', right_on='hash')
+    sales = sales.loc[:,['tx_hash','datetime','blockNumber','quantity'] + sales_table_merge_keys].copy()
+    sales.rename(columns={
+        'tx_hash':'final_sale_tx_hash',
+        'datetime':'sold_at',
+        'blockNumber':'sale_blockNumber',
+        'quantity':'quantity_sold'
+    }, inplace=True)
+    return sales
+
+def sort_listing_events(listings, updates, cancellations, sales):
+    event_frames = []
+    for kind, frame, block_col in [
+        (LISTED, listings, 'blockNumber'),
+        (UPDATED, updates, 'blockNumber'),
+        (CANCELLED, cancellations, 'blockNumber'),
+        (SOLD, sales.rename(columns=dict(zip(sales_table_merge_keys, listings_merge_keys))), 'sale_blockNumber'),
+    ]:
+        event_frames.append(pd.DataFrame({
+            'kind': kind,
+            'position': np.arange(len(frame)),
+            'block': frame[block_col].values,
+            **{key: frame[key].values for key in listings_merge_keys}
+        }))
+    events = pd.concat(event_frames, ignore_index=True)
+    # observed=True so categorical keys only number the combinations that occur
+    events['key'] = events.groupby(listings_merge_keys, sort=False, dropna=False, observed=True).ngroup()
+    # stable sort so ties inside a block keep their original frame order
+    return events.sort_values(['key', 'block'], kind='mergesort').reset_index(drop=True)
+
+class SalesSuffix:
+    # Sales at or after the block being swept, ordered by sale time (ties in
+    # frame order). A listing of quantity q is filled by the sale where the
+    # running quantity sold first reaches q, i.e. where the quantity sold
+    # *after* that sale equals total - q. New sales only ever go in front, so
+    # the quantity after each settled sale never changes and can be indexed.
+    # Sales sharing the earliest timestamp stay in a small unsettled front
+    # group because a later (earlier-block) sale can still tie with them.
+
+    def __init__(self):
+        self.settled = {}
+        self.settled_total = 0.0
+        self.front = []
+        self.front_time = None
+
+    def add(self, sold_at, position, quantity):
+        if self.front and sold_at != self.front_time:
+            self.settle_front()
+        self.front.append((position, quantity))
+        self.front.sort()
+        self.front_time = sold_at
+
+    def settle_front(self):
+        for position, quantity in reversed(self.front):
+            self.settled.setdefault(self.settled_total, []).insert(0, position)
+            self.settled_total += quantity
+        self.front = []
+
+    def fills(self, quantity):
+        front_total = sum(q for _, q in self.front)
+        target = self.settled_total + front_total - quantity
+        quantity_after = self.settled_total + front_total
+        matches = []
+        for position, q in self.front:
+            quantity_after -= q
+            if quantity_after == target:
+                matches.append(position)
+        return matches + self.settled.get(target, [])
+
+def sweep_listing_lifecycles(marketplace_txs, sales, keep_cols=()):
+    # keep_cols: extra columns of the listing txs to carry through to the rows
+    listings = marketplace_txs.loc[marketplace_txs['tx_type'].isin(LISTING_TX_TYPES)].reset_index(drop=True)
+    updates = marketplace_txs.loc[marketplace_txs['tx_type']=='updateListing'].reset_index(drop=True)
+    cancellations = marketplace_txs.loc[marketplace_txs['tx_type']=='cancelListing'].reset_index(drop=True)
+    sales = sales.reset_index(drop=True)
+    events = sort_listing_events(listings, updates, cancellations, sales)
+
+    kinds = events['kind'].values
+    positions = events['position'].values
+    blocks = events['block'].values
+    keys = events['key'].values
+    # listings carried over from an earlier refresh may already be partly filled
+    listing_quantities = listings['quantity'].values
+    if 'quantity_sold_before' in listings.columns:
+        listing_quantities = listing_quantities - listings['quantity_sold_before'].fillna(0).values
+    update_blocks = updates['blockNumber'].values
+    cancellation_blocks = cancellations['blockNumber'].values
+    sale_blocks = sales['sale_blockNumber'].values
+    sale_times = sales['sold_at'].values
+    sale_quantities = sales['quantity_sold'].values
+
+    # listing position -> [(update, cancellation, sale)], -1 where there is none
+    terminations = [None] * len(listings)
+
+    i = len(events) - 1
+    while i >= 0:
+        # walk one (key, block) group at a time, latest block first
+        key = keys[i]
+        next_update = -1
+        next_cancellations = []
+        sales_after = SalesSuffix()
+        while i >= 0 and keys[i] == key:
+            block_start = i
+            while block_start > 0 and keys[block_start - 1] == key and blocks[block_start - 1] == blocks[i]:
+                block_start -= 1
+            group = range(block_start, i + 1)
+
+            # cancellations and sales in the same block as the listing still end it
+            block_cancellations = [positions[j] for j in group if kinds[j] == CANCELLED]
+            if block_cancellations:
+                next_cancellations = block_cancellations
+            for j in group:
+                if kinds[j] == SOLD:
+                    sales_after.add(sale_times[positions[j]], positions[j], sale_quantities[positions[j]])
+
+            for j in group:
+                if kinds[j] == LISTED:
+                    listing = positions[j]
+                    terminations[listing] = [
+                        (next_update, cancellation, sale)
+                        for cancellation in (next_cancellations or [-1])
+                        for sale in (sales_after.fills(listing_quantities[listing]) or [-1])
+                    ]
+
+            # an update only ends listings from strictly earlier blocks
+            block_updates = [positions[j] for j in group if kinds[j] == UPDATED]
+            if block_updates:
+                next_update = min(block_updates)
+            i = block_start - 1
+
+    rows = {'listing': [], 'update': [], 'cancellation': [], 'sale': []}
+    for listing, listing_terminations in enumerate(terminations):
+        for update, cancellation, sale in listing_terminations:
+            update_block = update_blocks[update] if update >= 0 else None
+            cancellation_block = cancellation_blocks[cancellation] if cancellation >= 0 else None
+            sale_block = sale_blocks[sale] if sale >= 0 else None
+            keep_update, keep_cancellation, keep_sale = update >= 0, cancellation >= 0, sale >= 0
+
+            # resolve listings that have more than one termination event; the
+            # block numbers are compared even when the event itself was dropped
+            if before(update_block, cancellation_block, or_equal=True):
+                keep_cancellation = False
+            if before(cancellation_block, update_block):
+                keep_update = False
+            if before(sale_block, cancellation_block):
+                keep_cancellation = False
+            if before(cancellation_block, sale_block):
+                keep_sale = False
+            if before(sale_block, update_block):
+                keep_update = False
+            if before(update_block, sale_block, or_equal=True):
+                keep_sale = False
+
+            rows['listing'].append(listing)
+            rows['update'].append(update if keep_update else -1)
+            rows['cancellation'].append(cancellation if keep_cancellation else -1)
+            rows['sale'].append(sale if keep_sale else -1)
+
+    listings = listings.take(rows['listing']).reset_index(drop=True)
+    listings['update_tx_hash'] = take_or_null(updates['hash'], rows['update'])
+    listings['updated_at'] = take_or_null(updates['datetime'], rows['update'])
+    listings['cancellation_tx_hash'] = take_or_null(cancellations['hash'], rows['cancellation'])
+    listings['cancelled_at'] = take_or_null(cancellations['datetime'], rows['cancellation'])
+    listings['final_sale_tx_hash'] = take_or_null(sales['final_sale_tx_hash'], rows['sale'])
+    listings['sold_at'] = take_or_null(sales['sold_at'], rows['sale'])
+
+    listings.rename(columns={
+        'hash':'tx_hash',
+        'datetime':'listed_at',
+        'expiration_datetime':'expires_at',
+        'from':'wallet_seller'
+    }, inplace=True)
+    listings['listing_price_magic'] = listings['listing_price_magic'].apply(lambda x: round(x,2))
+
+    return listings.loc[:,cols_to_load + list(keep_cols)].copy()
+
+def before(block, other_block, or_equal=False):
+    if block is None or other_block is None:
+        return False
+    return block <= other_block if or_equal else block < other_block
+
+def take_or_null(values, positions):
+    return values.reset_index(drop=True).reindex(positions).array
+
+# The merge cascade the sweep replaces. Kept as the reference implementation
+# for check_listing_lifecycles.
+def merge_listing_lifecycles(marketplace_txs, sales):
+    listings_og = marketplace_txs.loc[marketplace_txs['tx_type'].isin(LISTING_TX_TYPES)].copy()
+    listings=listings_og.copy()
+
+    # join updates
+    updates = listings.loc[listings['tx_type']=='updateListing',['hash','datetime','blockNumber'] + listings_merge_keys].copy()
+    updates.rename(columns={
+        'hash':'update_tx_hash',
+        'datetime':'updated_at',
+        'blockNumber':'update_blockNumber'
+    }, inplace=True)
+    listings_updates = listings.merge(updates, how='left', on=listings_merge_keys)
+    listings_updates = listings_updates.loc[listings_updates['blockNumber']<listings_updates['update_blockNumber']]
+    most_recent_updates = listings_updates.groupby('hash',as_index=False).agg({'update_blockNumber':'min'})
+    listings_updates = listings_updates.merge(most_recent_updates, how='inner',on=['hash','update_blockNumber'])
+    dupe_cols_to_drop = list(listings_updates.columns)
+    dupe_cols_to_drop.remove('update_tx_hash')
+    listings_updates.drop_duplicates(dupe_cols_to_drop,inplace=True)
+    listings = listings.merge(listings_updates, how='left', on=list(listings_og.columns))
+
+    # Cancellations
+    cancellations = marketplace_txs.loc[marketplace_txs['tx_type'].isin(['cancelListing'])].copy()
+    cancellations = cancellations.loc[:,['hash','datetime','blockNumber'] + listings_merge_keys].copy()
+    cancellations.rename(columns={
+        'hash':'cancellation_tx_hash',
+        'datetime':'cancelled_at',
+        'blockNumber':'cancellation_blockNumber'
+    }, inplace=True)
+    listings_cancellations = listings_og.merge(cancellations, how='left', on=listings_merge_keys)
+    listings_cancellations = listings_cancellations.loc[listings_cancellations['blockNumber']<=listings_cancellations['cancellation_blockNumber']] # less than or equal to to account for times when the tx is updated then immediately cancelled
+    most_recent_cancellation = listings_cancellations.groupby('hash',as_index=False).agg({'cancellation_blockNumber':'min'})
+    listings_cancellations = listings_cancellations.merge(most_recent_cancellation, how='inner',on=['hash','cancellation_blockNumber'])
+    listings = listings.merge(listings_cancellations, how='left', on=list(listings_og.columns))
+    # handle cases where there is both an update and a cancellation
+    listings.loc[listings.cancellation_blockNumber >= listings.update_blockNumber, ['cancellation_tx_hash', 'cancelled_at']] = np.nan
+    listings.loc[listings.cancellation_blockNumber < listings.update_blockNumber, ['update_tx_hash', 'updated_at']] = np.nan
+
+    # Sales
+    listings_sales = listings_og.merge(sales, how='left', left_on=listings_merge_keys, right_on=sales_table_merge_keys)
+    listings_sales = listings_sales.loc[listings_sales['blockNumber']<=listings_sales['sale_blockNumber']]
+    listings_sales.sort_values(['hash','sold_at'],inplace=True)
+    listings_sales['cum_quantity_sold'] = listings_sales.groupby('hash').quantity_sold.cumsum()
+    listings_sales = listings_sales.loc[listings_sales['quantity']==listings_sales['cum_quantity_sold']]
+    listings = listings.merge(listings_sales, how='left', on=list(listings_og.columns))
+    # handle cases where there is any two of an update, a cancellation, or a listing
+    listings.loc[listings.cancellation_blockNumber > listings.sale_blockNumber, ['cancellation_tx_hash', 'cancelled_at']] = np.nan
+    listings.loc[listings.cancellation_blockNumber < listings.sale_blockNumber, ['final_sale_tx_hash','sold_at','quantity_sold']] = np.nan
+    listings.loc[listings.update_blockNumber > listings.sale_blockNumber, ['update_tx_hash', 'updated_at']] = np.nan
+    listings.loc[listings.update_blockNumber <= listings.sale_blockNumber, ['final_sale_tx_hash','sold_at','quantity_sold']] = np.nan
+
+    listings.drop('wallet_seller',axis=1,inplace=True)
+    listings.rename(columns={
+        'hash':'tx_hash',
+        'datetime':'listed_at',
+        'expiration_datetime':'expires_at',
+        'from':'wallet_seller'
+    }, inplace=True)
+    listings['listing_price_magic'] = listings['listing_price_magic'].apply(lambda x: round(x,2))
+
+    return listings.loc[:,cols_to_load].copy()
+
+def check_listing_lifecycles(marketplace_txs, sales):
+    # regression check: the sweep must reproduce the merge cascade row for row,
+    # run by checks/check_listing_lifecycles.py
+    swept = sweep_listing_lifecycles(marketplace_txs, sales).reset_index(drop=True)
+    merged = merge_listing_lifecycles(marketplace_txs, sales).reset_index(drop=True)
+    pd.testing.assert_frame_equal(swept, merged, check_dtype=False)
+    return swept
@@ -0,0 +1,77 @@
+# In this file we mimic the small part of the boto3 Bucket API the pipeline
+# uses, backed by a local directory. It lets the S3 reading and writing code
+# run offline, e.g. against a copy of the treasure-marketplace-db bucket.
+
+import datetime as dt
+import hashlib
+import io
+import os
+import shutil
+
+class LocalObject:
+    def __init__(self, root, key):
+        self.root = root
+        self.key = key
+        self.path = os.path.join(root, *key.split('/'))
+
+    @property
+    def last_modified(self):
+        return dt.datetime.fromtimestamp(os.path.getmtime(self.path), dt.timezone.utc)
+
+    @property
+    def size(self):
+        return os.path.getsize(self.path)
+
+    @property
+    def e_tag(self):
+        with open(self.path, 'rb') as f:
+            return '"{}"'.format(hashlib.md5(f.read()).hexdigest())
+
+    def get(self):
+        if not os.path.exists(self.path):
+            raise FileNotFoundError(self.key)
+        with open(self.path, 'rb') as f:
+            body = f.read()
+        return {'Body': io.BytesIO(body), 'ETag': '"{}"'.format(hashlib.md5(body).hexdigest()), 'ContentLength': len(body)}
+
+    def put(self, Body):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if isinstance(Body, str):
+            Body = Body.encode()
+        with open(self.path + '.tmp', 'wb') as f:
+            f.write(Body if isinstance(Body, bytes) else Body.read())
+        os.replace(self.path + '.tmp', self.path)
+
+    def upload_file(self, filename):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        shutil.copyfile(filename, self.path)
+
+    def download_file(self, filename):
+        shutil.copyfile(self.path, filename)
+
+class LocalObjects:
+    def __init__(self, root):
+        self.root = root
+
+    def all(self):
+        return self.filter(Prefix='')
+
+    def filter(self, Prefix=''):
+        objs = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.endswith('.tmp'):
+                    continue
+                key = os.path.relpath(os.path.join(dirpath, filename), self.root).replace(os.sep, '/')
+                if key.startswith(Prefix):
+                    objs.append(LocalObject(self.root, key))
+        return sorted(objs, key=lambda obj: obj.key)
+
+class LocalBucket:
+    def __init__(self, root):
+        self.name = os.path.basename(os.path.abspath(root))
+        self.root = root
+        self.objects = LocalObjects(root)
+
+    def Object(self, key):
+        return LocalObject(self.root, key)
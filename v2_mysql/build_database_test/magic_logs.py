@@ -0,0 +1,126 @@
+# In this file we pull the MAGIC transfers of a batch of marketplace sales from
+# the token's Transfer event logs. The tokentx way asks for every buyer's whole
+# MAGIC history since the watermark, one call per wallet, and throws away all
+# but the sales. Here we page through getLogs for the MAGIC Transfer events
+# of the batch's blocks instead, 1,000 logs a call no matter how many buyers
+# there are, and keep the logs of the buys' tx hashes.
+#
+# Buy blocks less than MAGIC_LOGS_MAX_GAP blocks apart are asked for as one
+# range, so a busy batch is a single range, while a long quiet stretch between
+# two buys (full of DEX and bridge transfers on mainnet) is skipped. The API
+# serves at most 10,000 logs of a query however it's paged, so a range that
+# reaches that carries on from the block of its last log.
+#
+# Only transfers to or from the buyer are kept, the same ones the buyer's
+# tokentx history has for the tx, so the sales come out the same either way.
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import requests
+
+from arbiscan import ARBISCAN_API_URL, ARBISCAN_CALLS_PER_SECOND, ARBISCAN_MAX_WORKERS, TokenBucket, get_result
+
+# keccak256('Transfer(address,address,uint256)')
+TRANSFER_TOPIC = '0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef'
+LOGS_PAGE_SIZE = 1000
+# page * offset of a getLogs query can't go past this
+LOGS_MAX_RESULTS = 10000
+# buy blocks at most this far apart are fetched as one range
+MAGIC_LOGS_MAX_GAP = int(os.environ.get('MAGIC_LOGS_MAX_GAP', 2000))
+
+transfer_columns = ['blockNumber', 'timeStamp', 'hash', 'logIndex', 'from', 'contractAddress', 'to', 'value']
+
+def logs_url(arbiscan_api_key, address, from_block, to_block, page=1, offset=LOGS_PAGE_SIZE, topic0=TRANSFER_TOPIC):
+    request_url = ARBISCAN_API_URL
+    request_url = request_url + "?module=logs"
+    request_url = request_url + "&action=getLogs"
+    request_url = request_url + "&address=" + address
+    request_url = request_url + "&fromBlock=" + str(from_block)
+    request_url = request_url + "&toBlock=" + str(to_block)
+    request_url = request_url + "&topic0=" + topic0
+    request_url = request_url + "&page=" + str(page)
+    request_url = request_url + "&offset=" + str(offset)
+    request_url = request_url + "&apikey=" + arbiscan_api_key
+    return request_url
+
+def get_logs_page(arbiscan_api_key, token_address, block_range, page, rate_limiter, session):
+    request_url = logs_url(arbiscan_api_key, token_address, block_range[0], block_range[1], page=page)
+    return get_result(request_url, rate_limiter, session, 'arbiscan getLogs for blocks {}-{}'.format(block_range[0], block_range[1]))
+
+def get_log_range(arbiscan_api_key, token_address, block_range, rate_limiter, session):
+    # pages through the range until a page comes back short. At the result
+    # cap the logs of the last block seen may be cut off, so they're dropped
+    # and the range carries on from that block
+    from_block, to_block = block_range
+    logs = []
+    while True:
+        range_logs = []
+        for page in range(1, LOGS_MAX_RESULTS // LOGS_PAGE_SIZE + 1):
+            page_logs = get_logs_page(arbiscan_api_key, token_address, (from_block, to_block), page, rate_limiter, session)
+            range_logs.extend(page_logs)
+            if len(page_logs) < LOGS_PAGE_SIZE:
+                return logs + range_logs
+        last_block = int(range_logs[-1]['blockNumber'], 16)
+        if last_block == from_block:
+            print('block {} has more than {} MAGIC transfers, some may be missing'.format(from_block, LOGS_MAX_RESULTS))
+            return logs + range_logs
+        logs.extend(log for log in range_logs if int(log['blockNumber'], 16) < last_block)
+        from_block = last_block
+
+def block_ranges(block_numbers, max_gap=MAGIC_LOGS_MAX_GAP):
+    # the blocks as (first, last) ranges, joining blocks at most max_gap apart
+    ranges = []
+    for block in sorted(set(int(block) for block in block_numbers)):
+        if ranges and block - ranges[-1][1] <= max_gap:
+            ranges[-1][1] = block
+        else:
+            ranges.append([block, block])
+    return [(first, last) for first, last in ranges]
+
+def crawl_transfer_logs(arbiscan_api_key, token_address, block_ranges, max_workers=ARBISCAN_MAX_WORKERS, calls_per_second=ARBISCAN_CALLS_PER_SECOND):
+    rate_limiter = TokenBucket(calls_per_second, 1)
+    session = requests.Session()
+    session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=max_workers))
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=max_workers))
+    # ranges in parallel, each one paged through in order
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        range_logs = list(executor.map(lambda block_range: get_log_range(arbiscan_api_key, token_address, block_range, rate_limiter, session), block_ranges))
+    session.close()
+    return [log for logs in range_logs for log in logs]
+
+def topic_address(topic):
+    # indexed addresses are left padded to 32 bytes
+    return '0x' + topic[-40:].lower()
+
+def logs_to_transfers(logs):
+    # Transfer logs as tokentx-like rows, numbers as decimal strings
+    logs = [log for log in logs if len(log['topics']) == 3 and log['topics'][0].lower() == TRANSFER_TOPIC]
+    if not logs:
+        return pd.DataFrame(columns=transfer_columns)
+    return pd.DataFrame({
+        'blockNumber': [str(int(log['blockNumber'], 16)) for log in logs],
+        'timeStamp': [str(int(log['timeStamp'], 16)) for log in logs],
+        'hash': [log['transactionHash'].lower() for log in logs],
+        'logIndex': [str(int(log['logIndex'], 16)) if log.get('logIndex') not in (None, '0x') else '0' for log in logs],
+        'from': [topic_address(log['topics'][1]) for log in logs],
+        'contractAddress': [log['address'].lower() for log in logs],
+        'to': [topic_address(log['topics'][2]) for log in logs],
+        # wei amounts overflow int64, keep them exact as text
+        'value': [str(int(log['data'], 16)) if log['data'] not in ('', '0x') else '0' for log in logs],
+    }, columns=transfer_columns)
+
+def get_sale_transfers(arbiscan_api_key, token_address, marketplace_buys, max_workers=ARBISCAN_MAX_WORKERS, calls_per_second=ARBISCAN_CALLS_PER_SECOND):
+    # the MAGIC transfers of the given buyItem txs (raw txlist rows)
+    if marketplace_buys.empty:
+        return pd.DataFrame(columns=transfer_columns)
+    ranges = block_ranges(marketplace_buys['blockNumber'].astype('int64'))
+    logs = crawl_transfer_logs(arbiscan_api_key, token_address, ranges, max_workers, calls_per_second)
+    transfers = logs_to_transfers(logs)
+
+    buyers = pd.Series(marketplace_buys['from'].str.lower().values, index=marketplace_buys['hash'].str.lower().values)
+    buyers = buyers.loc[~buyers.index.duplicated()]
+    buyer = transfers['hash'].map(buyers)
+    transfers = transfers.loc[buyer.notnull() & ((transfers['from'] == buyer) | (transfers['to'] == buyer))]
+    return transfers.drop_duplicates(["hash", "value"]).reset_index(drop=True)
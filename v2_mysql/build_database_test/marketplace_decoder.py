@@ -0,0 +1,88 @@
+# In this file we decode the calldata of marketplace txs for all rows at once.
+# Every field we care about sits at a fixed offset in the hex `input` string,
+# so we lay the inputs out as a (rows x chars) byte matrix and slice columns
+# out of it instead of calling int(x[a:b], 16) once per row.
+
+import numpy as np
+import pandas as pd
+
+# widest offset read by any tx type (expiration word of create/updateListing)
+CALLDATA_WIDTH = 330
+
+LISTING_TX_TYPES = ['createListing', 'updateListing']
+
+# ascii code -> nibble value, anything that isn't a hex digit decodes to 0
+HEX_LOOKUP = np.zeros(256, dtype=np.int64)
+for i, c in enumerate('0123456789abcdef'):
+    HEX_LOOKUP[ord(c)] = i
+    HEX_LOOKUP[ord(c.upper())] = i
+
+# 15 hex digits = 60 bits, the most we can accumulate safely in an int64
+MAX_INT_DIGITS = 15
+
+def calldata_to_matrix(inputs, width=CALLDATA_WIDTH):
+    # fixed-width bytes truncate longer inputs and zero-pad shorter ones
+    inputs = np.asarray(inputs, dtype='S{}'.format(width))
+    return inputs.view(np.uint8).reshape(len(inputs), width)
+
+def hex_slice_to_int(calldata, start, stop):
+    if stop - start > MAX_INT_DIGITS:
+        raise ValueError('cannot decode {} hex digits into int64'.format(stop - start))
+    nibbles = HEX_LOOKUP[calldata[:, start:stop]]
+    weights = np.int64(16) ** np.arange(stop - start - 1, -1, -1, dtype=np.int64)
+    return nibbles @ weights
+
+def hex_slice_to_float(calldata, start, stop):
+    # accumulate 13-digit (52-bit) chunks so every partial sum is exact and
+    # the result is rounded only once, the same as float(int(x, 16))
+    value = np.zeros(len(calldata), dtype='float64')
+    for chunk_start in range(start, stop, 13):
+        chunk_stop = min(chunk_start + 13, stop)
+        value = value * float(16 ** (chunk_stop - chunk_start)) + hex_slice_to_int(calldata, chunk_start, chunk_stop)
+    return value
+
+def hex_slice_to_str(calldata, start, stop):
+    chars = np.ascontiguousarray(calldata[:, start:stop])
+    return chars.view('S{}'.format(stop - start)).ravel().astype(str).astype(object)
+
+def map_values(values, mapping, keep_unmatched=False):
+    # there are only a handful of distinct method ids / collections per batch,
+    # so look each one up once and broadcast back
+    uniques, inverse = np.unique(values, return_inverse=True)
+    mapped = np.array([mapping.get(x, x if keep_unmatched else np.nan) for x in uniques], dtype=object)
+    return mapped[inverse]
+
+def decode_marketplace_calldata(inputs, method_ids, contract_addresses):
+    inputs = np.asarray(inputs, dtype=object)
+    calldata = calldata_to_matrix(inputs)
+    n_rows = len(inputs)
+
+    decoded = {
+        'tx_type': map_values(hex_slice_to_str(calldata, 0, 10), method_ids),
+        'nft_collection': map_values(hex_slice_to_str(calldata, 33, 74), contract_addresses, keep_unmatched=True),
+        'nft_id': hex_slice_to_int(calldata, 133, 138),
+        'to': '0x' + hex_slice_to_str(calldata, 162, 202),
+        'quantity': np.full(n_rows, np.nan),
+        'listing_price_magic': np.full(n_rows, np.nan),
+        'expiration_ms': np.full(n_rows, -1, dtype=np.int64),
+    }
+
+    tx_types = pd.Series(decoded['tx_type'])
+    is_listing = tx_types.isin(LISTING_TX_TYPES).values
+    is_buy = (tx_types == 'buyItem').values
+    listing_calldata = calldata[is_listing]
+    decoded['quantity'][is_listing] = hex_slice_to_int(listing_calldata, 198, 202)
+    decoded['quantity'][is_buy] = hex_slice_to_int(calldata[is_buy], 262, 266)
+    decoded['listing_price_magic'][is_listing] = hex_slice_to_float(listing_calldata, 240, 266) * 1e-18
+    # expiries are unix ms, so anything using the top 5 of the 20 digits is bogus
+    expiration_ms = hex_slice_to_int(listing_calldata, 315, 330)
+    expiration_ms[hex_slice_to_int(listing_calldata, 310, 315) != 0] = -1
+    decoded['expiration_ms'][is_listing] = expiration_ms
+
+    return decoded
+
+def timestamps_to_datetimes(timestamps, unit='s'):
+    # negative entries mark missing values, out of range ones (e.g. uint max
+    # expiries) come back as NaT instead of raising
+    timestamps = pd.Series(np.asarray(timestamps, dtype=np.int64))
+    return pd.to_datetime(timestamps.where(timestamps >= 0), unit=unit, utc=True, errors='coerce').array
@@ -0,0 +1,58 @@
+# In this file we fix the wallet_seller of the sales written before the
+# buyItem decoding was corrected (marketplace_decoder.py read the owner from
+# chars 162:212 of the input rather than 162:202). Those rows hold the
+# address followed by 10 hex chars of the quantity word, 52 chars instead of
+# 42, so they never match the seller of a listing. The address is the first
+# 42 chars, so the rows are rewritten in place. It only touches the 52 char
+# values, so running it again does nothing. A keyed marketplace_sales (see
+# binary_keys.py) can't hold them: its wallets are 20 byte addresses.
+#
+# The listings those sales should have filled are still open in
+# marketplace_listings. Rebuild it afterwards (rebuild_db.py) to close them.
+#
+# usage: python normalize_wallet_sellers.py [--dry-run]
+
+import json
+import os
+import sys
+
+from sqlalchemy import create_engine, text
+
+from binary_keys import is_swapped
+
+SALES_TABLE = 'marketplace_sales'
+ADDRESS_LENGTH = 42
+# '0x', the 20 address bytes and 5 bytes of the quantity word
+MISDECODED_LENGTH = 52
+
+def normalize_wallet_sellers(connection, dry_run=False):
+    if is_swapped(connection, SALES_TABLE):
+        print('{} is keyed, its wallets are all {} char addresses'.format(SALES_TABLE, ADDRESS_LENGTH))
+        return 0
+    n_rows = connection.execute(
+        text('SELECT COUNT(*) FROM {} WHERE LENGTH(wallet_seller) = :length'.format(SALES_TABLE)),
+        {'length': MISDECODED_LENGTH}
+    ).scalar()
+    if n_rows and not dry_run:
+        with connection.begin():
+            connection.execute(
+                text('UPDATE {} SET wallet_seller = SUBSTR(wallet_seller, 1, :address_length) WHERE LENGTH(wallet_seller) = :length'.format(SALES_TABLE)),
+                {'address_length': ADDRESS_LENGTH, 'length': MISDECODED_LENGTH}
+            )
+    print('{}: {} wallet_seller values {}'.format(SALES_TABLE, n_rows, 'to fix' if dry_run else 'fixed'))
+    return n_rows
+
+if __name__ == '__main__':
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "constants", "mysql_credential.json")) as f:
+        mysql_credentials = json.loads(f.read())
+    engine = create_engine(
+        "mysql+pymysql://{user}:{pw}@{host}/{db}".format(
+        user=mysql_credentials['username'],
+        pw=mysql_credentials['pw'],
+        host=mysql_credentials['host'],
+        db="treasure"
+        )
+    )
+    with engine.connect() as connection:
+        normalize_wallet_sellers(connection, dry_run='--dry-run' in sys.argv[1:])
+    engine.dispose()
@@ -0,0 +1,372 @@
+# In this file we keep an order book of active listings so floor prices don't
+# need the floor_prices view, which scans all of marketplace_listings on every
+# query. Each (nft_collection, nft_subcategory) has a min-heap of asks keyed by
+# price. Listings are identified like in listing_lifecycle.py, by seller,
+# collection and token id. An update, cancellation, sale or expiry doesn't
+# search the heap: the listing is dropped from (or replaced in) the active
+# dict and its heap entry is skipped the next time it reaches the top (lazy
+# deletion). Expiries come off a separate heap ordered by expiry time.
+#
+# The book is kept in the order_book_listings table, one row per active
+# listing with what's left of it, along with the (last_block,
+# boundary_tx_hashes) watermark of the txs it has applied in
+# order_book_progress. Each refresh loads it, applies only the batch's txs
+# past that watermark (a rerun batch isn't applied twice), and writes back
+# just the listings that changed. It's built from the open rows of
+# marketplace_listings (read_active_listings, which scans the whole table
+# and joins the sales) only the first time. The floors are written to the
+# small floor_prices_current table.
+
+import heapq
+import itertools
+import json
+
+import pandas as pd
+from sqlalchemy import inspect, text
+
+from binary_keys import from_keyed_frame, is_swapped, keyed_tables, stored_column
+from incremental_listings import to_sql_value
+
+FLOOR_PRICES_TABLE = 'floor_prices_current'
+ORDER_BOOK_TABLE = 'order_book_listings'
+ORDER_BOOK_PROGRESS_TABLE = 'order_book_progress'
+
+order_book_cols = ['tx_hash', 'wallet_seller', 'nft_collection', 'nft_id', 'nft_subcategory', 'listing_price_magic', 'quantity', 'expires_at']
+
+# order events are applied in within a block: marketplace_listings treats a
+# cancellation or sale as ending a listing made in the same block
+event_order = {
+    'createListing': 0,
+    'updateListing': 1,
+    'cancelListing': 2,
+    'buyItem': 3,
+}
+
+def utc_timestamp(value):
+    if value is None or pd.isnull(value):
+        return None
+    value = pd.Timestamp(value)
+    return value.tz_localize('UTC') if value.tzinfo is None else value.tz_convert('UTC')
+
+def group_key(nft_collection, nft_subcategory):
+    return (nft_collection, None if pd.isnull(nft_subcategory) else nft_subcategory)
+
+class Listing:
+    __slots__ = ['key', 'group', 'tx_hash', 'price', 'quantity', 'expires_at', 'seq']
+
+    def __init__(self, key, group, tx_hash, price, quantity, expires_at, seq):
+        self.key = key
+        self.group = group
+        self.tx_hash = tx_hash
+        self.price = price
+        self.quantity = quantity
+        self.expires_at = expires_at
+        self.seq = seq
+
+class OrderBook:
+    def __init__(self):
+        self.asks = {} # group -> heap of (price, seq, key)
+        self.expiries = [] # heap of (expires_at, seq, key)
+        self.active = {} # key -> Listing
+        self.depth_counts = {} # group -> [n listings, total quantity]
+        self.changed = set() # keys added, filled or removed since the book was built
+        self.seq = itertools.count()
+
+    @classmethod
+    def from_listings(cls, listings, as_of=None):
+        # listings: open marketplace_listings rows (see read_active_listings)
+        book = cls()
+        for row in listings.itertuples(index=False):
+            book.add_listing(
+                row.wallet_seller, row.nft_collection, row.nft_id, row.nft_subcategory,
+                row.tx_hash, row.listing_price_magic, row.quantity, row.expires_at
+            )
+        book.changed.clear()
+        book.expire(as_of)
+        return book
+
+    def _add_depth(self, group, n, quantity):
+        counts = self.depth_counts.setdefault(group, [0, 0])
+        counts[0] += n
+        counts[1] += quantity
+        if counts[0] == 0:
+            del self.depth_counts[group]
+
+    def _remove(self, key):
+        listing = self.active.pop(key, None)
+        if listing is not None:
+            self._add_depth(listing.group, -1, -listing.quantity)
+            self.changed.add(key)
+        return listing
+
+    def add_listing(self, wallet_seller, nft_collection, nft_id, nft_subcategory, tx_hash, price, quantity, expires_at):
+        # a new listing replaces whatever the seller had up for the same token,
+        # prices are rounded to 2 decimals like in marketplace_listings
+        key = (wallet_seller, nft_collection, nft_id)
+        self._remove(key)
+        listing = Listing(key, group_key(nft_collection, nft_subcategory), tx_hash, round(float(price), 2), int(quantity), utc_timestamp(expires_at), next(self.seq))
+        self.active[key] = listing
+        self.changed.add(key)
+        self._add_depth(listing.group, 1, listing.quantity)
+        heapq.heappush(self.asks.setdefault(listing.group, []), (listing.price, listing.seq, key))
+        if listing.expires_at is not None:
+            heapq.heappush(self.expiries, (listing.expires_at, listing.seq, key))
+        return listing
+
+    def cancel(self, wallet_seller, nft_collection, nft_id):
+        return self._remove((wallet_seller, nft_collection, nft_id))
+
+    def sell(self, wallet_seller, nft_collection, nft_id, quantity):
+        # partial fills keep the listing up with what's left
+        key = (wallet_seller, nft_collection, nft_id)
+        listing = self.active.get(key)
+        if listing is None:
+            return None
+        sold = min(int(quantity), listing.quantity)
+        listing.quantity -= sold
+        self.changed.add(key)
+        self._add_depth(listing.group, 0, -sold)
+        if listing.quantity <= 0:
+            self._remove(key)
+        return listing
+
+    def expire(self, as_of=None):
+        as_of = utc_timestamp(as_of) if as_of is not None else pd.Timestamp.now(tz='UTC')
+        n_expired = 0
+        while self.expiries and self.expiries[0][0] <= as_of:
+            _, seq, key = heapq.heappop(self.expiries)
+            listing = self.active.get(key)
+            if listing is not None and listing.seq == seq:
+                self._remove(key)
+                n_expired += 1
+        return n_expired
+
+    def _is_live(self, entry):
+        listing = self.active.get(entry[2])
+        return listing is not None and listing.seq == entry[1]
+
+    def _clean_top(self, heap):
+        while heap and not self._is_live(heap[0]):
+            heapq.heappop(heap)
+
+    def floor(self, nft_collection, nft_subcategory=None, as_of=None):
+        self.expire(as_of)
+        heap = self.asks.get(group_key(nft_collection, nft_subcategory), [])
+        self._clean_top(heap)
+        return heap[0][0] if heap else None
+
+    def top_asks(self, nft_collection, nft_subcategory=None, n=10, as_of=None):
+        # pops the n best live entries and pushes them back, O(n log size)
+        self.expire(as_of)
+        heap = self.asks.get(group_key(nft_collection, nft_subcategory), [])
+        popped = []
+        while heap and len(popped) < n:
+            entry = heapq.heappop(heap)
+            if self._is_live(entry):
+                popped.append(entry)
+        for entry in popped:
+            heapq.heappush(heap, entry)
+        return [self.active[entry[2]] for entry in popped]
+
+    def depth(self, nft_collection, nft_subcategory=None, as_of=None):
+        # number of live listings and the quantity they offer
+        self.expire(as_of)
+        n_listings, quantity = self.depth_counts.get(group_key(nft_collection, nft_subcategory), [0, 0])
+        return {'n_listings': n_listings, 'quantity': quantity}
+
+    def groups(self):
+        return list(self.depth_counts)
+
+    def apply_marketplace_txs(self, marketplace_txs):
+        # marketplace_txs as returned by process_marketplace_txs
+        events = marketplace_txs.loc[marketplace_txs['tx_type'].isin(list(event_order))].copy()
+        events['event_order'] = events['tx_type'].map(event_order)
+        events = events.sort_values(['blockNumber', 'event_order'], kind='mergesort')
+        for row in events.to_dict('records'):
+            if row['tx_type'] == 'cancelListing':
+                self.cancel(row['from'], row['nft_collection'], row['nft_id'])
+            elif row['tx_type'] == 'buyItem':
+                # for a buy, 'to' is the seller whose listing gets filled
+                self.sell(row['to'], row['nft_collection'], row['nft_id'], row['quantity'])
+            else:
+                self.add_listing(
+                    row['from'], row['nft_collection'], row['nft_id'], row['nft_subcategory'],
+                    row['hash'], row['listing_price_magic'], row['quantity'], row['expiration_datetime']
+                )
+
+    def floor_prices(self, as_of=None):
+        as_of = utc_timestamp(as_of) if as_of is not None else pd.Timestamp.now(tz='UTC')
+        rows = []
+        for nft_collection, nft_subcategory in self.groups():
+            floor_price = self.floor(nft_collection, nft_subcategory, as_of)
+            if floor_price is None:
+                continue
+            depth = self.depth(nft_collection, nft_subcategory, as_of)
+            rows.append({
+                'nft_collection': nft_collection,
+                'nft_subcategory': nft_subcategory,
+                'floor_price': floor_price,
+                'n_listings': depth['n_listings'],
+                'quantity': depth['quantity'],
+                'updated_at': as_of.tz_localize(None).to_pydatetime()
+            })
+        return pd.DataFrame(rows, columns=['nft_collection', 'nft_subcategory', 'floor_price', 'n_listings', 'quantity', 'updated_at'])
+
+def read_active_listings(connection, as_of=None):
+    # open listings with what's left of them after partial fills, counted the
+    # same way as incremental_listings.quantity_sold_before
+    as_of = utc_timestamp(as_of) if as_of is not None else pd.Timestamp.now(tz='UTC')
+    # joined on the keyed tables' wallet ids once they're swapped, the hex
+    # views would join on computed strings
+    keyed = is_swapped(connection, 'marketplace_listings') and is_swapped(connection, 'marketplace_sales')
+    tables = {table: keyed_tables[table]['keyed_table'] if keyed else table for table in ['marketplace_listings', 'marketplace_sales']}
+    wallet_seller = stored_column('wallet_seller') if keyed else 'wallet_seller'
+    query = text("""
+        SELECT
+            l.tx_hash, l.{wallet_seller}, l.nft_collection, l.nft_id, l.nft_subcategory, l.listing_price_magic, l.expires_at,
+            l.quantity - COALESCE(SUM(s.quantity), 0) AS quantity
+        FROM {listings} l
+        LEFT JOIN {sales} s
+            ON s.{wallet_seller} = l.{wallet_seller}
+            AND s.nft_collection = l.nft_collection
+            AND s.nft_id = l.nft_id
+            AND s.datetime >= l.listed_at
+        WHERE l.update_tx_hash IS NULL
+        AND l.cancellation_tx_hash IS NULL
+        AND l.final_sale_tx_hash IS NULL
+        AND (l.expires_at IS NULL OR l.expires_at > :as_of)
+        GROUP BY l.tx_hash, l.{wallet_seller}, l.nft_collection, l.nft_id, l.nft_subcategory, l.listing_price_magic, l.expires_at, l.quantity
+        HAVING l.quantity - COALESCE(SUM(s.quantity), 0) > 0
+    """.format(wallet_seller=wallet_seller, listings=tables['marketplace_listings'], sales=tables['marketplace_sales']))
+    listings = pd.read_sql(query, connection, params={'as_of': str(as_of.tz_localize(None))})
+    return from_keyed_frame(connection, listings) if keyed else listings
+
+def create_order_book_tables(connection):
+    connection.execute(text("""
+        CREATE TABLE IF NOT EXISTS {} (
+            tx_hash VARCHAR(255),
+            wallet_seller VARCHAR(255) NOT NULL,
+            nft_collection VARCHAR(255) NOT NULL,
+            nft_id BIGINT NOT NULL,
+            nft_subcategory VARCHAR(255),
+            listing_price_magic DOUBLE,
+            quantity BIGINT,
+            expires_at DATETIME,
+            PRIMARY KEY (wallet_seller, nft_collection, nft_id)
+        )
+    """.format(ORDER_BOOK_TABLE)))
+    connection.execute(text('CREATE TABLE IF NOT EXISTS {} (last_block BIGINT NOT NULL, boundary_tx_hashes TEXT NOT NULL)'.format(ORDER_BOOK_PROGRESS_TABLE)))
+
+def read_order_book_progress(connection):
+    row = connection.execute(text('SELECT last_block, boundary_tx_hashes FROM {}'.format(ORDER_BOOK_PROGRESS_TABLE))).fetchone()
+    if row is None:
+        return None
+    return {'last_block': int(row[0]), 'boundary_tx_hashes': json.loads(row[1])}
+
+def read_order_book(connection, watermark, as_of=None):
+    # the stored book and the watermark of the txs it has applied; the first
+    # time it's built from marketplace_listings, which is as of watermark
+    inspector = inspect(connection)
+    if inspector.has_table(ORDER_BOOK_TABLE) and inspector.has_table(ORDER_BOOK_PROGRESS_TABLE):
+        progress = read_order_book_progress(connection)
+        if progress is not None:
+            listings = pd.read_sql(text('SELECT {} FROM {}'.format(', '.join(order_book_cols), ORDER_BOOK_TABLE)), connection)
+            return OrderBook.from_listings(listings, as_of), progress
+    book = OrderBook.from_listings(read_active_listings(connection, as_of), as_of)
+    # written out in full on the first write_order_book
+    book.changed = set(book.active)
+    return book, watermark
+
+def unapplied_txs(marketplace_txs, progress):
+    # the txs past the (last_block, boundary_tx_hashes) the book has applied
+    if progress is None or marketplace_txs.empty:
+        return marketplace_txs
+    block_numbers = marketplace_txs['blockNumber'].astype('int64')
+    is_new = (block_numbers > progress['last_block']) | (
+        (block_numbers == progress['last_block']) & ~marketplace_txs['hash'].isin(progress['boundary_tx_hashes'])
+    )
+    return marketplace_txs.loc[is_new.values]
+
+def reset_order_book(connection):
+    # after marketplace_listings is rebuilt, the next read_order_book builds
+    # the book from it again
+    for table in [ORDER_BOOK_TABLE, ORDER_BOOK_PROGRESS_TABLE]:
+        if inspect(connection).has_table(table):
+            connection.execute(text('DELETE FROM {}'.format(table)))
+
+def write_order_book(connection, book, progress, as_of=None):
+    # replaces the rows of the listings that changed, in one transaction with
+    # the watermark of the txs applied
+    book.expire(as_of)
+    rows = []
+    for key in book.changed:
+        listing = book.active.get(key)
+        if listing is not None:
+            rows.append({
+                'tx_hash': listing.tx_hash,
+                'wallet_seller': key[0],
+                'nft_collection': key[1],
+                'nft_id': key[2],
+                'nft_subcategory': listing.group[1],
+                'listing_price_magic': listing.price,
+                'quantity': listing.quantity,
+                'expires_at': listing.expires_at,
+            })
+    keys = [{'wallet_seller': wallet_seller, 'nft_collection': nft_collection, 'nft_id': nft_id} for wallet_seller, nft_collection, nft_id in book.changed]
+    transaction = connection.begin() if not connection.in_transaction() else None
+    try:
+        create_order_book_tables(connection)
+        if keys:
+            connection.execute(
+                text('DELETE FROM {} WHERE wallet_seller = :wallet_seller AND nft_collection = :nft_collection AND nft_id = :nft_id'.format(ORDER_BOOK_TABLE)),
+                [{col: to_sql_value(value) for col, value in key.items()} for key in keys]
+            )
+        if rows:
+            connection.execute(
+                text('INSERT INTO {} ({}) VALUES ({})'.format(ORDER_BOOK_TABLE, ', '.join(order_book_cols), ', '.join(':{}'.format(col) for col in order_book_cols))),
+                [{col: to_sql_value(value) for col, value in row.items()} for row in rows]
+            )
+        connection.execute(text('DELETE FROM {}'.format(ORDER_BOOK_PROGRESS_TABLE)))
+        if progress is not None:
+            connection.execute(
+                text('INSERT INTO {} (last_block, boundary_tx_hashes) VALUES (:last_block, :boundary_tx_hashes)'.format(ORDER_BOOK_PROGRESS_TABLE)),
+                {'last_block': int(progress['last_block']), 'boundary_tx_hashes': json.dumps(list(progress['boundary_tx_hashes']))}
+            )
+    except Exception:
+        if transaction is not None:
+            transaction.rollback()
+        raise
+    if transaction is not None:
+        transaction.commit()
+    n_changed = len(book.changed)
+    book.changed.clear()
+    return n_changed
+
+def write_floor_prices(connection, book, as_of=None):
+    # small table, replaced wholesale in one transaction
+    floor_prices = book.floor_prices(as_of)
+    transaction = connection.begin() if not connection.in_transaction() else None
+    try:
+        connection.execute(text("""
+            CREATE TABLE IF NOT EXISTS {} (
+                nft_collection VARCHAR(255),
+                nft_subcategory VARCHAR(255),
+                floor_price DOUBLE,
+                n_listings INT,
+                quantity INT,
+                updated_at DATETIME
+            )
+        """.format(FLOOR_PRICES_TABLE)))
+        connection.execute(text('DELETE FROM {}'.format(FLOOR_PRICES_TABLE)))
+        if not floor_prices.empty:
+            connection.execute(
+                text('INSERT INTO {} (nft_collection, nft_subcategory, floor_price, n_listings, quantity, updated_at) VALUES (:nft_collection, :nft_subcategory, :floor_price, :n_listings, :quantity, :updated_at)'.format(FLOOR_PRICES_TABLE)),
+                [{col: to_sql_value(value) for col, value in row.items()} for row in floor_prices.to_dict('records')]
+            )
+    except Exception:
+        if transaction is not None:
+            transaction.rollback()
+        raise
+    if transaction is not None:
+        transaction.commit()
+    return floor_prices
@@ -0,0 +1,144 @@
+# In this file we archive raw Arbiscan pulls as Parquet instead of one CSV per
+# run. Files are partitioned by block range (block_bucket = blockNumber //
+# PARTITION_BLOCKS) and sorted by block, numbers are stored as integers,
+# hashes and addresses as fixed width binary and calldata as raw bytes. A
+# rebuild can then ask for just the columns and block range it needs and
+# pyarrow skips every other partition and row group.
+#
+# usage: python raw_archive.py <marketplace|magic> <archive root>
+# converts the existing CSVs under marketplace-txs/ or magic-txs/ in S3
+
+import io
+import os
+import sys
+import uuid
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+PARTITION_BLOCKS = 1000000
+ROW_GROUP_SIZE = 100000
+
+HASH_TYPE = pa.binary(32)
+ADDRESS_TYPE = pa.binary(20)
+
+column_types = {
+    'blockNumber': pa.int64(),
+    'timeStamp': pa.int64(),
+    'hash': HASH_TYPE,
+    'blockHash': HASH_TYPE,
+    'nonce': pa.int64(),
+    'transactionIndex': pa.int32(),
+    'from': ADDRESS_TYPE,
+    'to': ADDRESS_TYPE,
+    'from_wallet': ADDRESS_TYPE,
+    'to_wallet': ADDRESS_TYPE,
+    'contractAddress': ADDRESS_TYPE,
+    'gas': pa.int64(),
+    'gasPrice': pa.int64(),
+    'gasUsed': pa.int64(),
+    'cumulativeGasUsed': pa.int64(),
+    'confirmations': pa.int64(),
+    'isError': pa.int8(),
+    'txreceipt_status': pa.int8(),
+    'tokenDecimal': pa.int8(),
+    'input': pa.binary(),
+    # wei amounts overflow int64, keep them exact as text
+    'value': pa.string(),
+    'contract': pa.dictionary(pa.int32(), pa.string()),
+    'tokenName': pa.dictionary(pa.int32(), pa.string()),
+    'tokenSymbol': pa.dictionary(pa.int32(), pa.string()),
+}
+
+archive_prefixes = {
+    'marketplace': 'marketplace-txs/',
+    'magic': 'magic-txs/',
+}
+
+def is_missing(value):
+    return value is None or value == '' or (isinstance(value, float) and value != value)
+
+def hex_to_bytes(values):
+    return [None if is_missing(x) else bytes.fromhex(str(x)[2:] if str(x)[:2] in ('0x', '0X') else str(x)) for x in values]
+
+def bytes_to_hex(values):
+    return ['0x' + x.hex() if x is not None else None for x in values]
+
+def to_arrow_column(name, values):
+    arrow_type = column_types.get(name, pa.string())
+    if pa.types.is_binary(arrow_type) or pa.types.is_fixed_size_binary(arrow_type):
+        return pa.array(hex_to_bytes(values), type=arrow_type)
+    if pa.types.is_integer(arrow_type):
+        values = pd.Series(values)
+        return pa.array(pd.to_numeric(values.where(values != '')).astype('Int64'), type=arrow_type)
+    if pa.types.is_dictionary(arrow_type):
+        return pa.array(pd.Series(values).astype('string'), type=pa.string()).dictionary_encode().cast(arrow_type)
+    return pa.array(pd.Series(values).astype('string'), type=pa.string())
+
+def raw_txs_to_table(raw_txs):
+    raw_txs = raw_txs.loc[:,[col for col in raw_txs.columns if not str(col).startswith('Unnamed')]]
+    raw_txs = raw_txs.sort_values('blockNumber', key=lambda x: x.astype('int64'), kind='mergesort')
+    columns = {name: to_arrow_column(name, raw_txs[name].values) for name in raw_txs.columns}
+    columns['block_bucket'] = pa.array(raw_txs['blockNumber'].astype('int64').values // PARTITION_BLOCKS, type=pa.int64())
+    return pa.table(columns)
+
+def write_raw_txs(raw_txs, archive_root, kind):
+    table = raw_txs_to_table(raw_txs)
+    ds.write_dataset(
+        table,
+        os.path.join(archive_root, archive_prefixes[kind]),
+        format='parquet',
+        partitioning=ds.partitioning(pa.schema([('block_bucket', pa.int64())]), flavor='hive'),
+        # a new file per run, never overwrite what's already archived
+        basename_template='part-{}-{{i}}.parquet'.format(uuid.uuid4().hex),
+        existing_data_behavior='overwrite_or_ignore',
+        max_rows_per_group=ROW_GROUP_SIZE,
+    )
+
+def raw_txs_dataset(archive_root, kind):
+    path = os.path.join(archive_root, archive_prefixes[kind])
+    dataset = ds.dataset(path, format='parquet', partitioning='hive')
+    # older pulls don't always have the same columns, so read with the union
+    schema = pa.unify_schemas([fragment.physical_schema for fragment in dataset.get_fragments()] + [pa.schema([('block_bucket', pa.int64())])])
+    return ds.dataset(path, schema=schema, format='parquet', partitioning=ds.partitioning(pa.schema([('block_bucket', pa.int64())]), flavor='hive'))
+
+def read_raw_txs(archive_root, kind, columns=None, start_block=None, end_block=None, decode=True):
+    dataset = raw_txs_dataset(archive_root, kind)
+    if columns is not None:
+        columns = [col for col in columns if col in dataset.schema.names]
+
+    # the block_bucket filter prunes whole partitions, the blockNumber one
+    # skips row groups using their min/max statistics
+    block_filter = None
+    if start_block is not None:
+        block_filter = (ds.field('block_bucket') >= start_block // PARTITION_BLOCKS) & (ds.field('blockNumber') >= start_block)
+    if end_block is not None:
+        end_filter = (ds.field('block_bucket') <= end_block // PARTITION_BLOCKS) & (ds.field('blockNumber') <= end_block)
+        block_filter = end_filter if block_filter is None else block_filter & end_filter
+
+    table = dataset.to_table(columns=columns, filter=block_filter)
+    raw_txs = table.to_pandas()
+    raw_txs = raw_txs.drop(columns=['block_bucket'], errors='ignore')
+    if decode:
+        # hand back the same hex strings the API returns
+        for name in raw_txs.columns:
+            arrow_type = table.schema.field(name).type
+            if pa.types.is_binary(arrow_type) or pa.types.is_fixed_size_binary(arrow_type):
+                raw_txs[name] = bytes_to_hex(raw_txs[name].values)
+            elif pa.types.is_dictionary(arrow_type):
+                raw_txs[name] = raw_txs[name].astype(object)
+    return raw_txs
+
+def archive_bucket_csvs(bucket, archive_root, kind):
+    prefix = archive_prefixes[kind]
+    for obj in bucket.objects.all():
+        if (obj.key[:len(prefix)]==prefix) & (obj.key[-4:]=='.csv'):
+            raw_txs = pd.read_csv(io.BytesIO(obj.get()["Body"].read()), dtype=str, keep_default_na=False)
+            write_raw_txs(raw_txs, archive_root, kind)
+
+if __name__ == '__main__':
+    import boto3
+    kind, archive_root = sys.argv[1:3]
+    bucket = boto3.resource('s3').Bucket("treasure-marketplace-db")
+    archive_bucket_csvs(bucket, archive_root, kind)
@@ -0,0 +1,15 @@
+# Entry point for a full rebuild of marketplace_sales and marketplace_listings
+# from the raw archive, partitioned over a process pool (see
+# refresh_pipeline/rebuild.py).
+#
+# usage: python rebuild_db.py <archive root> [--workers N] [--serial] [--dry-run]
+
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from refresh_pipeline.rebuild import main
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,6 @@
 # We can then join the table to the marketplace sales and floor price tables
 # to get prices in either USD or ETH.
 
-import datetime as dt
 import json
 import os
 import pandas as pd
@@ -12,6 +11,11 @@ import pytz
 import requests
 from sqlalchemy import create_engine
 
+from bulk_load import bulk_load
+from daily_aggregates import refresh_daily_aggregates
+from token_price_backfill import COINGECKO_API_URL, backfill_token_prices, wrangle_price_data
+from token_price_index import backfill_sale_prices
+
 os.chdir('v2_mysql/build_database_test')
 tz = pytz.timezone('UTC')
 
@@ -31,20 +35,9 @@ engine = create_engine(
 )
 connection = engine.connect()
 
-# define function to go from json output to clean dataframe
-def wrangle_price_data(response_json, token_name):
-    response_json = pd.DataFrame(response_json['prices'])
-    response_json.rename(columns={0:'timestamp',1:'price_{}_usd'.format(token_name)},inplace=True)
-    response_json['datetime'] = [dt.datetime.fromtimestamp(int(x)/1000, tz) for x in response_json['timestamp']]
-    response_json['datetime'] = response_json.datetime.dt.floor('5min') # truncate to first 5 min
-    response_json.drop('timestamp',axis=1,inplace=True)
-    response_json.drop_duplicates('datetime', inplace=True)  
-
-    return response_json
-
 # pull token prices from CoinGecko API
-magic_request_url = 'https://api.coingecko.com/api/v3/coins/magic/market_chart?vs_currency=usd&days=1'
-eth_request_url = 'https://api.coingecko.com/api/v3/coins/ethereum/market_chart?vs_currency=usd&days=1'
+magic_request_url = COINGECKO_API_URL + '/coins/magic/market_chart?vs_currency=usd&days=1'
+eth_request_url = COINGECKO_API_URL + '/coins/ethereum/market_chart?vs_currency=usd&days=1'
 
 magic_response = requests.get(magic_request_url)
 eth_response = requests.get(eth_request_url)
@@ -66,12 +59,15 @@ pd.to_datetime(max_existing_dt).tz_localize(tz)
 merged_prices = merged_prices.loc[merged_prices['datetime']>pd.to_datetime(max_existing_dt).tz_localize(tz)]
 
 # insert records
-merged_prices.to_sql(
-    'token_prices', 
-    con = connection, 
-    if_exists = 'append', 
-    chunksize = 1000,
-    index=False
-)
+bulk_load(merged_prices, 'token_prices', connection)
+
+# sales from the first new bucket on either weren't converted yet or were
+# converted with an older bucket, so redo all of them
+if not merged_prices.empty:
+    backfilled_dates = backfill_sale_prices(connection, since=merged_prices['datetime'].min(), only_missing=False)
+    refresh_daily_aggregates(connection, backfilled_dates)
+
+# if earlier runs were missed, fetch what's missing since the last bucket we had
+backfill_token_prices(connection, start=max_existing_dt)
 
-connection.close()
\ No newline at end of file
+connection.close()
@@ -0,0 +1,7 @@
+# The marketplace refresh as an importable package. Importing it only defines
+# functions: constants are read (config.py) and the engine and S3 bucket made
+# (clients.py) the first time something needs them, and main() runs the
+# whole refresh the way refresh_db.py used to on import.
+
+from .pipeline import main, pull_arbiscan_data, refresh_database
+from .transform import build_marketplace_listings_table, build_marketplace_sales_table, process_marketplace_txs
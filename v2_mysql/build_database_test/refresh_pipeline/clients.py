@@ -0,0 +1,37 @@
+# In this file we create the database engine and the S3 bucket the refresh
+# talks to. Both are made on first use and cached, and boto3 is only imported
+# then, so importing the pipeline doesn't touch the network.
+
+import functools
+
+from sqlalchemy import create_engine
+
+from watermark import WatermarkStore
+
+from . import config
+
+REFRESH_DATABASE = "treasure_test"
+BUCKET_NAME = "treasure-marketplace-db"
+
+def make_engine(sql_credentials, database=REFRESH_DATABASE):
+    return create_engine(
+        "mysql+pymysql://{user}:{pw}@{host}/{db}".format(
+        user=sql_credentials['username'],
+        pw=sql_credentials['pw'],
+        host=sql_credentials['host'],
+        db=database
+        )
+    )
+
+@functools.lru_cache(maxsize=None)
+def get_engine(database=REFRESH_DATABASE):
+    return make_engine(config.mysql_credentials(), database)
+
+@functools.lru_cache(maxsize=None)
+def get_bucket(bucket_name=BUCKET_NAME):
+    import boto3
+    return boto3.resource('s3').Bucket(bucket_name)
+
+@functools.lru_cache(maxsize=None)
+def get_watermark_store(bucket_name=BUCKET_NAME):
+    return WatermarkStore(get_bucket(bucket_name))
@@ -0,0 +1,46 @@
+# In this file we load the API key, database credentials and the JSON
+# constants the refresh needs. Nothing is read at import time: each loader
+# reads its file the first time it's called and caches the result, and paths
+# are relative to this package rather than the working directory.
+
+import functools
+import json
+import os
+
+CONSTANTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "constants")
+
+DAO_WALLET = '0xdb6ab450178babcf0e467c1f3b436050d907e233'
+DAO_ROYALTY_PCT = 0.05
+
+def read_constant(filename):
+    with open(os.path.join(CONSTANTS_DIR, filename)) as f:
+        return f.read()
+
+@functools.lru_cache(maxsize=None)
+def arbiscan_api_key():
+    return read_constant("api_key.txt")
+
+@functools.lru_cache(maxsize=None)
+def mysql_credentials():
+    return json.loads(read_constant("mysql_credential.json"))
+
+@functools.lru_cache(maxsize=None)
+def contract_addresses():
+    return json.loads(read_constant("contract_addresses.json"))
+
+@functools.lru_cache(maxsize=None)
+def method_ids():
+    return json.loads(read_constant("marketplace_method_ids.json"))
+
+@functools.lru_cache(maxsize=None)
+def contract_addresses_reverse_lower():
+    # lowercased address -> contract name, for decoding calldata
+    return {address.lower(): name for name, address in contract_addresses().items()}
+
+@functools.lru_cache(maxsize=None)
+def treasure_ids_numeric():
+    return {int(key): value for key, value in json.loads(read_constant("treasure_token_ids.json")).items()}
+
+@functools.lru_cache(maxsize=None)
+def consumable_ids_numeric():
+    return {int(key): value for key, value in json.loads(read_constant("consumable_token_ids.json")).items()}
@@ -0,0 +1,173 @@
+# In this file we run the refresh: pull the txs since the last watermark from
+# Arbiscan, decode them, write sales and listings, then update the floor
+# prices, floor price history and daily aggregates before moving the
+# watermark. Credentials, the engine and the S3 bucket all come from config.py
+# and clients.py on first use, so importing this module does no I/O. Every
+# step runs as an instrumentation.py stage, --metrics <path> (or
+# REFRESH_METRICS_PATH) writes them out as JSON lines or, for a .prom path, a
+# Prometheus textfile.
+#
+# usage: python refresh_db.py [--full-listings] [--metrics <path>]
+
+import os
+import sys
+
+import pandas as pd
+
+import instrumentation
+from binary_keys import load_table, upsert_table
+from compact_frames import StringDictionary, decode_frame, encode_frame
+from daily_aggregates import refresh_daily_aggregates, touched_dates
+from floor_history import update_floor_price_history
+from incremental_listings import refresh_marketplace_listings
+from order_book import read_order_book, unapplied_txs, write_floor_prices, write_order_book
+from token_price_index import add_sale_price_columns, convert_sales
+from watermark import build_watermark, read_watermark
+
+from . import clients, config
+from .transform import build_marketplace_listings_table, build_marketplace_sales_table, process_marketplace_txs
+
+# where the sale amounts come from: MAGIC Transfer logs paged over the batch's
+# buy blocks (logs), or each buyer's tokentx history (tokentx)
+MAGIC_TRANSFER_SOURCE = os.environ.get('MAGIC_TRANSFER_SOURCE', 'logs')
+
+def pull_arbiscan_data(arbiscan_api_key, method_ids, start_block=0, latest_tx_hashes=[], max_workers=None, contract_addresses=None, magic_source=MAGIC_TRANSFER_SOURCE):
+    # the Arbiscan clients bring in requests, which is most of this package's
+    # import time, so they're only imported once there's something to pull
+    from arbiscan import ARBISCAN_MAX_WORKERS, get_wallet_token_txs
+    from arbiscan_crawler import crawl_contract_transactions
+    from magic_logs import get_sale_transfers
+
+    max_workers = max_workers if max_workers is not None else ARBISCAN_MAX_WORKERS
+    contract_addresses = contract_addresses if contract_addresses is not None else config.contract_addresses()
+    # read in marketplace txs, crawling by block range so a busy stretch between refreshes can't hit the 10,000 result cap
+    with instrumentation.stage('crawl_marketplace_txs') as stage:
+        marketplace_txs_old_df = crawl_contract_transactions(arbiscan_api_key, contract_addresses['treasure_marketplace'], start_block=start_block, max_workers=max_workers)
+        marketplace_txs_new_df = crawl_contract_transactions(arbiscan_api_key, contract_addresses['treasure_marketplace_2'], start_block=start_block, max_workers=max_workers)
+        stage['rows_out'] = len(marketplace_txs_old_df) + len(marketplace_txs_new_df)
+    marketplace_txs_old_df['contract'] = contract_addresses['treasure_marketplace']
+    marketplace_txs_new_df['contract'] = contract_addresses['treasure_marketplace_2']
+    marketplace_txs_df = pd.concat([marketplace_txs_old_df, marketplace_txs_new_df])
+
+    # filter txs against already existing records
+    marketplace_txs_df = marketplace_txs_df.loc[~marketplace_txs_df['hash'].isin(latest_tx_hashes)]
+
+    # keep only successful txs
+    marketplace_txs_df = marketplace_txs_df.loc[marketplace_txs_df.txreceipt_status=='1'].copy()
+
+    # setup to pull magic txs - filter marketplace txs down to buys
+    marketplace_txs_df["tx_type"] = [x[:10] for x in marketplace_txs_df["input"]]
+    marketplace_txs_df["tx_type"] = marketplace_txs_df["tx_type"].map(method_ids)
+    marketplace_buys_df = marketplace_txs_df.loc[marketplace_txs_df["tx_type"]=="buyItem"].copy()
+    marketplace_txs_df.drop("tx_type", axis=1, inplace=True)
+
+    if magic_source == 'tokentx':
+        # pull magic txs for every buyer, several wallets in flight at once
+        buyers = marketplace_buys_df["from"].unique()
+        with instrumentation.stage('pull_magic_txs', rows_in=len(buyers)) as stage:
+            new_magic_txs_df = get_wallet_token_txs(arbiscan_api_key, contract_addresses['magic'], buyers, start_block=start_block, latest_tx_hashes=latest_tx_hashes, max_workers=max_workers)
+            stage['rows_out'] = len(new_magic_txs_df)
+    else:
+        # pull the magic transfers of the buys from the token's Transfer logs over the buys' blocks
+        with instrumentation.stage('pull_magic_transfer_logs', rows_in=len(marketplace_buys_df)) as stage:
+            new_magic_txs_df = get_sale_transfers(arbiscan_api_key, contract_addresses['magic'], marketplace_buys_df, max_workers=max_workers)
+            stage['rows_out'] = len(new_magic_txs_df)
+
+    return marketplace_txs_df, new_magic_txs_df
+
+def refresh_database(sql_credentials=None, incremental_listings=True):
+    # the whole run is a stage as well as each step in it
+    with instrumentation.stage('refresh_database'):
+        run_refresh(sql_credentials, incremental_listings)
+
+def run_refresh(sql_credentials=None, incremental_listings=True):
+    engine = clients.make_engine(sql_credentials) if sql_credentials is not None else clients.get_engine()
+    connection = engine.connect()
+
+    # the ingestion watermark: last processed block and the tx hashes already seen in it
+    with instrumentation.stage('read_watermark'):
+        watermark_store = clients.get_watermark_store()
+        watermark = read_watermark(watermark_store, clients.get_bucket())
+    if watermark is None:
+        # nothing ingested yet (an empty bucket or a fresh local stand-in), start from the first block
+        print('no ingestion watermark found, pulling from block 0')
+        watermark = {'last_block': 0, 'boundary_tx_hashes': []}
+    latest_block = watermark['last_block']
+    latest_txs = watermark['boundary_tx_hashes']
+
+    with instrumentation.stage('pull_arbiscan_data') as stage:
+        marketplace_df, magic_df = pull_arbiscan_data(config.arbiscan_api_key(), config.method_ids(), latest_block, latest_txs)
+        stage['rows_out'] = len(marketplace_df) + len(magic_df)
+    with instrumentation.stage('process_marketplace_txs', rows_in=len(marketplace_df)) as stage:
+        marketplace_df_processed = process_marketplace_txs(marketplace_df)
+        stage['rows_out'] = len(marketplace_df_processed)
+    # the sales and listings are built on integer-coded hashes and wallets,
+    # and decoded back to strings for writing
+    with instrumentation.stage('build_marketplace_sales_table', rows_in=len(marketplace_df_processed) + len(magic_df)) as stage:
+        dictionary = StringDictionary()
+        marketplace_txs_coded = encode_frame(marketplace_df_processed, dictionary)
+        marketplace_sales_coded = build_marketplace_sales_table(marketplace_txs_coded, encode_frame(magic_df.loc[:,['hash','value']], dictionary))
+        marketplace_sales_df = decode_frame(marketplace_sales_coded, dictionary)
+        stage['rows_out'] = len(marketplace_sales_df)
+
+    # # write data to s3
+    # date = dt.datetime.now()
+    # marketplace_txs_filename = f'marketplace-txs/marketplace_txs_raw_{date.year}_{date.month}_{date.day}_{date.hour}_{date.minute}.csv'
+    # magic_txs_filename = f'magic-txs/magic_txs_raw_{date.year}_{date.month}_{date.day}_{date.hour}_{date.minute}.csv'
+    # marketplace_df.to_csv('/tmp/tmp_marketplace_txs_df.csv')
+    # magic_df.to_csv('/tmp/tmp_magic_txs_df.csv')
+    # s3_resource.Object('treasure-marketplace-db', marketplace_txs_filename).upload_file('/tmp/tmp_marketplace_txs_df.csv')
+    # s3_resource.Object('treasure-marketplace-db', magic_txs_filename).upload_file('/tmp/tmp_magic_txs_df.csv')
+    # os.remove('/tmp/tmp_marketplace_txs_df.csv')
+    # os.remove('/tmp/tmp_magic_txs_df.csv')
+
+    # load the stored order book (built from marketplace_listings the first
+    # time, so before this batch's sales and listings are written)
+    with instrumentation.stage('read_order_book') as stage:
+        order_book, order_book_progress = read_order_book(connection, watermark)
+        stage['rows_out'] = len(order_book.active)
+
+    # USD/ETH amounts from the token price bucket at or before each sale, left
+    # NULL when prices haven't been pulled that far yet (the price refresh fills them)
+    with instrumentation.stage('convert_sales', rows_in=len(marketplace_sales_df)):
+        add_sale_price_columns(connection)
+        marketplace_sales_df = convert_sales(connection, marketplace_sales_df)
+
+    # write data to sql, sales already in the table (e.g. from a retried run) are updated in place
+    with instrumentation.stage('write_sales', rows_in=len(marketplace_sales_df)) as stage:
+        stage['rows_out'] = upsert_table(marketplace_sales_df, 'marketplace_sales', connection, key='tx_hash')['rows']
+    with instrumentation.stage('write_listings', rows_in=len(marketplace_df_processed)) as stage:
+        if incremental_listings:
+            # close out listings from earlier runs and insert the new ones
+            refresh_marketplace_listings(connection, marketplace_df_processed, marketplace_sales_df)
+        else:
+            marketplace_listings_df = build_marketplace_listings_table(marketplace_txs_coded, marketplace_sales_coded)
+            stage['rows_out'] = load_table(decode_frame(marketplace_listings_df, dictionary), 'marketplace_listings', connection)['rows']
+
+    # feed the events the book hasn't seen to it, store the listings that
+    # changed and the current floors
+    with instrumentation.stage('write_floor_prices', rows_in=len(marketplace_df_processed)) as stage:
+        order_book.apply_marketplace_txs(unapplied_txs(marketplace_df_processed, order_book_progress))
+        with connection.begin():
+            stage['rows_out'] = write_order_book(connection, order_book, build_watermark(marketplace_df, order_book_progress))
+            write_floor_prices(connection, order_book)
+    # and extend the floor price history from the last computed bucket
+    with instrumentation.stage('update_floor_price_history'):
+        update_floor_price_history(connection)
+
+    # recompute the materialized daily aggregates for the days these sales fall on
+    with instrumentation.stage('refresh_daily_aggregates', rows_in=len(marketplace_sales_df)):
+        refresh_daily_aggregates(connection, touched_dates(marketplace_sales_df['datetime']))
+
+    # only move the watermark once everything is written
+    with instrumentation.stage('write_watermark'):
+        watermark_store.write(build_watermark(marketplace_df, watermark))
+
+    connection.close()
+    engine.dispose()
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if '--metrics' in argv:
+        instrumentation.configure(argv[argv.index('--metrics') + 1])
+    refresh_database(incremental_listings='--full-listings' not in argv)
@@ -0,0 +1,185 @@
+# In this file we rebuild marketplace_sales and marketplace_listings from the
+# raw archive using every core. A listing's lifecycle only depends on the
+# events with the same (wallet, nft_collection, nft_id), and a sale only on
+# its own hash. So after the calldata is decoded (row by row, in ordered
+# chunks) the txs are hash-partitioned by listing key, buys going with the
+# seller's listings, and each magic tx follows the buy it paid for. A sale's
+# amounts come from every buy and magic tx with its hash, so the keys of a
+# hash with buys for several listing keys are kept in one partition. Every
+# partition is built on its own in a process pool with the same functions the
+# refresh uses, and the pieces are put back in the order the serial build
+# returns them in: by the position of their tx in the decoded txs.
+#
+# usage: python rebuild_db.py <archive root> [--workers N] [--serial] [--dry-run]
+
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+
+from binary_keys import load_table, physical_table, upsert_table
+from compact_frames import StringDictionary, decode_frame, encode_frame
+from daily_aggregates import refresh_daily_aggregates, touched_dates
+from floor_history import update_floor_price_history
+from listing_lifecycle import prepare_listing_sales, sweep_listing_lifecycles
+from order_book import reset_order_book
+from raw_archive import read_raw_txs
+from token_price_index import add_sale_price_columns, convert_sales
+
+from . import clients, config
+from .token_registry import get_token_registry
+from .transform import build_marketplace_sales_table, process_marketplace_txs
+
+# more partitions than workers, so one busy collection doesn't hold up the pool
+PARTITIONS_PER_WORKER = 4
+
+raw_marketplace_columns = ['hash', 'blockNumber', 'timeStamp', 'from', 'to', 'input', 'gasPrice', 'gasUsed', 'txreceipt_status', 'contract']
+raw_magic_columns = ['hash', 'value']
+
+def read_raw_archive(archive_root):
+    marketplace_txs_raw = read_raw_txs(archive_root, 'marketplace', columns=raw_marketplace_columns)
+    marketplace_txs_raw = marketplace_txs_raw.loc[marketplace_txs_raw.txreceipt_status==1].reset_index(drop=True) # only keep successful txs
+    magic_txs = read_raw_txs(archive_root, 'magic', columns=raw_magic_columns)
+    return marketplace_txs_raw, magic_txs
+
+def transform_lookups():
+    # resolved once here and handed to the workers, which then never read
+    # the constants files themselves
+    return {
+        'method_ids': config.method_ids(),
+        'contract_addresses_reverse_lower': config.contract_addresses_reverse_lower(),
+        'contract_addresses': config.contract_addresses(),
+        'token_registry': get_token_registry(),
+    }
+
+def process_chunk(marketplace_txs_raw, lookups):
+    return process_marketplace_txs(
+        marketplace_txs_raw, lookups['method_ids'], lookups['contract_addresses_reverse_lower'], lookups['token_registry']
+    )
+
+def sale_positions(marketplace_sales, marketplace_txs):
+    # the inner merge in build_marketplace_sales_table keeps the order the
+    # hashes first appear in, with the rows of a hash together (a tx the
+    # archive has twice gives two), so a sale sorts with its hash's first buy
+    buys = marketplace_txs.loc[marketplace_txs['tx_type'] == 'buyItem']
+    first_positions = pd.Series(buys['position'].values, index=buys['hash'].values)
+    first_positions = first_positions.loc[~first_positions.index.duplicated()]
+    return marketplace_sales['tx_hash'].map(first_positions).values
+
+def build_partition(marketplace_txs, magic_txs, lookups):
+    # what refresh_database does with a batch, on integer-coded frames. Every
+    # row is tagged with the position of the tx it came from in
+    # marketplace_txs' index, for putting the partitions back together
+    dictionary = StringDictionary()
+    marketplace_txs_coded = encode_frame(marketplace_txs, dictionary).assign(position=marketplace_txs.index.values)
+    marketplace_sales_coded = build_marketplace_sales_table(marketplace_txs_coded, encode_frame(magic_txs.loc[:,['hash','value']], dictionary), lookups['contract_addresses'])
+    marketplace_listings_coded = sweep_listing_lifecycles(marketplace_txs_coded, prepare_listing_sales(marketplace_sales_coded, marketplace_txs_coded), keep_cols=['position'])
+    marketplace_sales_coded['position'] = sale_positions(marketplace_sales_coded, marketplace_txs_coded)
+    return decode_frame(marketplace_sales_coded, dictionary), decode_frame(marketplace_listings_coded, dictionary)
+
+def listing_partitions(marketplace_txs, n_partitions):
+    # the listing key of every tx, for a buy that's the seller ('to'). nft_id
+    # is hashed as a number so 1 and 1.0 (which group together) land together
+    is_buy = (marketplace_txs['tx_type'] == 'buyItem').values
+    wallet = marketplace_txs['from'].where(~is_buy, marketplace_txs['to'])
+    keys = pd.DataFrame({
+        'wallet': wallet.values,
+        'nft_collection': marketplace_txs['nft_collection'].astype(object).values,
+        'nft_id': pd.to_numeric(marketplace_txs['nft_id']).astype('float64').values,
+    })
+    key_ids, key_hashes = pd.factorize(pd.util.hash_pandas_object(keys, index=False).values)
+
+    # keys bought in the same tx are merged into one group (union-find), and
+    # every key goes where its group's first key hashes to
+    parents = np.arange(len(key_hashes))
+    def root(key):
+        while parents[key] != key:
+            parents[key] = parents[parents[key]]
+            key = parents[key]
+        return key
+    buys = pd.DataFrame({'hash': marketplace_txs['hash'].values[is_buy], 'key': key_ids[is_buy]}).drop_duplicates()
+    shared = buys.loc[buys['hash'].duplicated(keep=False)]
+    for _, hash_keys in shared.groupby('hash', sort=False)['key']:
+        first = root(hash_keys.iloc[0])
+        for key in hash_keys.iloc[1:]:
+            parents[root(key)] = first
+    groups = np.array([root(key) for key in range(len(key_hashes))], dtype=np.int64)
+    return (key_hashes[groups][key_ids] % n_partitions).astype(np.int64)
+
+def magic_partitions(magic_txs, marketplace_txs, partitions):
+    # magic txs go where the buys with their hash went (listing_partitions
+    # keeps those together), the rest are dropped (the sales merge would drop
+    # them anyway)
+    is_buy = (marketplace_txs['tx_type'] == 'buyItem').values
+    buy_partitions = pd.Series(partitions[is_buy], index=marketplace_txs['hash'].values[is_buy])
+    buy_partitions = buy_partitions.loc[~buy_partitions.index.duplicated()]
+    return magic_txs['hash'].map(buy_partitions).values
+
+def in_serial_order(frames):
+    # the serial build returns rows in the order of the txs they came from,
+    # and rows from the same tx in the order the partition gave them
+    merged = pd.concat(frames, ignore_index=True)
+    order = np.argsort(merged['position'].values, kind='mergesort')
+    return merged.take(order).drop(columns=['position']).reset_index(drop=True)
+
+def rebuild_serial(marketplace_txs_raw, magic_txs, lookups):
+    marketplace_txs = process_chunk(marketplace_txs_raw, lookups).reset_index(drop=True)
+    sales, listings = build_partition(marketplace_txs, magic_txs, lookups)
+    return sales.drop(columns=['position']), listings.drop(columns=['position'])
+
+def rebuild_parallel(marketplace_txs_raw, magic_txs, lookups, max_workers=None, n_partitions=None):
+    max_workers = max_workers or os.cpu_count() or 1
+    n_partitions = n_partitions or max_workers * PARTITIONS_PER_WORKER
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        # decoding is row by row, so contiguous chunks concatenated in order
+        # are the same as decoding it all at once
+        chunks = [marketplace_txs_raw.iloc[chunk] for chunk in np.array_split(np.arange(len(marketplace_txs_raw)), n_partitions)]
+        marketplace_txs = pd.concat(list(executor.map(process_chunk, chunks, [lookups] * len(chunks))), ignore_index=True)
+
+        partitions = listing_partitions(marketplace_txs, n_partitions)
+        magic_partition = magic_partitions(magic_txs, marketplace_txs, partitions)
+        futures = [
+            executor.submit(build_partition, marketplace_txs.loc[partitions == partition], magic_txs.loc[magic_partition == partition], lookups)
+            for partition in range(n_partitions)
+        ]
+        results = [future.result() for future in futures]
+
+    sales = in_serial_order([sales for sales, _ in results])
+    listings = in_serial_order([listings for _, listings in results])
+    return sales, listings
+
+def write_rebuild(connection, sales, listings):
+    add_sale_price_columns(connection)
+    sales = convert_sales(connection, sales)
+    upsert_table(sales, 'marketplace_sales', connection, key='tx_hash')
+    # readers keep seeing the old listings until the new ones are committed
+    with connection.begin():
+        connection.execute(text('DELETE FROM {}'.format(physical_table(connection, 'marketplace_listings'))))
+        load_table(listings, 'marketplace_listings', connection)
+        reset_order_book(connection)
+    update_floor_price_history(connection, rebuild=True)
+    refresh_daily_aggregates(connection, touched_dates(sales['datetime']))
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    archive_root = argv[0]
+    max_workers = int(argv[argv.index('--workers') + 1]) if '--workers' in argv else None
+
+    marketplace_txs_raw, magic_txs = read_raw_archive(archive_root)
+    lookups = transform_lookups()
+    if '--serial' in argv:
+        sales, listings = rebuild_serial(marketplace_txs_raw, magic_txs, lookups)
+    else:
+        sales, listings = rebuild_parallel(marketplace_txs_raw, magic_txs, lookups, max_workers)
+    print('rebuilt {} sales and {} listings from {} marketplace txs'.format(len(sales), len(listings), len(marketplace_txs_raw)))
+    if '--dry-run' in argv:
+        return sales, listings
+
+    engine = clients.get_engine()
+    with engine.connect() as connection:
+        write_rebuild(connection, sales, listings)
+    engine.dispose()
+    return sales, listings
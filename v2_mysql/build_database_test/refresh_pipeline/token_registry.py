@@ -0,0 +1,108 @@
+# In this file we resolve nft_name and nft_subcategory from (nft_collection,
+# nft_id). There are only a few hundred named tokens, so rather than mapping
+# every row through the id dicts and running the subcategory regex on each
+# name, the registry does both once per token when the constants are read:
+# every named collection gets an array indexed by token id holding a code
+# into the distinct names, and each name a code into the distinct
+# subcategories. The arrays of all collections sit end to end, so resolving a
+# batch is one take at offset + token id.
+#
+# The registry notes the modification time of the files it was built from,
+# get_token_registry() rebuilds it when any of them changes, so a long-lived
+# process picks up new token ids without a restart.
+
+import json
+import os
+import re
+import threading
+
+import numpy as np
+import pandas as pd
+
+from .config import CONSTANTS_DIR
+
+NO_CODE = -1
+
+# collection -> constants file with its token id -> name mapping
+name_files = {
+    'treasures': 'treasure_token_ids.json',
+    'legacy_legions': 'treasure_token_ids.json',
+    'legacy_legions_genesis': 'treasure_token_ids.json',
+    'consumables': 'consumable_token_ids.json',
+}
+
+def subcategory(name):
+    # 'Small Rupee 2' -> 'Small Rupee'
+    return re.sub(r'[0-9]+', '', name).rstrip()
+
+class TokenRegistry:
+    def __init__(self, constants_dir=CONSTANTS_DIR):
+        self.constants_dir = constants_dir
+        self.collections = list(name_files)
+        self.load()
+
+    def paths(self):
+        return [os.path.join(self.constants_dir, filename) for filename in sorted(set(name_files.values()))]
+
+    def file_mtimes(self):
+        return {path: os.stat(path).st_mtime_ns for path in self.paths()}
+
+    def load(self):
+        mtimes = self.file_mtimes()
+        token_names = {}
+        for filename in set(name_files.values()):
+            with open(os.path.join(self.constants_dir, filename)) as f:
+                token_names[filename] = {int(token_id): name for token_id, name in json.loads(f.read()).items()}
+
+        names = pd.Index(sorted({name for ids in token_names.values() for name in ids.values()}), dtype=object)
+        subcategories = pd.Index(sorted({subcategory(name) for name in names}), dtype=object)
+        tables = []
+        for collection in self.collections:
+            ids = token_names[name_files[collection]]
+            table = np.full(max(ids, default=-1) + 1, NO_CODE, dtype=np.int32)
+            table[list(ids)] = names.get_indexer(list(ids.values()))
+            tables.append(table)
+
+        self.names = names.values
+        self.subcategory_codes = subcategories.get_indexer([subcategory(name) for name in names]).astype(np.int32)
+        self.subcategories = subcategories.values
+        self.table_sizes = np.array([len(table) for table in tables], dtype=np.int64)
+        self.table_offsets = np.concatenate([[0], np.cumsum(self.table_sizes)[:-1]]).astype(np.int64)
+        self.name_codes = np.concatenate(tables) if tables else np.empty(0, dtype=np.int32)
+        self.mtimes = mtimes
+
+    def is_stale(self):
+        try:
+            return self.file_mtimes() != self.mtimes
+        except OSError: # mid-rewrite, keep what we have until it's back
+            return False
+
+    def lookup_name_codes(self, nft_collection, nft_id):
+        # name code of every row, NO_CODE for unnamed collections and unknown ids
+        collection_index = pd.Index(self.collections).get_indexer(pd.Series(nft_collection, copy=False).astype(object))
+        nft_id = pd.to_numeric(pd.Series(nft_id, copy=False), errors='coerce').values.astype('float64')
+        is_named = collection_index != NO_CODE
+        in_range = is_named & (nft_id >= 0) & (nft_id < self.table_sizes[collection_index]) & (nft_id == np.floor(nft_id))
+        positions = np.where(in_range, self.table_offsets[collection_index] + np.where(in_range, nft_id, 0).astype(np.int64), 0)
+        return np.where(in_range, self.name_codes.take(positions) if len(self.name_codes) else NO_CODE, NO_CODE)
+
+    def resolve(self, nft_collection, nft_id):
+        # (nft_name, nft_subcategory) object arrays, NaN where there's no name
+        name_codes = self.lookup_name_codes(nft_collection, nft_id)
+        has_name = name_codes != NO_CODE
+        names = np.full(len(name_codes), np.nan, dtype=object)
+        subcategories = np.full(len(name_codes), np.nan, dtype=object)
+        names[has_name] = self.names.take(name_codes[has_name])
+        subcategories[has_name] = self.subcategories.take(self.subcategory_codes.take(name_codes[has_name]))
+        return names, subcategories
+
+registry = None
+registry_lock = threading.Lock()
+
+def get_token_registry():
+    # built on first use, rebuilt when a constants file it came from changes
+    global registry
+    with registry_lock:
+        if registry is None or registry.is_stale():
+            registry = TokenRegistry()
+        return registry
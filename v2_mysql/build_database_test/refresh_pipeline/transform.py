@@ -0,0 +1,105 @@
+# In this file we turn raw Arbiscan txs into the rows the refresh writes:
+# decoded marketplace txs, marketplace_sales and marketplace_listings. These
+# are plain functions of their input frames, the contract lookups default to
+# the cached constants in config.py and the token names to the registry in
+# token_registry.py.
+
+import pandas as pd
+
+from listing_lifecycle import prepare_listing_sales, sweep_listing_lifecycles
+from marketplace_decoder import decode_marketplace_calldata, timestamps_to_datetimes
+
+from . import config
+from .token_registry import get_token_registry
+
+def process_marketplace_txs(marketplace_txs_raw, method_ids=None, contract_addresses=None, token_registry=None):
+    # contract_addresses here is lowercased address -> name, lookups left as
+    # None come from the constants files
+    method_ids = method_ids if method_ids is not None else config.method_ids()
+    contract_addresses = contract_addresses if contract_addresses is not None else config.contract_addresses_reverse_lower()
+    token_registry = token_registry if token_registry is not None else get_token_registry()
+    decoded = decode_marketplace_calldata(marketplace_txs_raw['input'], method_ids, contract_addresses)
+    is_marketplace_tx = ~pd.isnull(decoded['tx_type']) # null transactions are all whitelisting of certain accounts before marketplace launch
+    marketplace_txs_raw = marketplace_txs_raw.loc[is_marketplace_tx].copy()
+    for col in ['tx_type', 'to', 'nft_collection', 'nft_id', 'quantity', 'listing_price_magic']:
+        marketplace_txs_raw[col] = decoded[col][is_marketplace_tx]
+    marketplace_txs_raw['blockNumber'] = marketplace_txs_raw['blockNumber'].astype('int64') # arbiscan returns strings, which compare lexically
+    marketplace_txs_raw['datetime'] = timestamps_to_datetimes(marketplace_txs_raw['timeStamp'])
+    marketplace_txs_raw['expiration_datetime'] = timestamps_to_datetimes(decoded['expiration_ms'][is_marketplace_tx], unit='ms')
+    marketplace_txs_raw['gas_fee_eth'] = (marketplace_txs_raw['gasPrice'].astype('int64') * 1e-9 * marketplace_txs_raw['gasUsed'].astype(int) * 1e-9) / 2.0
+    nft_names, nft_subcategories = token_registry.resolve(marketplace_txs_raw['nft_collection'].values, marketplace_txs_raw['nft_id'].values)
+    has_name = ~pd.isnull(nft_names)
+    marketplace_txs_raw.loc[has_name, 'nft_name'] = nft_names[has_name]
+    marketplace_txs_raw.loc[has_name, 'nft_subcategory'] = nft_subcategories[has_name].tolist()
+
+    # correct data error: coalesce from + from_wallet, to + to_wallet
+    columns_to_keep = [
+        'hash',
+        'datetime',
+        'blockNumber',
+        'from',
+        'to',
+        'listing_price_magic',
+        'expiration_datetime',
+        'gas_fee_eth',
+        'nft_collection',
+        'nft_id',
+        'nft_name',
+        'nft_subcategory',
+        'quantity',
+        'tx_type',
+        'contract'
+    ]
+
+    return marketplace_txs_raw.loc[:,columns_to_keep].copy()
+
+def build_marketplace_sales_table(marketplace_txs, magic_txs, contract_addresses=None):
+    # contract_addresses here is name -> address
+    contract_addresses = contract_addresses if contract_addresses is not None else config.contract_addresses()
+    marketplace_sales = marketplace_txs.loc[marketplace_txs["tx_type"]=="buyItem"].copy()
+
+    # join magic txs table to get transaction values, on a copy so the caller's frame keeps wei
+    magic_txs = magic_txs.copy()
+    magic_txs['value'] = magic_txs['value'].astype("float64") * 1e-18
+
+    mkt_magic_merged_table = magic_txs.merge(marketplace_sales, how='inner', on='hash')
+    mkt_magic_merged_table = mkt_magic_merged_table.groupby('hash',as_index=False).agg({'value':["min", "max", "sum"]})
+    mkt_magic_merged_table.columns = mkt_magic_merged_table.columns.droplevel()
+    mkt_magic_merged_table.rename(columns={'':'hash','min':'dao_amt_received_magic', 'max':'seller_amt_received_magic', 'sum':'sale_amt_magic'}, inplace=True)
+    mkt_magic_merged_table.loc[mkt_magic_merged_table['dao_amt_received_magic']==mkt_magic_merged_table['seller_amt_received_magic'], 'sale_amt_magic'] = \
+        mkt_magic_merged_table.loc[mkt_magic_merged_table['dao_amt_received_magic']==mkt_magic_merged_table['seller_amt_received_magic'], 'seller_amt_received_magic'] / 0.95
+    mkt_magic_merged_table.loc[mkt_magic_merged_table['dao_amt_received_magic']==mkt_magic_merged_table['seller_amt_received_magic'], 'dao_amt_received_magic'] = \
+        mkt_magic_merged_table.loc[mkt_magic_merged_table['dao_amt_received_magic']==mkt_magic_merged_table['seller_amt_received_magic'], 'sale_amt_magic'] * 0.05
+
+    marketplace_sales = marketplace_sales.merge(mkt_magic_merged_table, how='inner', on='hash')
+    marketplace_sales.rename(columns={
+        'hash':'tx_hash',
+        'to':'wallet_seller',
+        'from':'wallet_buyer'
+        },inplace=True)
+
+    marketplace_sales.loc[marketplace_sales['contract']==contract_addresses['treasure_marketplace_2'], 'sale_amt_magic'] = marketplace_sales.loc[marketplace_sales['contract']==contract_addresses['treasure_marketplace_2'], 'seller_amt_received_magic']
+    marketplace_sales.loc[marketplace_sales['contract']==contract_addresses['treasure_marketplace_2'], 'seller_amt_received_magic'] = marketplace_sales.loc[marketplace_sales['contract']==contract_addresses['treasure_marketplace_2'], 'sale_amt_magic'] * 0.95
+    marketplace_sales.loc[marketplace_sales['contract']==contract_addresses['treasure_marketplace_2'], 'dao_amt_received_magic'] = marketplace_sales.loc[marketplace_sales['contract']==contract_addresses['treasure_marketplace_2'], 'sale_amt_magic'] * 0.05
+
+    # load into the table
+    columns_to_load = [
+        'tx_hash',
+        'datetime',
+        'wallet_buyer',
+        'wallet_seller',
+        'sale_amt_magic',
+        'seller_amt_received_magic',
+        'dao_amt_received_magic',
+        'gas_fee_eth',
+        'nft_collection',
+        'nft_id',
+        'nft_name',
+        'nft_subcategory',
+        'quantity'
+    ]
+    return marketplace_sales.loc[:, columns_to_load]
+
+def build_marketplace_listings_table(marketplace_txs, marketplace_sales):
+    sales = prepare_listing_sales(marketplace_sales, marketplace_txs)
+    return sweep_listing_lifecycles(marketplace_txs, sales)
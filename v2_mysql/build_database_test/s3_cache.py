@@ -0,0 +1,83 @@
+# In this file we cache S3 objects on local disk. Archived raw tx objects never
+# change once written, so each one is stored under a hash of its key and ETag
+# and only downloaded again if it is new or was rewritten. Misses are
+# downloaded by a thread pool, parsing runs in a process pool, and the cache
+# is kept under a size cap by evicting the least recently used files.
+
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import pandas as pd
+
+S3_CACHE_DIR = os.environ.get('S3_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'treasure-marketplace-db'))
+S3_CACHE_MAX_BYTES = int(os.environ.get('S3_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+DOWNLOAD_WORKERS = 16
+PARSE_WORKERS = os.cpu_count()
+
+class ObjectCache:
+    def __init__(self, cache_dir=S3_CACHE_DIR, max_bytes=S3_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, key, e_tag):
+        digest = hashlib.sha256('{}\0{}'.format(key, e_tag).encode()).hexdigest()
+        return os.path.join(self.cache_dir, digest)
+
+    def get(self, key, e_tag):
+        path = self.path(key, e_tag)
+        if not os.path.exists(path):
+            return None
+        os.utime(path) # mark as recently used
+        return path
+
+    def put(self, key, e_tag, body):
+        path = self.path(key, e_tag)
+        tmp_path = path + '.tmp.{}'.format(os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(body)
+        os.replace(tmp_path, path)
+        return path
+
+    def evict(self, keep=()):
+        entries = []
+        for filename in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, filename)
+            if '.tmp.' in filename or not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total_bytes = sum(size for _, size, _ in entries)
+        keep = set(keep)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            if path in keep:
+                continue
+            os.remove(path)
+            total_bytes -= size
+
+def fetch_object(obj, cache):
+    path = cache.get(obj.key, obj.e_tag)
+    if path is not None:
+        return path, False
+    return cache.put(obj.key, obj.e_tag, obj.get()["Body"].read()), True
+
+def fetch_objects(objs, cache, max_workers=DOWNLOAD_WORKERS):
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        fetched = list(executor.map(lambda obj: fetch_object(obj, cache), objs))
+    paths = [path for path, _ in fetched]
+    n_downloaded = sum(downloaded for _, downloaded in fetched)
+    return paths, n_downloaded
+
+def read_cached_csvs(bucket, prefix, cache=None, download_workers=DOWNLOAD_WORKERS, parse_workers=PARSE_WORKERS):
+    cache = cache if cache is not None else ObjectCache()
+    objs = [obj for obj in bucket.objects.filter(Prefix=prefix) if obj.key[-4:]=='.csv']
+    paths, n_downloaded = fetch_objects(objs, cache, download_workers)
+    print('{} of {} objects under {} downloaded, the rest read from cache'.format(n_downloaded, len(objs), prefix))
+
+    with ProcessPoolExecutor(max_workers=parse_workers) as executor:
+        frames = list(executor.map(pd.read_csv, paths))
+    cache.evict(keep=paths)
+    return frames
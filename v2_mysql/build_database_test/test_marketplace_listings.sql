@@ -41,7 +41,7 @@ WHERE tx_hash = update_tx_hash;
 # Test 3: all listings amounts are the same as sale amounts
 SELECT a.*, ROUND(a.listing_price_magic, 2), (b.sale_amt_magic / b.quantity), b.quantity
 FROM treasure_test.marketplace_listings a 
-INNER JOIN marketplace_sales b ON a.final_sale_tx_hash = b.tx_hash
+INNER JOIN treasure_test.marketplace_sales b ON a.final_sale_tx_hash = b.tx_hash
 WHERE ROUND(a.listing_price_magic, 2) <> ROUND((b.sale_amt_magic / b.quantity),2);
 
 # Test 4: there are no cases where two transition states are not null
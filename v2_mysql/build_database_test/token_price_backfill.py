@@ -0,0 +1,179 @@
+# In this file we fill holes in token_prices. The regular refresh only asks
+# CoinGecko for the last day and keeps what's newer than MAX(datetime), so a
+# run that doesn't happen leaves buckets that are never fetched again. Here we
+# look for runs of missing 5 minute buckets and fetch them with
+# market_chart/range queries instead. CoinGecko only returns 5 minute data for
+# ranges up to a day, so gaps are split into windows of at most a day; the
+# windows are fetched in parallel under a shared rate limit, the MAGIC and ETH
+# series of each are merged on the bucket, and only buckets that are still
+# missing get inserted. Sales around a filled gap are then reconverted to
+# USD/ETH against the new buckets.
+#
+# usage: python token_price_backfill.py [start date] [end date]
+
+import datetime as dt
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import pandas as pd
+import pytz
+import requests
+from sqlalchemy import create_engine, text
+
+from arbiscan import TokenBucket
+from bulk_load import bulk_load
+from daily_aggregates import refresh_daily_aggregates
+from token_price_index import backfill_sale_prices
+
+# point this at a local stand-in to run the backfill offline
+COINGECKO_API_URL = os.environ.get('COINGECKO_API_URL', 'https://api.coingecko.com/api/v3')
+COINGECKO_CALLS_PER_SECOND = 0.5
+COINGECKO_MAX_WORKERS = 4
+REQUEST_TIMEOUT = 30
+MAX_RETRIES = 3
+
+BUCKET = pd.Timedelta(minutes=5)
+WINDOW = pd.Timedelta(days=1)
+# CoinGecko's 5 minute points drift, so the odd bucket is always missing;
+# only runs at least this long count as a gap
+MIN_GAP = pd.Timedelta(minutes=30)
+
+tokens = {'magic': 'magic', 'eth': 'ethereum'}
+tz = pytz.timezone('UTC')
+
+def wrangle_price_data(response_json, token_name):
+    # json output of market_chart(/range) to a clean dataframe
+    response_json = pd.DataFrame(response_json['prices'])
+    response_json.rename(columns={0:'timestamp',1:'price_{}_usd'.format(token_name)},inplace=True)
+    response_json['datetime'] = [dt.datetime.fromtimestamp(int(x)/1000, tz) for x in response_json['timestamp']]
+    response_json['datetime'] = response_json.datetime.dt.floor('5min') # truncate to first 5 min
+    response_json.drop('timestamp',axis=1,inplace=True)
+    response_json.drop_duplicates('datetime', inplace=True)
+
+    return response_json
+
+def utc_timestamp(value):
+    value = pd.Timestamp(value)
+    return value.tz_localize('UTC') if value.tzinfo is None else value.tz_convert('UTC')
+
+def find_price_gaps(connection, start=None, end=None, min_gap=MIN_GAP):
+    # runs of missing buckets in [start, end] as (first missing bucket, next
+    # bucket we have or None), start defaults to the first bucket we have and
+    # end to now
+    existing = pd.read_sql(text('SELECT DISTINCT datetime FROM token_prices ORDER BY datetime'), connection)
+    existing = pd.to_datetime(existing['datetime']).dt.tz_localize('UTC')
+    start = utc_timestamp(start).floor(BUCKET) if start is not None else (existing.iloc[0] if len(existing) else None)
+    end = utc_timestamp(end if end is not None else pd.Timestamp.now(tz='UTC')).floor(BUCKET)
+    if start is None or end < start:
+        return []
+
+    before = existing.loc[existing < start]
+    inside = existing.loc[(existing >= start) & (existing <= end)]
+    after = existing.loc[existing > end]
+    # the buckets we have either side of the range bound the first and last gap
+    bounds = [before.iloc[-1] if len(before) else start - BUCKET] + list(inside) + [after.iloc[0] if len(after) else None]
+
+    gaps = []
+    for previous, following in zip(bounds[:-1], bounds[1:]):
+        gap_start = max(previous + BUCKET, start)
+        gap_end = min(following, end + BUCKET) if following is not None else end + BUCKET
+        if gap_end - gap_start >= min_gap:
+            gaps.append((gap_start, following))
+    return gaps
+
+def gap_windows(gaps, end=None):
+    # [from, to) windows of at most WINDOW covering the gaps
+    end = utc_timestamp(end if end is not None else pd.Timestamp.now(tz='UTC')).floor(BUCKET)
+    windows = []
+    for gap_start, following in gaps:
+        gap_end = min(following, end + BUCKET) if following is not None else end + BUCKET
+        window_start = gap_start
+        while window_start < gap_end:
+            windows.append((window_start, min(window_start + WINDOW, gap_end)))
+            window_start += WINDOW
+    return windows
+
+def price_range_url(token_id, window_start, window_end):
+    return '{}/coins/{}/market_chart/range?vs_currency=usd&from={}&to={}'.format(
+        COINGECKO_API_URL, token_id, int(window_start.timestamp()), int(window_end.timestamp())
+    )
+
+def get_price_range(token_name, window, rate_limiter, session):
+    request_url = price_range_url(tokens[token_name], *window)
+    for attempt in range(MAX_RETRIES):
+        rate_limiter.acquire()
+        response = session.get(request_url, timeout=REQUEST_TIMEOUT)
+        # rate limited or failed requests come back without a prices list
+        if response.status_code == 200 and isinstance(response.json().get('prices'), list):
+            return wrangle_price_data(response.json(), token_name)
+        time.sleep(2 ** attempt)
+    raise RuntimeError('coingecko request for {} from {} to {} failed: {} {}'.format(token_name, window[0], window[1], response.status_code, response.text[:200]))
+
+def get_window_prices(window, rate_limiter, session):
+    # both series for a window, merged on the bucket and cut to the window
+    magic_prices = get_price_range('magic', window, rate_limiter, session)
+    eth_prices = get_price_range('eth', window, rate_limiter, session)
+    merged_prices = magic_prices.merge(eth_prices, how='inner', on='datetime')
+    merged_prices = merged_prices.loc[(merged_prices['datetime'] >= window[0]) & (merged_prices['datetime'] < window[1])]
+    return merged_prices.loc[:,['datetime','price_magic_usd','price_eth_usd']]
+
+def read_existing_buckets(connection, window):
+    query = text('SELECT datetime FROM token_prices WHERE datetime >= :start AND datetime < :end')
+    params = {'start': str(window[0].tz_localize(None)), 'end': str(window[1].tz_localize(None))}
+    return set(pd.to_datetime(pd.read_sql(query, connection, params=params)['datetime']).dt.tz_localize('UTC'))
+
+def backfill_token_prices(connection, start=None, end=None, min_gap=MIN_GAP, max_workers=COINGECKO_MAX_WORKERS, calls_per_second=COINGECKO_CALLS_PER_SECOND):
+    gaps = find_price_gaps(connection, start, end, min_gap)
+    windows = gap_windows(gaps, end)
+    if not windows:
+        print('no gaps in token_prices')
+        return pd.DataFrame(columns=['datetime','price_magic_usd','price_eth_usd'])
+    print('fetching {} window(s) for {} gap(s) in token_prices'.format(len(windows), len(gaps)))
+
+    rate_limiter = TokenBucket(calls_per_second, 1)
+    session = requests.Session()
+    session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=max_workers))
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=max_workers))
+    inserted = []
+    # each window is written as soon as it's in, so a failure part way keeps
+    # what was fetched and a rerun only asks for what's still missing
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(get_window_prices, window, rate_limiter, session): window for window in windows}
+        for future in as_completed(futures):
+            window_prices = future.result()
+            existing = read_existing_buckets(connection, futures[future])
+            window_prices = window_prices.loc[~window_prices['datetime'].isin(existing)]
+            if not window_prices.empty:
+                bulk_load(window_prices, 'token_prices', connection)
+                inserted.append(window_prices)
+    session.close()
+    inserted = pd.concat(inserted, ignore_index=True) if inserted else pd.DataFrame(columns=['datetime','price_magic_usd','price_eth_usd'])
+    print('inserted {} missing token price bucket(s)'.format(len(inserted)))
+
+    # sales from a gap up to the next bucket we already had were converted
+    # with an older bucket (or not at all)
+    backfilled_dates = set()
+    for gap_start, following in gaps:
+        backfilled_dates.update(backfill_sale_prices(connection, since=gap_start, until=following, only_missing=False))
+    refresh_daily_aggregates(connection, sorted(backfilled_dates))
+    return inserted
+
+if __name__ == '__main__':
+    start = pd.Timestamp(sys.argv[1]) if len(sys.argv) > 1 else None
+    end = pd.Timestamp(sys.argv[2]) if len(sys.argv) > 2 else None
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "constants", "mysql_credential.json")) as f:
+        mysql_credentials = json.loads(f.read())
+    engine = create_engine(
+        "mysql+pymysql://{user}:{pw}@{host}/{db}".format(
+        user=mysql_credentials['username'],
+        pw=mysql_credentials['pw'],
+        host=mysql_credentials['host'],
+        db="treasure_test"
+        )
+    )
+    with engine.connect() as connection:
+        backfill_token_prices(connection, start, end)
+    engine.dispose()
@@ -0,0 +1,160 @@
+# In this file we convert sale amounts to USD and ETH when sales are ingested.
+# token_prices holds MAGIC and ETH prices in 5 minute buckets. Instead of
+# joining sales to a daily AVG of it on every query, each sale gets the prices
+# of the nearest bucket at or before it: the buckets are held as sorted arrays
+# and a whole batch is looked up with one np.searchsorted. A sale with no
+# bucket within PRICE_MAX_AGE before it is left NULL, and the backfill fills
+# those in (and all the rows from before the columns existed) once the prices
+# are there. Prices are pulled on their own schedule, so a sale may have been
+# converted with an older bucket than the one that later lands before it: the
+# price refresh recomputes every sale from its first new bucket on.
+#
+# usage: python token_price_index.py backfill [chunksize]
+
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine, inspect, text
+
+from binary_keys import physical_table
+from daily_aggregates import refresh_daily_aggregates, touched_dates
+
+PRICE_MAX_AGE = pd.Timedelta(hours=1)
+BACKFILL_CHUNKSIZE = 10000
+
+price_cols = ['sale_amt_usd', 'sale_amt_eth']
+
+def naive_utc(datetimes):
+    datetimes = pd.Series(pd.to_datetime(datetimes))
+    if datetimes.dt.tz is not None:
+        datetimes = datetimes.dt.tz_convert('UTC').dt.tz_localize(None)
+    return datetimes
+
+class TokenPriceIndex:
+    def __init__(self, datetimes, price_magic_usd, price_eth_usd, max_age=PRICE_MAX_AGE):
+        datetimes = naive_utc(datetimes).values.astype('datetime64[ns]')
+        order = np.argsort(datetimes, kind='mergesort')
+        self.datetimes = datetimes[order]
+        self.price_magic_usd = np.asarray(price_magic_usd, dtype='float64')[order]
+        self.price_eth_usd = np.asarray(price_eth_usd, dtype='float64')[order]
+        self.max_age = max_age
+
+    def __len__(self):
+        return len(self.datetimes)
+
+    def lookup(self, datetimes):
+        # prices of the latest bucket at or before each datetime, NaN if there
+        # is none or it's older than max_age
+        datetimes = naive_utc(datetimes).values.astype('datetime64[ns]')
+        if len(self.datetimes) == 0:
+            return np.full(len(datetimes), np.nan), np.full(len(datetimes), np.nan)
+        positions = np.searchsorted(self.datetimes, datetimes, side='right') - 1
+        found = (positions >= 0) & ~pd.isnull(datetimes)
+        positions = np.where(found, positions, 0)
+        if self.max_age is not None:
+            found &= datetimes - self.datetimes[positions] <= self.max_age.to_timedelta64()
+        price_magic_usd = np.where(found, self.price_magic_usd[positions], np.nan)
+        price_eth_usd = np.where(found, self.price_eth_usd[positions], np.nan)
+        return price_magic_usd, price_eth_usd
+
+def read_token_price_index(connection, start=None, end=None, max_age=PRICE_MAX_AGE):
+    # buckets covering [start, end], plus the one before start
+    conditions = []
+    params = {}
+    if start is not None:
+        lookback = max_age if max_age is not None else pd.Timedelta(days=365 * 10)
+        conditions.append('datetime >= :start')
+        params['start'] = str(naive_utc([start]).iloc[0] - lookback)
+    if end is not None:
+        conditions.append('datetime <= :end')
+        params['end'] = str(naive_utc([end]).iloc[0])
+    query = text('SELECT datetime, price_magic_usd, price_eth_usd FROM token_prices {} ORDER BY datetime'.format(
+        'WHERE ' + ' AND '.join(conditions) if conditions else ''
+    ))
+    prices = pd.read_sql(query, connection, params=params)
+    return TokenPriceIndex(prices['datetime'], prices['price_magic_usd'], prices['price_eth_usd'], max_age)
+
+def add_sale_price_columns(connection):
+    # marketplace_sales tables created before these columns existed (the
+    # keyed table always has them)
+    table = physical_table(connection, 'marketplace_sales')
+    existing = {col['name'] for col in inspect(connection).get_columns(table)}
+    for col in price_cols:
+        if col not in existing:
+            connection.execute(text('ALTER TABLE {} ADD COLUMN {} DOUBLE'.format(table, col)))
+
+def add_sale_prices(sales, price_index):
+    sales = sales.copy()
+    price_magic_usd, price_eth_usd = price_index.lookup(sales['datetime'])
+    sales['sale_amt_usd'] = sales['sale_amt_magic'].values * price_magic_usd
+    sales['sale_amt_eth'] = sales['sale_amt_usd'].values / price_eth_usd
+    return sales
+
+def convert_sales(connection, sales):
+    # what refresh_database calls on each batch before writing it
+    if sales.empty:
+        return sales.assign(**{col: pd.Series(dtype='float64') for col in price_cols})
+    price_index = read_token_price_index(connection, sales['datetime'].min(), sales['datetime'].max())
+    return add_sale_prices(sales, price_index)
+
+def backfill_sale_prices(connection, chunksize=BACKFILL_CHUNKSIZE, since=None, until=None, only_missing=True):
+    # fill sale_amt_usd/sale_amt_eth for sales in [since, until), where they are
+    # still NULL or for all of them if not only_missing, a chunk of sales at a
+    # time in (datetime, tx_hash) order with one transaction per chunk.
+    # Returns the dates of the sales that were filled.
+    add_sale_price_columns(connection)
+    # the keyset needs the tx_hash index, so a swapped table is read and
+    # updated through its keyed table (binary tx_hash, compared the same way)
+    table = physical_table(connection, 'marketplace_sales')
+    select_query = text("""
+        SELECT tx_hash, datetime, sale_amt_magic
+        FROM {}
+        WHERE {}(datetime > :last_datetime OR (datetime = :last_datetime AND tx_hash > :last_tx_hash)){}
+        ORDER BY datetime, tx_hash
+        LIMIT :chunksize
+    """.format(table, 'sale_amt_usd IS NULL AND ' if only_missing else '', ' AND datetime < :until' if until is not None else ''))
+    update_query = text('UPDATE {} SET sale_amt_usd = :sale_amt_usd, sale_amt_eth = :sale_amt_eth WHERE tx_hash = :tx_hash'.format(table))
+    # keyset starts just before since, '' sorts before any tx_hash
+    last_datetime = str(naive_utc([since]).iloc[0]) if since is not None else '1970-01-01 00:00:00'
+    last_tx_hash = ''
+    n_read = 0
+    filled_datetimes = []
+    while True:
+        params = {'last_datetime': last_datetime, 'last_tx_hash': last_tx_hash, 'chunksize': chunksize}
+        if until is not None:
+            params['until'] = str(naive_utc([until]).iloc[0])
+        chunk = pd.read_sql(select_query, connection, params=params)
+        if chunk.empty:
+            break
+        n_read += len(chunk)
+        last_datetime, last_tx_hash = str(chunk['datetime'].iloc[-1]), chunk['tx_hash'].iloc[-1]
+        chunk = convert_sales(connection, chunk)
+        chunk = chunk.loc[chunk['sale_amt_usd'].notnull()]
+        if not chunk.empty:
+            with connection.begin():
+                connection.execute(update_query, chunk.loc[:,['tx_hash'] + price_cols].to_dict('records'))
+            filled_datetimes.append(chunk['datetime'])
+    filled_datetimes = pd.concat(filled_datetimes) if filled_datetimes else pd.Series(dtype='datetime64[ns]')
+    print('filled USD/ETH amounts for {} of {} sales'.format(len(filled_datetimes), n_read))
+    return touched_dates(filled_datetimes)
+
+if __name__ == '__main__':
+    command = sys.argv[1]
+    chunksize = int(sys.argv[2]) if len(sys.argv) > 2 else BACKFILL_CHUNKSIZE
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "constants", "mysql_credential.json")) as f:
+        mysql_credentials = json.loads(f.read())
+    engine = create_engine(
+        "mysql+pymysql://{user}:{pw}@{host}/{db}".format(
+        user=mysql_credentials['username'],
+        pw=mysql_credentials['pw'],
+        host=mysql_credentials['host'],
+        db="treasure"
+        )
+    )
+    with engine.connect() as connection:
+        if command == 'backfill':
+            refresh_daily_aggregates(connection, backfill_sale_prices(connection, chunksize))
+    engine.dispose()
@@ -0,0 +1,70 @@
+# In this file we keep track of how far ingestion has got. Rather than listing
+# the whole bucket and re-reading the newest raw CSV on every refresh, we
+# store a small JSON manifest with the last processed block and the hashes
+# seen in that block (the next refresh starts from that block again, so those
+# are the only hashes that need filtering out). Reading it is a single GET no
+# matter how many runs we've done.
+
+import datetime as dt
+import io
+import json
+
+import pandas as pd
+
+WATERMARK_KEY = 'state/ingestion_watermark.json'
+RAW_MARKETPLACE_TXS_PREFIX = 'marketplace-txs/'
+
+def is_missing_key(error):
+    if isinstance(error, FileNotFoundError):
+        return True
+    return getattr(error, 'response', {}).get('Error', {}).get('Code') in ('NoSuchKey', '404')
+
+class WatermarkStore:
+    def __init__(self, bucket, key=WATERMARK_KEY):
+        self.bucket = bucket
+        self.key = key
+
+    def read(self):
+        try:
+            body = self.bucket.Object(self.key).get()['Body'].read()
+        except Exception as error:
+            if is_missing_key(error):
+                return None
+            raise
+        return json.loads(body)
+
+    def write(self, watermark):
+        self.bucket.Object(self.key).put(Body=json.dumps(watermark).encode())
+
+def build_watermark(marketplace_txs, previous_watermark=None):
+    block_numbers = marketplace_txs['blockNumber'].astype('int64') if not marketplace_txs.empty else pd.Series(dtype='int64')
+    if block_numbers.empty:
+        return previous_watermark
+    last_block = int(block_numbers.max())
+    boundary_tx_hashes = set(marketplace_txs.loc[block_numbers.values==last_block, 'hash'])
+    if previous_watermark is not None and previous_watermark['last_block'] == last_block:
+        boundary_tx_hashes |= set(previous_watermark['boundary_tx_hashes'])
+    return {
+        'last_block': last_block,
+        'boundary_tx_hashes': sorted(boundary_tx_hashes),
+        'updated_at': dt.datetime.utcnow().isoformat()
+    }
+
+def scan_bucket_watermark(bucket):
+    # the old way: find the newest raw marketplace CSV and read it. Only used
+    # to bootstrap the manifest the first time.
+    get_last_modified = lambda obj: obj.last_modified
+    objs = [obj for obj in bucket.objects.all() if obj.key[:16]==RAW_MARKETPLACE_TXS_PREFIX]
+    if not objs:
+        return None
+    latest_obj = sorted(objs, key=get_last_modified)[-1]
+    latest_mkt_txs = pd.read_csv(io.BytesIO(latest_obj.get()["Body"].read()))
+    return build_watermark(latest_mkt_txs)
+
+def read_watermark(store, bucket):
+    watermark = store.read()
+    if watermark is None:
+        watermark = scan_bucket_watermark(bucket)
+        if watermark is not None:
+            store.write(watermark)
+    return watermark
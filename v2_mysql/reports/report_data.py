@@ -0,0 +1,142 @@
+# In this file we query the data behind the report charts. Rather than pulling
+# every sale into pandas and grouping there, each chart asks the database for
+# just the daily aggregates it plots, optionally within a date range. The
+# queries only use DATE(), GROUP BY and window functions, so they run the same
+# against the v2 MySQL db and the v1 sqlite db. Medians are done with
+# ROW_NUMBER/COUNT windows since neither database has a MEDIAN aggregate.
+#
+# Setting full_table=True (or REPORT_FULL_TABLE=1) falls back to the old
+# approach: SELECT * once and compute the same frames in pandas.
+
+import datetime as dt
+import os
+
+import pandas as pd
+from sqlalchemy import text
+
+REPORT_FULL_TABLE = os.environ.get('REPORT_FULL_TABLE', '0') == '1'
+# inclusive date range as YYYY-MM-DD, unset means all of history
+REPORT_START_DATE = dt.date.fromisoformat(os.environ['REPORT_START_DATE']) if os.environ.get('REPORT_START_DATE') else None
+REPORT_END_DATE = dt.date.fromisoformat(os.environ['REPORT_END_DATE']) if os.environ.get('REPORT_END_DATE') else None
+
+class ReportData:
+    def __init__(self, connection, time_column='datetime', start_date=REPORT_START_DATE, end_date=REPORT_END_DATE, full_table=REPORT_FULL_TABLE):
+        self.connection = connection
+        self.time_column = time_column
+        self.start_date = start_date
+        self.end_date = end_date
+        self.full_table = full_table
+        self._sales = None
+
+    def date_filter(self, params):
+        # compare the raw column against the range so an index on it can be used
+        conditions = []
+        if self.start_date is not None:
+            conditions.append('{} >= :start_date'.format(self.time_column))
+            params['start_date'] = str(self.start_date)
+        if self.end_date is not None:
+            conditions.append('{} < :end_date'.format(self.time_column))
+            params['end_date'] = str(self.end_date + dt.timedelta(days=1))
+        return conditions
+
+    def where_clause(self, params, collection=None, nft_names=None, extra_conditions=()):
+        conditions = self.date_filter(params) + list(extra_conditions)
+        if collection is not None:
+            conditions.append('nft_collection = :collection')
+            params['collection'] = collection
+        if nft_names is not None:
+            conditions.append('nft_name IN ({})'.format(', '.join(':nft_name_{}'.format(i) for i in range(len(nft_names)))))
+            params.update({'nft_name_{}'.format(i): name for i, name in enumerate(nft_names)})
+        return 'WHERE ' + ' AND '.join(conditions) if conditions else ''
+
+    def query(self, sql, params):
+        df = pd.read_sql(text(sql), self.connection, params=params)
+        if 'date' in df.columns:
+            df['date'] = pd.to_datetime(df['date']).dt.date
+        return df
+
+    def sales(self):
+        # the full table fallback, only read once per report
+        if self._sales is None:
+            sales = pd.read_sql(text('SELECT * FROM marketplace_sales'), self.connection)
+            sales[self.time_column] = pd.to_datetime(sales[self.time_column])
+            sales['date'] = sales[self.time_column].dt.date
+            if self.start_date is not None:
+                sales = sales.loc[sales['date'] >= self.start_date]
+            if self.end_date is not None:
+                sales = sales.loc[sales['date'] <= self.end_date]
+            sales['sale_amt_magic_adj'] = sales['sale_amt_magic'] / sales['quantity']
+            self._sales = sales
+        return self._sales
+
+    def filter_sales(self, collection=None, nft_names=None):
+        sales = self.sales()
+        if collection is not None:
+            sales = sales.loc[sales['nft_collection']==collection]
+        if nft_names is not None:
+            sales = sales.loc[sales['nft_name'].isin(nft_names)]
+        return sales
+
+    def daily_sales(self, group_by=(), collection=None):
+        # quantity and sale_amt_magic summed per day and group_by columns
+        group_by = list(group_by)
+        if self.full_table:
+            return self.filter_sales(collection).groupby(['date'] + group_by, as_index=False).agg({'quantity':'sum', 'sale_amt_magic':'sum'})
+
+        params = {}
+        group_cols = ''.join(', {}'.format(col) for col in group_by)
+        sql = """
+            SELECT DATE({time_column}) AS date{group_cols}, SUM(quantity) AS quantity, SUM(sale_amt_magic) AS sale_amt_magic
+            FROM marketplace_sales
+            {where}
+            GROUP BY DATE({time_column}){group_cols}
+            ORDER BY 1{group_cols}
+        """.format(time_column=self.time_column, group_cols=group_cols, where=self.where_clause(params, collection))
+        return self.query(sql, params)
+
+    def daily_median_price(self, group_by=(), collection=None, nft_names=None, per_unit=True):
+        # median sale price per day and group_by columns, per NFT sold if
+        # per_unit (sale_amt_magic_adj) or per sale otherwise
+        group_by = list(group_by)
+        value_col = 'sale_amt_magic_adj' if per_unit else 'sale_amt_magic'
+        if self.full_table:
+            return self.filter_sales(collection, nft_names).groupby(['date'] + group_by, as_index=False).agg({value_col:'median'})
+
+        params = {}
+        group_cols = ''.join(', {}'.format(col) for col in group_by)
+        value = 'sale_amt_magic / quantity' if per_unit else 'sale_amt_magic'
+        where = self.where_clause(params, collection, nft_names, ['{} IS NOT NULL'.format(value)])
+        sql = """
+            WITH ranked AS (
+                SELECT
+                    DATE({time_column}) AS date{group_cols},
+                    {value} AS value,
+                    ROW_NUMBER() OVER (PARTITION BY DATE({time_column}){group_cols} ORDER BY {value}) AS rn,
+                    COUNT(*) OVER (PARTITION BY DATE({time_column}){group_cols}) AS n
+                FROM marketplace_sales
+                {where}
+            )
+            SELECT date{group_cols}, AVG(value) AS {value_col}
+            FROM ranked
+            WHERE 2 * rn IN (n, n + 1, n + 2)
+            GROUP BY date{group_cols}
+            ORDER BY 1{group_cols}
+        """.format(time_column=self.time_column, group_cols=group_cols, value=value, value_col=value_col, where=where)
+        # 2 * rn IN (n, n + 1, n + 2) picks the middle row for odd n and the
+        # two middle rows for even n, without needing integer division
+        return self.query(sql, params)
+
+    def nft_names(self, collection):
+        # names in the order they first sold, which is what Series.unique()
+        # gave on the old full table pull
+        if self.full_table:
+            sales = self.filter_sales(collection).sort_values([self.time_column, 'nft_name'], kind='mergesort')
+            return list(sales['nft_name'].dropna().unique())
+        params = {}
+        sql = """
+            SELECT nft_name FROM marketplace_sales
+            {where}
+            GROUP BY nft_name
+            ORDER BY MIN({time_column}), nft_name
+        """.format(time_column=self.time_column, where=self.where_clause(params, collection, extra_conditions=['nft_name IS NOT NULL']))
+        return list(self.query(sql, params)['nft_name'])
@@ -12,5 +12,7 @@ CREATE TABLE IF NOT EXISTS marketplace_sales (
     nft_name VARCHAR(255),
     nft_subcategory VARCHAR(255),
     quantity INT NOT NULL,
+    sale_amt_usd DOUBLE,
+    sale_amt_eth DOUBLE,
     PRIMARY KEY (tx_hash)
 );
\ No newline at end of file
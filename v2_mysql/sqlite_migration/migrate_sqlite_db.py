@@ -1,61 +1,243 @@
-# In this script we will migrate the marketplace_sales table from our sqlite db
-# to the new mysql db.
+# In this script we will migrate the v1 tables from our sqlite db to the new
+# mysql db. Tables are streamed rather than loaded whole: each one is read in
+# rowid order with fetchmany, converted and written a chunk at a time, and the
+# position reached is committed in the same transaction as the chunk so an
+# interrupted migration picks up after the last committed chunk. The tables
+# are migrated in parallel and afterwards compared by row count and checksum.
+#
+# usage: python migrate_sqlite_db.py [migrate|verify] [table ...]
 
-import csv
 import json
 import os
-import pandas as pd
-import pymysql
-from sqlalchemy import create_engine
 import sqlite3
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine, text
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'build_database_test'))
+from bulk_load import bulk_load, upsert
+
+SQLITE_DB = os.path.join("..", "v1_sqlite", "treasure.db")
+CHUNKSIZE = 50000
+KEY_CHUNKSIZE = 500
+CHECKPOINT_TABLE = 'migration_checkpoints'
+
+# key: the column rows are merged on (None means plain appends, which is
+# still safe because the checkpoint moves in the same transaction)
+# checksum_columns: columns that survive the round trip exactly, floats are
+# left out as MySQL FLOAT columns don't give back the same value
+migrations = {
+    'marketplace_sales': {
+        'key': 'tx_hash',
+        'renames': {'timestamp': 'datetime'},
+        'datetime_columns': ['datetime'],
+        'checksum_columns': ['tx_hash', 'datetime', 'wallet_buyer', 'wallet_seller', 'nft_collection', 'nft_id', 'quantity'],
+    },
+    'marketplace_txs_raw': {
+        'key': 'hash',
+        'renames': {},
+        'datetime_columns': [],
+        'checksum_columns': ['hash', 'blockNumber', 'timeStamp', 'from_wallet', 'to_wallet', 'input'],
+    },
+    'magic_txs_raw': {
+        'key': None,
+        'renames': {},
+        'datetime_columns': [],
+        'checksum_columns': ['hash', 'blockNumber', 'timeStamp', 'from_wallet', 'to_wallet', 'contractAddress'],
+    },
+}
+
+def read_sqlite_chunks(sqlite_path, table, after_rowid=-1, chunksize=CHUNKSIZE):
+    # a generator, so only one chunk is ever held in memory
+    sqlite_connection = sqlite3.connect(sqlite_path)
+    try:
+        sqlite_cursor = sqlite_connection.cursor()
+        sqlite_cursor.execute('SELECT rowid AS _rowid, * FROM "{}" WHERE rowid > ? ORDER BY rowid'.format(table), (after_rowid,))
+        columns = [description[0] for description in sqlite_cursor.description]
+        while True:
+            rows = sqlite_cursor.fetchmany(chunksize)
+            if not rows:
+                break
+            yield pd.DataFrame(rows, columns=columns)
+        sqlite_cursor.close()
+    finally:
+        sqlite_connection.close()
+
+def convert_chunk(chunk, migration):
+    chunk = chunk.drop(columns=['_rowid']).rename(columns=migration['renames'])
+    for col in migration['datetime_columns']:
+        chunk[col] = pd.to_datetime(chunk[col], utc=True)
+    return chunk
+
+def canonical_values(values):
+    # the same value has to give the same text whichever side it came from,
+    # e.g. 12 vs 12.0 from a REAL column or a tz-aware vs naive UTC datetime
+    def canonical(x):
+        if x is None or (isinstance(x, float) and np.isnan(x)) or x is pd.NaT:
+            return ''
+        if isinstance(x, (float, np.floating)) and float(x).is_integer():
+            return str(int(x))
+        if isinstance(x, (pd.Timestamp, np.datetime64)) or hasattr(x, 'isoformat'):
+            x = pd.Timestamp(x)
+            x = x.tz_convert('UTC').tz_localize(None) if x.tzinfo is not None else x
+            return x.isoformat()
+        return str(x)
+    return [canonical(x) for x in values]
+
+def normalize_target_chunk(chunk, migration):
+    # mysql hands back naive datetimes (strings from the sqlite fallback)
+    for col in migration['datetime_columns']:
+        chunk[col] = pd.to_datetime(chunk[col], utc=True)
+    return chunk
+
+def chunk_checksum(chunk, columns):
+    # order independent: rows are hashed on their own and added up mod 2**64
+    canonical = pd.DataFrame({col: canonical_values(chunk[col].astype(object).values) for col in columns})
+    return int(pd.util.hash_pandas_object(canonical, index=False).values.sum(dtype=np.uint64))
 
-try:
-    os.chdir("v2_mysql")
-except:
-    pass
-
-# read in sqlite data
-sqlite_connection = sqlite3.connect("../v1_sqlite/treasure.db")
-sqlite_cursor = sqlite_connection.cursor()
-sqlite_cursor.execute("SELECT * FROM marketplace_sales;")
-marketplace_sales = sqlite_cursor.fetchall()
-marketplace_sales = pd.DataFrame(marketplace_sales)
-marketplace_sales.columns = [description[0] for description in sqlite_cursor.description]
-
-marketplace_sales.rename(columns={'timestamp':'datetime'}, inplace=True)
-sqlite_cursor.close()
-
-# read in important contract addresses and marketplace method IDs
-credential = os.path.join("database_refresh", "constants", "mysql_credential.json")
-with open(credential) as f:
-    mysql_credentials = json.loads(f.read())
-
-
-# write table to mysql, filtering out duplicate txs
-engine = create_engine(
-    "mysql+pymysql://{user}:{pw}@{host}/{db}".format(
-        user=mysql_credentials['username'], 
-        pw=mysql_credentials['pw'], 
-        host=mysql_credentials['host'], 
-        db="treasure"
+def add_checksums(a, b):
+    return (a + b) % 2**64
+
+def create_checkpoint_table(connection):
+    connection.execute(text("""
+        CREATE TABLE IF NOT EXISTS {} (
+            table_name VARCHAR(64) PRIMARY KEY,
+            last_rowid BIGINT NOT NULL,
+            rows_migrated BIGINT NOT NULL,
+            checksum VARCHAR(20) NOT NULL
         )
+    """.format(CHECKPOINT_TABLE)))
+
+def read_checkpoint(connection, table):
+    result = connection.execute(
+        text('SELECT last_rowid, rows_migrated, checksum FROM {} WHERE table_name = :table_name'.format(CHECKPOINT_TABLE)),
+        {'table_name': table}
+    ).fetchone()
+    if result is None:
+        return {'last_rowid': -1, 'rows_migrated': 0, 'checksum': 0}
+    return {'last_rowid': result[0], 'rows_migrated': result[1], 'checksum': int(result[2])}
+
+def write_checkpoint(connection, table, checkpoint):
+    connection.execute(text('DELETE FROM {} WHERE table_name = :table_name'.format(CHECKPOINT_TABLE)), {'table_name': table})
+    connection.execute(
+        text('INSERT INTO {} (table_name, last_rowid, rows_migrated, checksum) VALUES (:table_name, :last_rowid, :rows_migrated, :checksum)'.format(CHECKPOINT_TABLE)),
+        {'table_name': table, 'last_rowid': checkpoint['last_rowid'], 'rows_migrated': checkpoint['rows_migrated'], 'checksum': str(checkpoint['checksum'])}
     )
 
-connection = engine.connect()
-existing_tx_hashes_result = connection.execute("SELECT tx_hash FROM marketplace_sales")
+def migrate_table(engine, sqlite_path, table, chunksize=CHUNKSIZE):
+    migration = migrations[table]
+    with engine.connect() as connection:
+        checkpoint = read_checkpoint(connection, table)
+        if checkpoint['rows_migrated']:
+            print('{}: resuming after rowid {} ({} rows already migrated)'.format(table, checkpoint['last_rowid'], checkpoint['rows_migrated']))
+        for chunk in read_sqlite_chunks(sqlite_path, table, checkpoint['last_rowid'], chunksize):
+            last_rowid = int(chunk['_rowid'].max())
+            chunk = convert_chunk(chunk, migration)
+            checkpoint = {
+                'last_rowid': last_rowid,
+                'rows_migrated': checkpoint['rows_migrated'] + len(chunk),
+                'checksum': add_checksums(checkpoint['checksum'], chunk_checksum(chunk, migration['checksum_columns']))
+            }
+            with connection.begin():
+                if migration['key'] is None:
+                    bulk_load(chunk, table, connection)
+                else:
+                    # rows that were already in mysql before the migration are kept as they are
+                    upsert(chunk, table, connection, key=migration['key'], update=False)
+                write_checkpoint(connection, table, checkpoint)
+        print('{}: {} rows migrated'.format(table, checkpoint['rows_migrated']))
+    return checkpoint
 
-existing_tx_hashes_lst = []
-for row in existing_tx_hashes_result:
-     existing_tx_hashes_lst.append(row[0])
+def migrate_tables(engine, sqlite_path, tables, chunksize=CHUNKSIZE):
+    with engine.begin() as connection:
+        create_checkpoint_table(connection)
+    # one thread per table, each with its own sqlite and mysql connection
+    with ThreadPoolExecutor(max_workers=len(tables)) as executor:
+        checkpoints = list(executor.map(lambda table: migrate_table(engine, sqlite_path, table, chunksize), tables))
+    return dict(zip(tables, checkpoints))
 
-marketplace_sales = marketplace_sales.loc[~marketplace_sales.tx_hash.isin(existing_tx_hashes_lst)]
+def read_mysql_rows_for_keys(connection, table, key, keys, columns):
+    frames = []
+    for chunk_start in range(0, len(keys), KEY_CHUNKSIZE):
+        key_chunk = keys[chunk_start:chunk_start + KEY_CHUNKSIZE]
+        placeholders = ', '.join(':k{}'.format(i) for i in range(len(key_chunk)))
+        query = text('SELECT {} FROM `{}` WHERE `{}` IN ({})'.format(', '.join('`{}`'.format(col) for col in columns), table, key, placeholders))
+        result = connection.execute(query, {'k{}'.format(i): value for i, value in enumerate(key_chunk)})
+        frames.append(pd.DataFrame(result.fetchall(), columns=columns))
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns)
 
-marketplace_sales.to_sql(
-    'marketplace_sales', 
-    con = engine, 
-    if_exists = 'append', 
-    chunksize = 1000,
-    index=False
+def stream_mysql_table(connection, table, columns, chunksize=CHUNKSIZE):
+    # stream_results gives a server side cursor, so the table isn't buffered client side
+    result = connection.execution_options(stream_results=True).execute(
+        text('SELECT {} FROM `{}`'.format(', '.join('`{}`'.format(col) for col in columns), table))
     )
+    while True:
+        rows = result.fetchmany(chunksize)
+        if not rows:
+            break
+        yield pd.DataFrame(rows, columns=columns)
+
+def verify_table(engine, sqlite_path, table, chunksize=CHUNKSIZE):
+    migration = migrations[table]
+    columns = migration['checksum_columns']
+    source = {'rows': 0, 'checksum': 0}
+    target = {'rows': 0, 'checksum': 0}
+    with engine.connect() as connection:
+        for chunk in read_sqlite_chunks(sqlite_path, table, chunksize=chunksize):
+            chunk = convert_chunk(chunk, migration)
+            source['rows'] += len(chunk)
+            source['checksum'] = add_checksums(source['checksum'], chunk_checksum(chunk, columns))
+            if migration['key'] is not None:
+                # the mysql table may also hold rows the v2 refresh added, so
+                # only compare against the keys that came from sqlite
+                target_chunk = read_mysql_rows_for_keys(connection, table, migration['key'], list(chunk[migration['key']].unique()), columns)
+                target_chunk = normalize_target_chunk(target_chunk, migration)
+                target['rows'] += len(target_chunk)
+                target['checksum'] = add_checksums(target['checksum'], chunk_checksum(target_chunk, columns))
+        if migration['key'] is None:
+            for target_chunk in stream_mysql_table(connection, table, columns, chunksize):
+                target_chunk = normalize_target_chunk(target_chunk, migration)
+                target['rows'] += len(target_chunk)
+                target['checksum'] = add_checksums(target['checksum'], chunk_checksum(target_chunk, columns))
+    matches = source == target
+    print('{}: {} ({} rows in sqlite, {} in mysql)'.format(table, 'OK' if matches else 'MISMATCH', source['rows'], target['rows']))
+    return {'table': table, 'matches': matches, 'source': source, 'target': target}
+
+def verify_tables(engine, sqlite_path, tables, chunksize=CHUNKSIZE):
+    with ThreadPoolExecutor(max_workers=len(tables)) as executor:
+        return list(executor.map(lambda table: verify_table(engine, sqlite_path, table, chunksize), tables))
+
+if __name__ == '__main__':
+    try:
+        os.chdir("v2_mysql")
+    except:
+        pass
+
+    command = sys.argv[1] if len(sys.argv) > 1 else 'migrate'
+    tables = sys.argv[2:] or list(migrations)
+
+    # read in mysql credentials
+    credential = os.path.join("database_refresh", "constants", "mysql_credential.json")
+    with open(credential) as f:
+        mysql_credentials = json.loads(f.read())
+
+    engine = create_engine(
+        "mysql+pymysql://{user}:{pw}@{host}/{db}".format(
+            user=mysql_credentials['username'],
+            pw=mysql_credentials['pw'],
+            host=mysql_credentials['host'],
+            db="treasure"
+            ),
+        pool_size=len(tables)
+        )
+
+    if command == 'migrate':
+        migrate_tables(engine, SQLITE_DB, tables)
+    results = verify_tables(engine, SQLITE_DB, tables)
 
-engine.dispose()
\ No newline at end of file
+    engine.dispose()
+    if not all(result['matches'] for result in results):
+        sys.exit(1)